@@ -14,6 +14,7 @@ import os
 from keras.models import Model
 from mymrcnn.config import Config
 import mymrcnn.myBackboneModel as modellib
+import mymrcnn.pyramid as imagepyramid
 ROOT_DIR = os.path.abspath("D:/workfolder/mymrcnnWork")
 MODEL_DIR = os.path.join(ROOT_DIR, "logs")
 WORK_DIR = "D:/MyWork"
@@ -21,9 +22,9 @@ def target_category_loss(x, tensor, nb_classes):
     return tf.multiply(x, tf.convert_to_tensor(tensor,dtype=tf.float32))
 
 def load_image(path):
-    img = cv2.imread(path)
-    x = cv2.resize(img,(576,384))
-    return x
+    # Through the shared pyramid, a copy since the cached image is read only
+    image_pyramid = imagepyramid.get_pyramid(os.path.dirname(path))
+    return image_pyramid.get(os.path.basename(path), (384, 576)).copy()
  
 def register_gradient():
     if "GuidedBackProp" not in ops._gradient_registry._registry:
@@ -1,7 +1,6 @@
 import os
 import json
 
-import albumentations as albu
 import cv2
 import keras
 from keras import backend as K
@@ -20,6 +19,8 @@ from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 import segmentation_models as sm
 import tensorflow as tf
+import mymrcnn.pyramid as imagepyramid
+import mymrcnn.augmentation as batchaugmentation
 
 import keras.backend as K
 from keras.legacy import interfaces
@@ -223,8 +224,10 @@ class DataGenerator(keras.utils.Sequence):
     def __init__(self, list_IDs, df, target_df=None, mode='fit',
                  base_path="D:/MyWork/train_images",
                  batch_size=32, dim=(1400, 2100), n_channels=3, reshape=None, gamma=None,
-                 augment=False, n_classes=4, random_state=2019, shuffle=True):
+                 augment=False, n_classes=4, random_state=2019, shuffle=True, pyramid=None):
         self.dim = dim
+        # Optional shared ImagePyramid of base_path, see mymrcnn.pyramid
+        self.pyramid = pyramid
         self.batch_size = batch_size
         self.df = df
         self.mode = mode
@@ -235,6 +238,7 @@ class DataGenerator(keras.utils.Sequence):
         self.gamma = gamma
         self.n_channels = n_channels
         self.augment = augment
+        self.augmenter = batchaugmentation.albumentations_compatible() if augment else None
         self.n_classes = n_classes
         self.shuffle = shuffle
         self.random_state = random_state
@@ -287,15 +291,20 @@ class DataGenerator(keras.utils.Sequence):
         # Generate data
         for i, ID in enumerate(list_IDs_batch):
             im_name = self.df['ImageId'].iloc[ID]
-            img_path = self.base_path + "/" + im_name
-            img = self.__load_rgb(img_path)
-            
-            if self.reshape is not None:
-                img = np_resize(img, self.reshape)
-            
-            # Adjust gamma
-            if self.gamma is not None:
-                img = adjust_gamma(img, gamma=self.gamma)
+            if self.pyramid is not None:
+                # Decoded once, resized and gamma corrected with the other variants
+                img = self.pyramid.get(im_name, self.reshape,
+                                       imagepyramid.unit_rgb_transform(self.gamma))
+            else:
+                img_path = self.base_path + "/" + im_name
+                img = self.__load_rgb(img_path)
+
+                if self.reshape is not None:
+                    img = np_resize(img, self.reshape)
+
+                # Adjust gamma
+                if self.gamma is not None:
+                    img = adjust_gamma(img, gamma=self.gamma)
             
             # Store samples
             X[i,] = img
@@ -340,26 +349,12 @@ class DataGenerator(keras.utils.Sequence):
         # nImg = nImg.astype(np.float32) / 255.
         return  img.astype(np.float32) / 255.
     
-    def __random_transform(self, img, masks):
-        composition = albu.Compose([
-            albu.HorizontalFlip(),
-            albu.VerticalFlip(),
-            albu.ShiftScaleRotate(rotate_limit=30, shift_limit=0.1)
-        ])
-        
-        composed = composition(image=img, mask=masks)
-        aug_img = composed['image']
-        aug_masks = composed['mask']
-        
-        return aug_img, aug_masks
-    
     def __augment_batch(self, img_batch, masks_batch):
-        for i in range(img_batch.shape[0]):
-            img_batch[i, ], masks_batch[i, ] = self.__random_transform(
-                img_batch[i, ], masks_batch[i, ])
-        
-        return img_batch, masks_batch
+        # Parameters are drawn for the whole batch, see mymrcnn.augmentation
+        return self.augmenter(img_batch, masks_batch)
 BATCH_SIZE = 24
+# One decode per source image for all the generators below
+IMAGE_PYRAMID = imagepyramid.get_pyramid("D:/MyWork/train_images")
 
 train_idx, val_idx = train_test_split(
     mask_count_df.index, random_state=2019, test_size=0.1
@@ -375,7 +370,8 @@ train_generator = DataGenerator(
     # gamma = None,
     augment=True,
     n_channels=3,
-    n_classes=4
+    n_classes=4,
+    pyramid=IMAGE_PYRAMID
 )
 
 val_generator = DataGenerator(
@@ -388,7 +384,8 @@ val_generator = DataGenerator(
     # gamma = None,
     augment=False,
     n_channels=3,
-    n_classes=4
+    n_classes=4,
+    pyramid=IMAGE_PYRAMID
 )
 model = sm.Unet(
     'resnet34', 
@@ -555,7 +552,8 @@ val_final_generator = DataGenerator(
     # gamma = None,
     augment=False,
     n_channels=3,
-    n_classes=4
+    n_classes=4,
+    pyramid=IMAGE_PYRAMID
 )
 batch_pred_masks = model.predict_generator(
         val_final_generator, 
@@ -10,6 +10,7 @@ from collections import UserDict
 from collections import deque
 from sklearn.model_selection import train_test_split
 from mrcnn import utils
+import mymrcnn.pyramid as imagepyramid
 basePath = "D:/MyWork/"
 csv_data = pd.read_csv(basePath + "/train.csv",converters={'EncodedPixels': str})     
 
@@ -214,7 +215,7 @@ def deleteAbnormalMask():
         filePath = str(item)
         img_mask_data = cv2.imread(filePath)
         img_mask_data = img_mask_data[:,:,[0]]
-        bbox = utils.extract_bboxes(img_mask_data.astype(np.uint8))
+        bbox = utils.extract_bboxes(img_mask_data)
         y1,x1,y2,x2 = bbox[0][0],bbox[0][1],bbox[0][2],bbox[0][3]
         width = x2 - x1
         height = y2 - y1
@@ -267,7 +268,7 @@ def combineSameBBoxMask():
         img_id,img_class,class_instance = item.name.split("_")
         img_mask_data = cv2.imread(filePath)
         img_mask_data = img_mask_data[:,:,[0]]
-        cur_bbox = utils.extract_bboxes(img_mask_data.astype(np.uint8))[0]
+        cur_bbox = utils.extract_bboxes(img_mask_data)[0]
         y1,x1,y2,x2 = cur_bbox[0],cur_bbox[1],cur_bbox[2],cur_bbox[3]
         cur_area = (x2 - x1) * (y2 - y1)
         if img_id not in maskdicts.keys():
@@ -314,7 +315,7 @@ def createClipedImage():
         img_file_name = filePath.split(os.sep)[-1]
         img_mask_data = cv2.imread(filePath)
         img_mask_data = img_mask_data[:,:,[0]]
-        bbox = utils.extract_bboxes(img_mask_data.astype(np.uint8))[0]
+        bbox = utils.extract_bboxes(img_mask_data)[0]
         scaleX,scaleY = 2100 / 576,1400 / 384
         y1, x1, y2, x2 = int(bbox[0] * scaleY),int(bbox[1] * scaleX),int(bbox[2] * scaleY),int(bbox[3]* scaleX)
         width = x2 - x1
@@ -323,7 +324,8 @@ def createClipedImage():
             continue
         if width < 25 or height < 18:
             continue
-        img = cv2.imread(basePath + "train_images/" + img_id + ".jpg")
+        # Images with several masks are decoded once
+        img = imagepyramid.get_pyramid(basePath + "train_images").get(img_id)
         clippedImg = img[y1:y2, x1:x2,:]
         if width < height:
             clippedImg = np.transpose(clippedImg,axes=(1,0,2))
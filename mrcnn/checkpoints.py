@@ -0,0 +1,579 @@
+"""
+Checkpoint loading and discovery.
+
+Keras' load_weights opens the h5 file and walks every layer group to match
+names each time it is called. load_weights() here does that walk once per
+checkpoint and caches the result next to it:
+
+    <checkpoint>.h5.layers.json   layer name -> weight dataset paths
+
+The cache is keyed by file size and mtime, so a rewritten checkpoint is
+walked again. The weighted layers of a model are also looked up once per
+model. Loading then only reads the datasets of the layers being set, and
+assigns them all in one batch_set_value call. This makes loading several
+checkpoints into one built graph cheap, see iter_checkpoints().
+
+CheckpointIndex keeps the checkpoints of a model directory in
+<model_dir>/checkpoints.json, so find_last() doesn't list and sort the log
+folders on every start. It records the modification time of each run
+folder, and scans them again when a folder was added or changed since,
+e.g. by a script that doesn't use the index or by copying checkpoints by
+hand.
+
+Training saves with AsyncCheckpoint. At the end of an epoch it copies the
+weights to memory and returns. CheckpointWriter then writes the h5 file on
+a background thread and adds it to the index with the epoch metrics. It
+applies the retention policy of the run: the last keep_last checkpoints
+plus the keep_best best ones by a metric are kept, the rest are deleted.
+"""
+
+import os
+import json
+import errno
+import queue
+import weakref
+import threading
+import numpy as np
+import keras
+import keras.backend as K
+
+# Checkpoint files start with this, see set_log_dir()
+CHECKPOINT_PREFIX = "mask_rcnn"
+INDEX_NAME = "checkpoints.json"
+LAYER_MAP_SUFFIX = ".layers.json"
+
+
+def _write_json(path, data):
+    # Write then rename, so readers never see half a file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def _decode(value):
+    return value.decode("utf8") if hasattr(value, "decode") else value
+
+
+def _read_names(group, name):
+    """A list attribute, also when Keras split it over name0, name1, ...
+    because it is too large for one HDF5 attribute.
+    """
+    if name in group.attrs:
+        return [_decode(n) for n in group.attrs[name]]
+    names = []
+    chunk = 0
+    while "{}{}".format(name, chunk) in group.attrs:
+        names.extend(_decode(n) for n in group.attrs["{}{}".format(name, chunk)])
+        chunk += 1
+    return names
+
+
+def _saving():
+    # Keras before 2.2 used the 'topology' namespace.
+    try:
+        from keras.engine import saving
+    except ImportError:
+        from keras.engine import topology as saving
+    return saving
+
+
+############################################################
+#  Layer maps
+############################################################
+
+def _file_stamp(filepath):
+    stat = os.stat(filepath)
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def _walk(filepath):
+    """Reads the layer -> dataset layout of a Keras weights file."""
+    import h5py
+    with h5py.File(filepath, mode="r") as f:
+        root = ""
+        group = f
+        if not _read_names(f, "layer_names") and "model_weights" in f:
+            root = "model_weights"
+            group = f["model_weights"]
+        layers = []
+        for name in _read_names(group, "layer_names"):
+            weight_names = _read_names(group[name], "weight_names")
+            layers.append([name,
+                           [name + "/" + w for w in weight_names],
+                           [list(group[name][w].shape) for w in weight_names]])
+        return {
+            "stamp": _file_stamp(filepath),
+            "root": root,
+            "keras_version": _decode(group.attrs.get("keras_version", "1")),
+            "backend": _decode(group.attrs.get("backend", None)),
+            "layers": layers,
+        }
+
+
+def layer_map(filepath):
+    """The layer layout of a checkpoint, from its cache file if that is
+    still current.
+
+    Returns dict with root (group of the weights in the file),
+    keras_version, backend and layers, a list of
+    [layer name, [dataset paths], [dataset shapes]] in file order.
+    """
+    cache_path = filepath + LAYER_MAP_SUFFIX
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if cached.get("stamp") == _file_stamp(filepath):
+                return cached
+        except ValueError:
+            pass
+    layers = _walk(filepath)
+    try:
+        _write_json(cache_path, layers)
+    except (IOError, OSError):
+        # Read only checkpoint folders still load, just without the cache
+        pass
+    return layers
+
+
+# Keras model -> its layers with weights, in order
+_MODEL_LAYERS = weakref.WeakKeyDictionary()
+
+
+def model_layers(keras_model):
+    """The layers of a model that have weights, in order.
+    In multi-GPU training, we wrap the model. The layers of the inner model
+    are returned because they have the weights.
+    """
+    keras_model = getattr(keras_model, "inner_model", keras_model)
+    if keras_model not in _MODEL_LAYERS:
+        _MODEL_LAYERS[keras_model] = [l for l in keras_model.layers if l.weights]
+    return _MODEL_LAYERS[keras_model]
+
+
+def _pairs(layers, mapping, by_name, exclude):
+    """Matches model layers to checkpoint layers."""
+    if by_name:
+        lookup = {l.name: l for l in layers}
+        return [(lookup[name], paths) for name, paths, _ in mapping["layers"]
+                if name in lookup and name not in exclude]
+    stored = [(name, paths) for name, paths, _ in mapping["layers"] if paths]
+    if len(stored) != len(layers):
+        raise ValueError("You are trying to load a weight file containing {} layers "
+                         "into a model with {} layers.".format(len(stored), len(layers)))
+    return [(layer, paths) for layer, (_, paths) in zip(layers, stored)]
+
+
+def load_weights(keras_model, filepath, by_name=False, exclude=None):
+    """Loads a checkpoint into a model, like Keras' load_weights.
+
+    keras_model: The model to set. A multi-GPU wrapper is accepted.
+    by_name: Match layers by name, otherwise by order.
+    exclude: list of layer names to exclude. Implies by_name.
+    """
+    import h5py
+    exclude = set(exclude or [])
+    if exclude:
+        by_name = True
+    mapping = layer_map(filepath)
+    pairs = _pairs(model_layers(keras_model), mapping, by_name, exclude)
+    saving = _saving()
+    weight_values = []
+    with h5py.File(filepath, mode="r") as f:
+        group = f[mapping["root"]] if mapping["root"] else f
+        for layer, paths in pairs:
+            values = [np.asarray(group[p]) for p in paths]
+            values = saving.preprocess_weights_for_loading(
+                layer, values, mapping["keras_version"], mapping["backend"])
+            if len(values) != len(layer.weights):
+                raise ValueError("Layer {} expects {} weights, but the saved weights "
+                                 "have {} elements.".format(layer.name, len(layer.weights),
+                                                            len(values)))
+            for weight, value in zip(layer.weights, values):
+                if K.int_shape(weight) != value.shape:
+                    raise ValueError("Layer {} weight {} has shape {}, the saved weight "
+                                     "has shape {}.".format(layer.name, weight.name,
+                                                            K.int_shape(weight), value.shape))
+                weight_values.append((weight, value))
+    K.batch_set_value(weight_values)
+
+
+def iter_checkpoints(keras_model, filepaths, by_name=False, exclude=None):
+    """Loads the checkpoints one after the other into the same model,
+    yielding each path once its weights are set. The graph is built once,
+    so comparing many checkpoints only costs the weight reads:
+
+        for path in iter_checkpoints(model.keras_model, paths, by_name=True):
+            scores[path] = evaluate(model)
+    """
+    for filepath in filepaths:
+        load_weights(keras_model, filepath, by_name=by_name, exclude=exclude)
+        yield filepath
+
+
+############################################################
+#  Checkpoint index
+############################################################
+
+class CheckpointIndex(object):
+    """The checkpoints of a model directory, kept in <model_dir>/checkpoints.json.
+
+    The index maps each run directory (one per training run, named
+    <config name><timestamp>) to its sorted checkpoint file names, and
+    keeps the metrics and sampler state each checkpoint was saved with. It is built by
+    scanning the model directory when it doesn't exist yet, or when the run
+    directories don't match the modification times it was saved with.
+    """
+
+    def __init__(self, model_dir):
+        self.model_dir = model_dir
+        self.path = os.path.join(model_dir, INDEX_NAME)
+        self._runs = None
+        self._metrics = {}
+        self._samplers = {}
+
+    @property
+    def runs(self):
+        if self._runs is None:
+            stamps = self._load()
+            if self._runs is None or stamps != self._stamps():
+                self.rebuild()
+        return self._runs
+
+    def _load(self):
+        """Reads the index file if there is one. Returns the run directory
+        modification times it was saved with.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            index = json.load(f)
+        self._runs = index["runs"]
+        self._metrics = index.get("metrics", {})
+        self._samplers = index.get("samplers", {})
+        return index.get("stamps")
+
+    def _stamps(self):
+        """Modification time of each run directory. Adding or deleting a
+        checkpoint changes the time of its run.
+        """
+        if not os.path.isdir(self.model_dir):
+            return {}
+        return {entry.name: entry.stat().st_mtime
+                for entry in os.scandir(self.model_dir) if entry.is_dir()}
+
+    def rebuild(self):
+        """Scans the model directory and rewrites the index. Metrics and
+        sampler states of checkpoints that still exist are kept.
+        """
+        if self._runs is None:
+            self._load()
+        self._runs = {}
+        if os.path.isdir(self.model_dir):
+            for dir_name in next(os.walk(self.model_dir))[1]:
+                files = next(os.walk(os.path.join(self.model_dir, dir_name)))[2]
+                self._runs[dir_name] = sorted(
+                    f for f in files if f.startswith(CHECKPOINT_PREFIX) and f.endswith(".h5"))
+            self._metrics = self._existing(self._metrics)
+            self._samplers = self._existing(self._samplers)
+            self.save()
+        return self
+
+    def _existing(self, by_checkpoint):
+        return {key: value for key, value in by_checkpoint.items()
+                if key.split("/")[-1] in self._runs.get(key.split("/")[0], [])}
+
+    def save(self):
+        _write_json(self.path, {"runs": self._runs, "metrics": self._metrics,
+                                "samplers": self._samplers, "stamps": self._stamps()})
+
+    @staticmethod
+    def _key(filepath):
+        return os.path.basename(os.path.dirname(filepath)), os.path.basename(filepath)
+
+    def add(self, filepath, metrics=None, sampler=None):
+        """Records a checkpoint written under the model directory.
+        metrics: Optional. dict of the epoch logs, e.g. {"val_loss": 0.3}.
+        sampler: Optional. State of the training sampler, see samplers.
+        """
+        run, name = self._key(filepath)
+        checkpoints = self.runs.setdefault(run, [])
+        if name not in checkpoints:
+            checkpoints.append(name)
+            checkpoints.sort()
+        if metrics:
+            self._metrics[run + "/" + name] = {k: float(v) for k, v in metrics.items()}
+        if sampler:
+            self._samplers[run + "/" + name] = sampler
+        self.save()
+
+    def remove(self, filepath):
+        """Drops a checkpoint from the index. The file is left alone."""
+        run, name = self._key(filepath)
+        if name in self.runs.get(run, []):
+            self.runs[run].remove(name)
+            self._metrics.pop(run + "/" + name, None)
+            self._samplers.pop(run + "/" + name, None)
+            self.save()
+
+    def metrics(self, filepath):
+        """The metrics a checkpoint was recorded with, {} if none."""
+        run, name = self._key(filepath)
+        self.runs
+        return self._metrics.get(run + "/" + name, {})
+
+    def sampler(self, filepath):
+        """The sampler state a checkpoint was recorded with, {} if none."""
+        run, name = self._key(filepath)
+        self.runs
+        return self._samplers.get(run + "/" + name, {})
+
+    def checkpoints(self, key, run=None):
+        """Paths of the checkpoints of one run, oldest first.
+        key: Lower case config name the run directories start with.
+        run: Run directory name. The last run by default.
+        """
+        if run is None:
+            runs = sorted(r for r in self.runs if r.startswith(key))
+            if not runs:
+                raise FileNotFoundError(
+                    errno.ENOENT,
+                    "Could not find model directory under {}".format(self.model_dir))
+            run = runs[-1]
+        return [os.path.join(self.model_dir, run, name) for name in self.runs.get(run, [])]
+
+    def last(self, key):
+        """Path of the last checkpoint of the last run of a model, like
+        find_last(). The index is rebuilt once if it points at a missing file.
+        """
+        for attempt in range(2):
+            checkpoints = self.checkpoints(key)
+            if checkpoints and os.path.exists(checkpoints[-1]):
+                return checkpoints[-1]
+            if attempt == 0:
+                self.rebuild()
+        raise FileNotFoundError(
+            errno.ENOENT, "Could not find weight files in {}".format(
+                os.path.dirname(checkpoints[-1]) if checkpoints else self.model_dir))
+
+
+class IndexCheckpoints(keras.callbacks.Callback):
+    """Adds the checkpoint of each epoch to the CheckpointIndex. Goes after
+    the ModelCheckpoint callback writing checkpoint_path.
+    """
+
+    def __init__(self, model_dir, checkpoint_path):
+        super(IndexCheckpoints, self).__init__()
+        self.index = CheckpointIndex(model_dir)
+        self.checkpoint_path = checkpoint_path
+
+    def on_epoch_end(self, epoch, logs=None):
+        filepath = self.checkpoint_path.format(epoch=epoch + 1, **(logs or {}))
+        if os.path.exists(filepath):
+            self.index.add(filepath)
+
+
+############################################################
+#  Asynchronous saving with retention
+############################################################
+
+def _snapshot(keras_model):
+    """Copies the weights of a model to memory, with the names needed to
+    write them in the Keras h5 layout.
+    Returns a list of (layer name, [weight names], [values]).
+    """
+    keras_model = getattr(keras_model, "inner_model", keras_model)
+    layers = keras_model.layers
+    values = K.batch_get_value([w for l in layers for w in l.weights])
+    snapshot = []
+    start = 0
+    for layer in layers:
+        count = len(layer.weights)
+        names = [str(w.name) if getattr(w, "name", None) else "param_" + str(i)
+                 for i, w in enumerate(layer.weights)]
+        snapshot.append((layer.name, names, values[start:start + count]))
+        start += count
+    return snapshot
+
+
+def _write_weights(filepath, snapshot):
+    """Writes a snapshot like keras Model.save_weights(), through a
+    temporary file so a crash never leaves half a checkpoint.
+    """
+    import h5py
+    saving = _saving()
+    tmp_path = filepath + ".tmp"
+    with h5py.File(tmp_path, mode="w") as f:
+        layer_names = [name.encode("utf8") for name, _, _ in snapshot]
+        if hasattr(saving, "save_attributes_to_hdf5_group"):
+            saving.save_attributes_to_hdf5_group(f, "layer_names", layer_names)
+        else:
+            f.attrs["layer_names"] = layer_names
+        f.attrs["backend"] = K.backend().encode("utf8")
+        f.attrs["keras_version"] = str(keras.__version__).encode("utf8")
+        for layer_name, weight_names, values in snapshot:
+            group = f.create_group(layer_name)
+            names = [n.encode("utf8") for n in weight_names]
+            if hasattr(saving, "save_attributes_to_hdf5_group"):
+                saving.save_attributes_to_hdf5_group(group, "weight_names", names)
+            else:
+                group.attrs["weight_names"] = names
+            for name, value in zip(weight_names, values):
+                dataset = group.create_dataset(name, value.shape, dtype=value.dtype)
+                if not value.shape:
+                    dataset[()] = value
+                else:
+                    dataset[:] = value
+    os.replace(tmp_path, filepath)
+
+
+class CheckpointWriter(object):
+    """Writes weight snapshots on a background thread and prunes the run.
+
+    model_dir: The model directory holding the checkpoint index.
+    keep_last: Number of most recent checkpoints of the run to keep. None
+        keeps them all.
+    keep_best: Number of best checkpoints by `monitor` to keep as well.
+    monitor: Metric the best checkpoints are ranked by.
+    mode: "min" or "max", whether lower or higher monitor values are better.
+    max_pending: Snapshots waiting to be written before save() blocks. Each
+        holds a full copy of the weights.
+    """
+
+    def __init__(self, model_dir, keep_last=None, keep_best=0, monitor="val_loss",
+                 mode="min", max_pending=1):
+        assert keep_last is None or keep_last >= 1, "keep_last must keep at least one"
+        assert mode in ("min", "max")
+        self.index = CheckpointIndex(model_dir)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.monitor = monitor
+        self.mode = mode
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name="CheckpointWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, keras_model, filepath, metrics=None, sampler=None):
+        """Snapshots the weights now and queues them for writing, to be
+        indexed with the metrics and sampler state.
+        """
+        self._raise()
+        self._queue.put((filepath, _snapshot(keras_model), dict(metrics or {}), sampler))
+
+    def flush(self):
+        """Waits until everything queued is on disk."""
+        self._queue.join()
+        self._raise()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                filepath, snapshot, metrics, sampler = item
+                _write_weights(filepath, snapshot)
+                self.index.add(filepath, metrics, sampler)
+                self.prune(os.path.dirname(filepath))
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def retained(self, run_dir):
+        """Checkpoint paths of a run the policy keeps."""
+        run = os.path.basename(run_dir)
+        paths = [os.path.join(run_dir, name) for name in self.index.runs.get(run, [])]
+        if self.keep_last is None:
+            return set(paths)
+        keep = set(paths[-self.keep_last:])
+        if self.keep_best:
+            scored = [p for p in paths if self.monitor in self.index.metrics(p)]
+            scored.sort(key=lambda p: self.index.metrics(p)[self.monitor],
+                        reverse=self.mode == "max")
+            keep.update(scored[:self.keep_best])
+        return keep
+
+    def prune(self, run_dir):
+        """Deletes the checkpoints of a run the policy doesn't keep."""
+        run = os.path.basename(run_dir)
+        keep = self.retained(run_dir)
+        for name in list(self.index.runs.get(run, [])):
+            path = os.path.join(run_dir, name)
+            if path in keep:
+                continue
+            for stale in (path, path + LAYER_MAP_SUFFIX):
+                if os.path.exists(stale):
+                    os.remove(stale)
+            # After the files, so the index saves the run's new time
+            self.index.remove(path)
+
+
+class AsyncCheckpoint(keras.callbacks.Callback):
+    """Saves a checkpoint at the end of each epoch without waiting for the
+    disk, in place of ModelCheckpoint(save_weights_only=True). The files are
+    added to the checkpoint index and pruned by the CheckpointWriter policy.
+
+    checkpoint_path: Path template with an {epoch} field, as for
+        ModelCheckpoint.
+    sampler: Optional. The samplers.Sampler of the training generator. Its
+        state after each epoch is recorded with the checkpoint.
+    samples_per_epoch: Samples the sampler gives per epoch.
+    writer_args: CheckpointWriter arguments.
+    """
+
+    def __init__(self, model_dir, checkpoint_path, sampler=None, samples_per_epoch=None,
+                 **writer_args):
+        super(AsyncCheckpoint, self).__init__()
+        self.model_dir = model_dir
+        self.checkpoint_path = checkpoint_path
+        self.sampler = sampler
+        self.samples_per_epoch = samples_per_epoch
+        self.writer_args = writer_args
+        self.writer = None
+
+    def on_train_begin(self, logs=None):
+        if self.writer is None:
+            self.writer = CheckpointWriter(self.model_dir, **self.writer_args)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        filepath = self.checkpoint_path.format(epoch=epoch + 1, **logs)
+        metrics = {k: v for k, v in logs.items() if np.isscalar(v)}
+        sampler = None
+        if self.sampler is not None:
+            sampler = self.sampler.state(samples=(epoch + 1) * self.samples_per_epoch)
+        self.writer.save(self.model, filepath, metrics, sampler)
+
+    def on_train_end(self, logs=None):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def checkpoint_callback(model_dir, checkpoint_path, config, sampler=None):
+    """The AsyncCheckpoint of a training run, with the retention policy of
+    config.CHECKPOINT_KEEP_LAST, CHECKPOINT_KEEP_BEST, CHECKPOINT_MONITOR
+    and CHECKPOINT_MODE.
+    sampler: Optional. The sampler of the training generator, drawing
+        STEPS_PER_EPOCH * BATCH_SIZE samples per epoch.
+    """
+    return AsyncCheckpoint(model_dir, checkpoint_path, sampler=sampler,
+                           samples_per_epoch=config.STEPS_PER_EPOCH * config.BATCH_SIZE,
+                           keep_last=config.CHECKPOINT_KEEP_LAST,
+                           keep_best=config.CHECKPOINT_KEEP_BEST,
+                           monitor=config.CHECKPOINT_MONITOR,
+                           mode=config.CHECKPOINT_MODE)
@@ -33,6 +33,42 @@ class Config(object):
     # number that your GPU can handle for best performance.
     IMAGES_PER_GPU = 2
 
+    # How the per-image graphs (proposal NMS, detection targets, detection
+    # refinement) run over a batch.
+    # slice: Unroll one copy of each graph per image. The graph grows
+    #        linearly with IMAGES_PER_GPU.
+    # map:   Build each graph once and run it with tf.map_fn. The steps that
+    #        are elementwise per image run on the whole batch at once.
+    # The batchgraph check of mymrcnn_benchmark.py asserts both give the same
+    # outputs.
+    BATCH_GRAPH_MODE = "slice"
+
+    # Number of local worker processes for CPU data parallel training, see
+    # cpu_parallel. Each trains on its own BATCH_SIZE batch, so a step covers
+    # CPU_WORKERS * BATCH_SIZE images. 0 or 1 trains in this process.
+    CPU_WORKERS = 0
+
+    # RAM budget in GB of the planner's batch recommendation, see planner and
+    # display(). None uses the memory of the machine.
+    PLANNER_RAM_GB = None
+
+    # Graph build cache, see buildcache. Built graphs are stored by a hash of
+    # the config, the mode and the model code, and later constructions load
+    # them instead of running the graph code. Off by default. None is
+    # ~/.mymrcnn/graphs.
+    BUILD_CACHE = False
+    BUILD_CACHE_DIR = None
+
+    # Checkpoint retention, see checkpoints.CheckpointWriter. A run keeps its
+    # last CHECKPOINT_KEEP_LAST checkpoints plus the CHECKPOINT_KEEP_BEST best
+    # ones by the CHECKPOINT_MONITOR epoch metric ("min" or "max" is better
+    # by CHECKPOINT_MODE). None keeps every checkpoint, the default since
+    # scripts load specific epochs. Runs opt in to pruning, e.g. 3 and 2.
+    CHECKPOINT_KEEP_LAST = None
+    CHECKPOINT_KEEP_BEST = 0
+    CHECKPOINT_MONITOR = "val_loss"
+    CHECKPOINT_MODE = "min"
+
     # Number of training steps per epoch
     # This doesn't need to match the size of the training set. Tensorboard
     # updates are saved at the end of each epoch, so setting this to a
@@ -227,10 +263,25 @@ class Config(object):
         # See compose_image_meta() for details
         self.IMAGE_META_SIZE = 1 + 3 + 3 + 4 + 1 + self.NUM_CLASSES
 
-    def display(self):
-        """Display Configuration values."""
+    def display(self, model=None, ram_gb=None):
+        """Display Configuration values.
+
+        model: Optional. A built model (or its keras_model) to also show the
+            memory and FLOPs plan of, see planner.
+        ram_gb: RAM budget of the batch recommendation. Defaults to
+            PLANNER_RAM_GB, then to the machine's memory.
+        """
         print("\nConfigurations:")
         for a in dir(self):
             if not a.startswith("__") and not callable(getattr(self, a)):
                 print("{:30} {}".format(a, getattr(self, a)))
         print("\n")
+        if model is not None:
+            from mrcnn import planner
+            ram_gb = ram_gb or self.PLANNER_RAM_GB or planner.physical_memory_gb()
+            # MaskRCNN.compile() doesn't accumulate gradients, so the
+            # planner only recommends a batch size that fits
+            print(planner.plan(model, self).format(
+                self.BATCH_SIZE, ram_gb, getattr(self, "EFFECTIVE_BATCH_SIZE", self.BATCH_SIZE),
+                accumulation=False))
+            print("\n")
@@ -8,6 +8,7 @@ Written by Waleed Abdulla
 """
 
 import os
+import sys
 import random
 import datetime
 import re
@@ -24,6 +25,9 @@ import keras.engine as KE
 import keras.models as KM
 
 from mrcnn import utils
+from mrcnn import buildcache
+from mrcnn import checkpoints
+from mrcnn import cpu_parallel
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -212,43 +216,43 @@ def resnet_graph(input_image, architecture, stage5=False, train_bn=True):
 
 def apply_box_deltas_graph(boxes, deltas):
     """Applies the given deltas to the given boxes.
-    boxes: [N, (y1, x1, y2, x2)] boxes to update
-    deltas: [N, (dy, dx, log(dh), log(dw))] refinements to apply
+    boxes: [..., N, (y1, x1, y2, x2)] boxes to update
+    deltas: [..., N, (dy, dx, log(dh), log(dw))] refinements to apply
     """
     # Convert to y, x, h, w
-    height = boxes[:, 2] - boxes[:, 0]
-    width = boxes[:, 3] - boxes[:, 1]
-    center_y = boxes[:, 0] + 0.5 * height
-    center_x = boxes[:, 1] + 0.5 * width
+    height = boxes[..., 2] - boxes[..., 0]
+    width = boxes[..., 3] - boxes[..., 1]
+    center_y = boxes[..., 0] + 0.5 * height
+    center_x = boxes[..., 1] + 0.5 * width
     # Apply deltas
-    center_y += deltas[:, 0] * height
-    center_x += deltas[:, 1] * width
-    height *= tf.exp(deltas[:, 2])
-    width *= tf.exp(deltas[:, 3])
+    center_y += deltas[..., 0] * height
+    center_x += deltas[..., 1] * width
+    height *= tf.exp(deltas[..., 2])
+    width *= tf.exp(deltas[..., 3])
     # Convert back to y1, x1, y2, x2
     y1 = center_y - 0.5 * height
     x1 = center_x - 0.5 * width
     y2 = y1 + height
     x2 = x1 + width
-    result = tf.stack([y1, x1, y2, x2], axis=1, name="apply_box_deltas_out")
+    result = tf.stack([y1, x1, y2, x2], axis=-1, name="apply_box_deltas_out")
     return result
 
 
 def clip_boxes_graph(boxes, window):
     """
-    boxes: [N, (y1, x1, y2, x2)]
+    boxes: [..., N, (y1, x1, y2, x2)]
     window: [4] in the form y1, x1, y2, x2
     """
     # Split
     wy1, wx1, wy2, wx2 = tf.split(window, 4)
-    y1, x1, y2, x2 = tf.split(boxes, 4, axis=1)
+    y1, x1, y2, x2 = tf.split(boxes, 4, axis=-1)
     # Clip
     y1 = tf.maximum(tf.minimum(y1, wy2), wy1)
     x1 = tf.maximum(tf.minimum(x1, wx2), wx1)
     y2 = tf.maximum(tf.minimum(y2, wy2), wy1)
     x2 = tf.maximum(tf.minimum(x2, wx2), wx1)
-    clipped = tf.concat([y1, x1, y2, x2], axis=1, name="clipped_boxes")
-    clipped.set_shape((clipped.shape[0], 4))
+    clipped = tf.concat([y1, x1, y2, x2], axis=-1, name="clipped_boxes")
+    clipped.set_shape(clipped.shape[:-1].concatenate([4]))
     return clipped
 
 
@@ -273,6 +277,12 @@ class ProposalLayer(KE.Layer):
         self.proposal_count = proposal_count
         self.nms_threshold = nms_threshold
 
+    def get_config(self):
+        config = super(ProposalLayer, self).get_config()
+        config["proposal_count"] = self.proposal_count
+        config["nms_threshold"] = self.nms_threshold
+        return config
+
     def call(self, inputs):
         # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
         scores = inputs[0][:, :, 1]
@@ -287,28 +297,39 @@ class ProposalLayer(KE.Layer):
         pre_nms_limit = tf.minimum(self.config.PRE_NMS_LIMIT, tf.shape(anchors)[1])
         ix = tf.nn.top_k(scores, pre_nms_limit, sorted=True,
                          name="top_anchors").indices
-        scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
-                                   self.config.IMAGES_PER_GPU)
-        pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
-                                    self.config.IMAGES_PER_GPU,
-                                    names=["pre_nms_anchors"])
-
-        # Apply deltas to anchors to get refined anchors.
-        # [batch, N, (y1, x1, y2, x2)]
-        boxes = utils.batch_slice([pre_nms_anchors, deltas],
-                                  lambda x, y: apply_box_deltas_graph(x, y),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors"])
-
-        # Clip to image boundaries. Since we're in normalized coordinates,
-        # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
         window = np.array([0, 0, 1, 1], dtype=np.float32)
-        boxes = utils.batch_slice(boxes,
-                                  lambda x: clip_boxes_graph(x, window),
-                                  self.config.IMAGES_PER_GPU,
-                                  names=["refined_anchors_clipped"])
+        if self.config.BATCH_GRAPH_MODE == "map":
+            # Gathers, deltas and clipping are elementwise per image, so run
+            # them on the whole batch at once.
+            scores = utils.batch_gather(scores, ix)
+            deltas = utils.batch_gather(deltas, ix)
+            pre_nms_anchors = utils.batch_gather(anchors, ix, name="pre_nms_anchors")
+            boxes = tf.identity(apply_box_deltas_graph(pre_nms_anchors, deltas),
+                                name="refined_anchors")
+            boxes = tf.identity(clip_boxes_graph(boxes, window),
+                                name="refined_anchors_clipped")
+        else:
+            scores = utils.batch_slice([scores, ix], lambda x, y: tf.gather(x, y),
+                                       self.config.IMAGES_PER_GPU)
+            deltas = utils.batch_slice([deltas, ix], lambda x, y: tf.gather(x, y),
+                                       self.config.IMAGES_PER_GPU)
+            pre_nms_anchors = utils.batch_slice([anchors, ix], lambda a, x: tf.gather(a, x),
+                                        self.config.IMAGES_PER_GPU,
+                                        names=["pre_nms_anchors"])
+
+            # Apply deltas to anchors to get refined anchors.
+            # [batch, N, (y1, x1, y2, x2)]
+            boxes = utils.batch_slice([pre_nms_anchors, deltas],
+                                      lambda x, y: apply_box_deltas_graph(x, y),
+                                      self.config.IMAGES_PER_GPU,
+                                      names=["refined_anchors"])
+
+            # Clip to image boundaries. Since we're in normalized coordinates,
+            # clip to 0..1 range. [batch, N, (y1, x1, y2, x2)]
+            boxes = utils.batch_slice(boxes,
+                                      lambda x: clip_boxes_graph(x, window),
+                                      self.config.IMAGES_PER_GPU,
+                                      names=["refined_anchors_clipped"])
 
         # Filter out small boxes
         # According to Xinlei Chen's paper, this reduces detection accuracy
@@ -324,8 +345,9 @@ class ProposalLayer(KE.Layer):
             padding = tf.maximum(self.proposal_count - tf.shape(proposals)[0], 0)
             proposals = tf.pad(proposals, [(0, padding), (0, 0)])
             return proposals
-        proposals = utils.batch_slice([boxes, scores], nms,
-                                      self.config.IMAGES_PER_GPU)
+        proposals = utils.batch_apply([boxes, scores], nms,
+                                      self.config.IMAGES_PER_GPU, tf.float32,
+                                      mode=self.config.BATCH_GRAPH_MODE)
         return proposals
 
     def compute_output_shape(self, input_shape):
@@ -365,6 +387,11 @@ class PyramidROIAlign(KE.Layer):
         super(PyramidROIAlign, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
 
+    def get_config(self):
+        config = super(PyramidROIAlign, self).get_config()
+        config["pool_shape"] = self.pool_shape
+        return config
+
     def call(self, inputs):
         # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coords
         boxes = inputs[0]
@@ -657,11 +684,13 @@ class DetectionTargetLayer(KE.Layer):
         # Slice the batch and run a graph for each slice
         # TODO: Rename target_bbox to target_deltas for clarity
         names = ["rois", "target_class_ids", "target_bbox", "target_mask"]
-        outputs = utils.batch_slice(
+        outputs = utils.batch_apply(
             [proposals, gt_class_ids, gt_boxes, gt_masks],
             lambda w, x, y, z: detection_targets_graph(
                 w, x, y, z, self.config),
-            self.config.IMAGES_PER_GPU, names=names)
+            self.config.IMAGES_PER_GPU,
+            [tf.float32, tf.int32, tf.float32, tf.float32],
+            names=names, mode=self.config.BATCH_GRAPH_MODE)
         return outputs
 
     def compute_output_shape(self, input_shape):
@@ -807,10 +836,11 @@ class DetectionLayer(KE.Layer):
         window = norm_boxes_graph(m['window'], image_shape[:2])
 
         # Run detection refinement graph on each item in the batch
-        detections_batch = utils.batch_slice(
+        detections_batch = utils.batch_apply(
             [rois, mrcnn_class, mrcnn_bbox, window],
             lambda x, y, w, z: refine_detections_graph(x, y, w, z, self.config),
-            self.config.IMAGES_PER_GPU)
+            self.config.IMAGES_PER_GPU, tf.float32,
+            mode=self.config.BATCH_GRAPH_MODE)
 
         # Reshape output
         # [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)] in
@@ -1211,13 +1241,9 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     image = dataset.load_image(image_id)
     mask, class_ids = dataset.load_mask(image_id)
     original_shape = image.shape
-    image, window, scale, padding, crop = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        min_scale=config.IMAGE_MIN_SCALE,
-        max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+    plan = utils.get_resize_plan(image.shape, config)
+    image, window, scale, padding, crop = plan.resize_image(image)
+    mask = plan.resize_mask(mask, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
@@ -1277,7 +1303,7 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
     # Resize masks to smaller size to reduce memory usage
     if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+        mask = utils.batch_minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Image meta data
     image_meta = compose_image_meta(image_id, original_shape, image.shape,
@@ -1834,7 +1860,8 @@ class MaskRCNN():
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
-        self.keras_model = self.build(mode=mode, config=config)
+        self.keras_model = buildcache.cached_build(
+            lambda: self.build(mode=mode, config=config), mode, config, [sys.modules[__name__]])
 
     def build(self, mode, config):
         """Build Mask R-CNN architecture.
@@ -2065,73 +2092,21 @@ class MaskRCNN():
 
     def find_last(self):
         """Finds the last checkpoint file of the last trained model in the
-        model directory.
+        model directory, from the checkpoint index of the directory.
         Returns:
             The path of the last checkpoint file
         """
-        # Get directory names. Each directory corresponds to a model
-        dir_names = next(os.walk(self.model_dir))[1]
-        key = self.config.NAME.lower()
-        dir_names = filter(lambda f: f.startswith(key), dir_names)
-        dir_names = sorted(dir_names)
-        if not dir_names:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT,
-                "Could not find model directory under {}".format(self.model_dir))
-        # Pick last directory
-        dir_name = os.path.join(self.model_dir, dir_names[-1])
-        # Find the last checkpoint
-        checkpoints = next(os.walk(dir_name))[2]
-        checkpoints = filter(lambda f: f.startswith("mask_rcnn"), checkpoints)
-        checkpoints = sorted(checkpoints)
-        if not checkpoints:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT, "Could not find weight files in {}".format(dir_name))
-        checkpoint = os.path.join(dir_name, checkpoints[-1])
-        return checkpoint
+        return checkpoints.CheckpointIndex(self.model_dir).last(self.config.NAME.lower())
 
     def load_weights(self, filepath, by_name=False, exclude=None):
         """Modified version of the corresponding Keras function with
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exclude: list of layer names to exclude
+        The layer layout of the file is cached next to it, see
+        checkpoints.load_weights().
         """
-        import h5py
-        # Conditional import to support versions of Keras before 2.2
-        # TODO: remove in about 6 months (end of 2018)
-        try:
-            from keras.engine import saving
-        except ImportError:
-            # Keras before 2.2 used the 'topology' namespace.
-            from keras.engine import topology as saving
-
-        if exclude:
-            by_name = True
-
-        if h5py is None:
-            raise ImportError('`load_weights` requires h5py.')
-        f = h5py.File(filepath, mode='r')
-        if 'layer_names' not in f.attrs and 'model_weights' in f:
-            f = f['model_weights']
-
-        # In multi-GPU training, we wrap the model. Get layers
-        # of the inner model because they have the weights.
-        keras_model = self.keras_model
-        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
-            else keras_model.layers
-
-        # Exclude some layers
-        if exclude:
-            layers = filter(lambda l: l.name not in exclude, layers)
-
-        if by_name:
-            saving.load_weights_from_hdf5_group_by_name(f, layers)
-        else:
-            saving.load_weights_from_hdf5_group(f, layers)
-        if hasattr(f, 'close'):
-            f.close()
+        checkpoints.load_weights(self.keras_model, filepath, by_name=by_name, exclude=exclude)
 
         # Update the log directory
         self.set_log_dir(filepath)
@@ -2323,6 +2298,15 @@ class MaskRCNN():
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
+        if self.config.CPU_WORKERS > 1:
+            # Data parallel over local worker processes, see cpu_parallel
+            cpu_parallel.train(self, data_generator, train_dataset, val_dataset,
+                               learning_rate, epochs, self.config.CPU_WORKERS,
+                               layers=layers,
+                               train_kwargs=dict(augmentation=augmentation,
+                                                 no_augmentation_sources=no_augmentation_sources))
+            return
+
         # Data generators
         train_generator = data_generator(train_dataset, self.config, shuffle=True,
                                          augmentation=augmentation,
@@ -2339,8 +2323,7 @@ class MaskRCNN():
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
                                         histogram_freq=0, write_graph=True, write_images=False),
-            keras.callbacks.ModelCheckpoint(self.checkpoint_path,
-                                            verbose=0, save_weights_only=True),
+            checkpoints.checkpoint_callback(self.model_dir, self.checkpoint_path, self.config),
         ]
 
         # Add custom callbacks to the list
@@ -2390,15 +2373,19 @@ class MaskRCNN():
         molded_images = []
         image_metas = []
         windows = []
-        for image in images:
+        # Same-shape batches are resized and padded in one pass
+        resized = None
+        if len(set(image.shape for image in images)) == 1 \
+                and self.config.IMAGE_RESIZE_MODE != "crop":
+            plan = utils.get_resize_plan(images[0].shape, self.config)
+            resized, _ = plan.apply(images)
+        for i, image in enumerate(images):
             # Resize image
-            # TODO: move resizing to mold_image()
-            molded_image, window, scale, padding, crop = utils.resize_image(
-                image,
-                min_dim=self.config.IMAGE_MIN_DIM,
-                min_scale=self.config.IMAGE_MIN_SCALE,
-                max_dim=self.config.IMAGE_MAX_DIM,
-                mode=self.config.IMAGE_RESIZE_MODE)
+            plan = utils.get_resize_plan(image.shape, self.config)
+            if resized is not None:
+                molded_image, window, scale = resized[i], plan.window, plan.scale
+            else:
+                molded_image, window, scale, padding, crop = plan.resize_image(image)
             molded_image = mold_image(molded_image, self.config)
             # Build image_meta
             image_meta = compose_image_meta(
@@ -2469,13 +2456,7 @@ class MaskRCNN():
             N = class_ids.shape[0]
 
         # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = utils.unmold_mask(masks[i], boxes[i], original_image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty(original_image_shape[:2] + (0,))
+        full_masks = utils.batch_unmold_mask(masks, boxes, original_image_shape)
 
         return boxes, class_ids, scores, full_masks
 
@@ -7,8 +7,81 @@ from pathlib import Path
 from collections import UserDict
 from collections import deque
 from mymrcnn import utils as utils
+from mymrcnn import pyramid
 def generateClassVec(row):
     return np.array(row[1:].values)
+class ImageRegistry():
+    """Per image class data of a factory, shared by reference between its
+    training and validation sets.
+    image_ids: string table of the image ids. Row i of the arrays below
+        belongs to image_ids[i].
+    presence: [num_images, num_classes] uint8 class presence matrix.
+    mask_names: string table of mask file names, grouped by image then class.
+    mask_offsets: [num_images * num_classes + 1] offsets into mask_names.
+        The masks of image row r and class c are
+        mask_names[mask_offsets[r * num_classes + c]:mask_offsets[r * num_classes + c + 1]].
+    Rows are added with add() and the tables are built by freeze(). Image ids
+    are looked up as strings.
+    """
+    __slots__ = ("classes", "image_ids", "presence", "mask_names", "mask_offsets",
+                 "_rows", "_pending")
+    def __init__(self, classes):
+        self.classes = list(classes)
+        self.image_ids = np.array([], dtype=str)
+        self.presence = np.zeros([0, len(self.classes)], dtype=np.uint8)
+        self.mask_names = np.array([], dtype=str)
+        self.mask_offsets = np.zeros([1], dtype=np.int32)
+        self._rows = {}
+        self._pending = None
+    def add(self, image_id, class_vec, masks=None):
+        """class_vec: class presence flags of the image.
+        masks: Optional. One list of mask file names per class.
+        """
+        if self._pending is None:
+            self._pending = ([], [], [], [])
+        ids, vecs, names, counts = self._pending
+        ids.append(image_id)
+        vecs.append(class_vec)
+        for clzIdx in range(len(self.classes)):
+            clzMasks = masks[clzIdx] if masks is not None else []
+            names.extend(clzMasks)
+            counts.append(len(clzMasks))
+    def freeze(self):
+        """Builds the tables from the rows added since the last freeze()."""
+        if self._pending is None:
+            return self
+        ids, vecs, names, counts = self._pending
+        self._pending = None
+        self.image_ids = np.concatenate([self.image_ids, np.array(ids, dtype=str)])
+        self.presence = np.concatenate(
+            [self.presence, np.array(vecs, dtype=np.uint8).reshape(-1, len(self.classes))])
+        self.mask_names = np.concatenate([self.mask_names, np.array(names, dtype=str)])
+        self.mask_offsets = np.concatenate(
+            [self.mask_offsets, self.mask_offsets[-1] + np.cumsum(counts, dtype=np.int32)])
+        self._rows = {image_id: row for row, image_id in enumerate(self.image_ids.tolist())}
+        return self
+    def row(self, image_id):
+        return self._rows[str(image_id)]
+    def masks(self, image_id, classIdx):
+        """Returns the mask file names of one class of an image."""
+        cell = self._rows[str(image_id)] * len(self.classes) + classIdx
+        return self.mask_names[self.mask_offsets[cell]:self.mask_offsets[cell + 1]].tolist()
+    def __getitem__(self, image_id):
+        """Returns the class presence vector of an image."""
+        return self.presence[self._rows[str(image_id)]]
+    def __contains__(self, image_id):
+        return str(image_id) in self._rows
+    def __len__(self):
+        return len(self.image_ids)
+    def __getstate__(self):
+        # The id to row map is rebuilt on unpickling, so only the arrays
+        # travel to generator worker processes.
+        self.freeze()
+        return (self.classes, self.image_ids, self.presence, self.mask_names, self.mask_offsets)
+    def __setstate__(self, state):
+        self.classes, self.image_ids, self.presence, self.mask_names, self.mask_offsets = state
+        self._pending = None
+        self._rows = {image_id: row for row, image_id in enumerate(self.image_ids.tolist())}
 class LimitedDict(UserDict):
     maxLen = sys.maxsize
     queue = deque([])
@@ -33,18 +106,38 @@ class LimitedDict(UserDict):
         return super().__getitem__(key)
 
 
+class CachedDataSet(utils.Dataset):
+    """Base of the data sets below. Pickles without the image caches, so
+    handing a data set to generator worker processes only copies the image
+    records and the shared ImageRegistry.
+    """
+    image_pyramid = None
+    def use_pyramid(self, source_dir):
+        """Reads the images through the shared ImagePyramid of the full
+        resolution images in source_dir, instead of the shrunk copies.
+        """
+        self.image_pyramid = pyramid.get_pyramid(source_dir)
+        return self
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("image_datas", "image_mask_data"):
+            if name in state:
+                state[name] = LimitedDict(maxLen=state[name].maxLen)
+        return state
+
+
 class ImageDataTrainningFactory():
     totalPath = ""
     trainPath = ""
     valPath = ""
     def __init__(self, workDir):
         self._image_ids = []
-        self.sub_image_info = {}
         self.WORK_DIR = workDir
         self.image_datas = LimitedDict(maxLen=200)
         self.image_mask_data = LimitedDict(maxLen=200)
         self.classes = ["Gravel","Sugar","Fish","Flower"]
         self.num_classes = len(self.classes)
+        self.sub_image_info = ImageRegistry(self.classes)
         self.image_meta = {"width":2100,"height":1400,"MASKWIDTH":2100,"MASKHEIGHT":1400}
     def initialize(self,totalPath,trainPath,valPath):
         self.totalPath = totalPath
@@ -63,7 +156,8 @@ class ImageDataTrainningFactory():
             csv_data = pd.read_excel(self.totalPath)
         for idx,row in csv_data.iterrows():
             self._image_ids += [row[0]]
-            self.sub_image_info[row[0]] = generateClassVec(row)
+            self.sub_image_info.add(row[0], generateClassVec(row))
+        self.sub_image_info.freeze()
     def getDataSet(self):
         # train_data = pd.read_excel(self.WORK_DIR + "/data_train_s.xlsx")
         train_data = pd.read_excel(self.trainPath)
@@ -77,19 +171,19 @@ class ImageDataTrainningFactory():
             val_ids += [row[0]]
         trainingSet = ImageDataSet(self.WORK_DIR)
         trainingSet.preload(training_ids,["Gravel","Sugar","Fish","Flower"])
-        trainingSet.sub_image_info = self.sub_image_info.copy()
+        trainingSet.sub_image_info = self.sub_image_info
         valSet = ImageDataSet(self.WORK_DIR)
         valSet.preload(val_ids,["Gravel","Sugar","Fish","Flower"])
-        valSet.sub_image_info = self.sub_image_info.copy()
+        valSet.sub_image_info = self.sub_image_info
         return trainingSet,valSet
-class ImageDataSet(utils.Dataset):
+class ImageDataSet(CachedDataSet):
     """Generates the shapes synthetic dataset. The dataset consists of simple
     shapes (triangles, squares, circles) placed randomly on a blank surface.
     The images are generated on the fly. No file access required.
     """
     def __init__(self, workDir):
         super().__init__()
-        self.sub_image_info = {}
+        self.sub_image_info = None
         self.WORK_DIR = workDir
         self.IMAGE_DIR = self.WORK_DIR + "/train_image_shrinked"
         self.MASK_DIR = self.WORK_DIR + "/masks"
@@ -111,6 +205,10 @@ class ImageDataSet(utils.Dataset):
         specs in image_info.
         """
         image_id = self.image_info[id]["id"]
+        # Class crops (ids with a "_") are PNGs of their own size in IMAGE_DIR,
+        # they have no full resolution source
+        if self.image_pyramid is not None and image_id.find("_") < 0:
+            return self.image_pyramid.get(image_id, (384, 576))
         if image_id not in self.image_datas:
             if image_id.find("_") >= 0:
                 image_file = self.IMAGE_DIR + "/" + image_id + ".png"
@@ -154,12 +252,12 @@ class ImageDataSetForMRCNNFactory():
     valPath = ""
     def __init__(self, workDir):
         self._image_ids = []
-        self.sub_image_info = {}
         self.WORK_DIR = workDir
         self.image_datas = LimitedDict(maxLen=200)
         self.image_mask_data = LimitedDict(maxLen=200)
         self.classes = ["Gravel","Sugar","Fish","Flower"]
         self.num_classes = len(self.classes)
+        self.sub_image_info = ImageRegistry(self.classes)
         self.image_meta = {"width":576,"height":384,"MASKWIDTH":576,"MASKHEIGHT":384}
     def initialize(self,totalPath,trainPath,valPath):
         self.totalPath = totalPath
@@ -174,13 +272,14 @@ class ImageDataSetForMRCNNFactory():
         csv_data = pd.read_excel(self.totalPath)
         for idx,row in csv_data.iterrows():
             self._image_ids += [row[0]]
-            self.sub_image_info[row[0]] = {}
+            masks = []
             for clzIdx,clz in enumerate(self.classes):
-                self.sub_image_info[row[0]][self.classes[clzIdx]] = []
                 if isinstance(row[clz],str) and len(row[clz].strip()) > 0:
-                    ids = row[clz].strip().split(" ")
-                    for msk in ids:
-                        self.sub_image_info[row[0]][self.classes[clzIdx]].append(msk)
+                    masks.append(row[clz].strip().split(" "))
+                else:
+                    masks.append([])
+            self.sub_image_info.add(row[0], [len(m) > 0 for m in masks], masks)
+        self.sub_image_info.freeze()
     def getDataSet(self):
         # train_data = pd.read_excel(self.WORK_DIR + "/data_train_s.xlsx")
         train_data = pd.read_excel(self.trainPath)
@@ -194,21 +293,21 @@ class ImageDataSetForMRCNNFactory():
             val_ids += [row[0]]
         trainingSet = ImageDataSetForMRCNN(self.WORK_DIR)
         trainingSet.preload(training_ids,["Gravel","Sugar","Fish","Flower"])
-        trainingSet.sub_image_info = self.sub_image_info.copy()
+        trainingSet.sub_image_info = self.sub_image_info
         valSet = ImageDataSetForMRCNN(self.WORK_DIR)
         valSet.preload(val_ids,["Gravel","Sugar","Fish","Flower"])
-        valSet.sub_image_info = self.sub_image_info.copy()
+        valSet.sub_image_info = self.sub_image_info
         return trainingSet,valSet
 
 
-class ImageDataSetForMRCNN(utils.Dataset):
+class ImageDataSetForMRCNN(CachedDataSet):
     """Generates the shapes synthetic dataset. The dataset consists of simple
     shapes (triangles, squares, circles) placed randomly on a blank surface.
     The images are generated on the fly. No file access required.
     """
     def __init__(self, workDir):
         super().__init__()
-        self.sub_image_info = {}
+        self.sub_image_info = None
         self.WORK_DIR = workDir
         self.IMAGE_DIR = self.WORK_DIR + "/train_image_shrinked"
         self.MASK_DIR = self.WORK_DIR + "/masks_shrinked"
@@ -230,6 +329,8 @@ class ImageDataSetForMRCNN(utils.Dataset):
         specs in image_info.
         """
         image_id = self.image_info[id]["id"]
+        if self.image_pyramid is not None:
+            return self.image_pyramid.get(image_id, (384, 576))
         if image_id not in self.image_datas:
             image_file = self.IMAGE_DIR + "/" + image_id + ".jpg"
             image = cv2.imread(image_file)
@@ -244,11 +345,10 @@ class ImageDataSetForMRCNN(utils.Dataset):
         """Generate instance masks for shapes of the given image ID.
         """
         image_id = self.image_info[id]["id"]
-        image_info = self.sub_image_info[image_id]
         lst_cls_masks = None
         class_ids = []
-        for clz in self.classes:
-            clzInfo = image_info[clz]
+        for clzIdx,clz in enumerate(self.classes):
+            clzInfo = self.sub_image_info.masks(image_id,clzIdx)
             if len(clzInfo) > 0:
                 for path in clzInfo:
                     img_mask = self._load_mask(path)
@@ -265,12 +365,12 @@ class ImageDataSetForMaskFactory():
     valPath = ""
     def __init__(self, workDir):
         self._image_ids = []
-        self.sub_image_info = {}
         self.WORK_DIR = workDir
         self.image_datas = LimitedDict(maxLen=200)
         self.image_mask_data = LimitedDict(maxLen=200)
         self.classes = ["Gravel","Sugar","Fish","Flower"]
         self.num_classes = len(self.classes)
+        self.sub_image_info = ImageRegistry(self.classes)
         self.image_meta = {"width":576,"height":384,"MASKWIDTH":576,"MASKHEIGHT":384}
     def initialize(self,totalPath,trainPath,valPath):
         self.totalPath = totalPath
@@ -289,7 +389,8 @@ class ImageDataSetForMaskFactory():
             csv_data = pd.read_excel(self.totalPath)
         for idx,row in csv_data.iterrows():
             self._image_ids += [row[0]]
-            self.sub_image_info[row[0]] = generateClassVec(row)
+            self.sub_image_info.add(row[0], generateClassVec(row))
+        self.sub_image_info.freeze()
     def getDataSet(self):
         # train_data = pd.read_excel(self.WORK_DIR + "/data_train_s.xlsx")
         train_data = pd.read_excel(self.trainPath)
@@ -303,21 +404,21 @@ class ImageDataSetForMaskFactory():
             val_ids += [row[0]]
         trainingSet = ImageDataSetForMask(self.WORK_DIR)
         trainingSet.preload(training_ids,["Gravel","Sugar","Fish","Flower"])
-        trainingSet.sub_image_info = self.sub_image_info.copy()
+        trainingSet.sub_image_info = self.sub_image_info
         valSet = ImageDataSetForMask(self.WORK_DIR)
         valSet.preload(val_ids,["Gravel","Sugar","Fish","Flower"])
-        valSet.sub_image_info = self.sub_image_info.copy()
+        valSet.sub_image_info = self.sub_image_info
         return trainingSet,valSet
 
 
-class ImageDataSetForMask(utils.Dataset):
+class ImageDataSetForMask(CachedDataSet):
     """Generates the shapes synthetic dataset. The dataset consists of simple
     shapes (triangles, squares, circles) placed randomly on a blank surface.
     The images are generated on the fly. No file access required.
     """
     def __init__(self, workDir):
         super().__init__()
-        self.sub_image_info = {}
+        self.sub_image_info = None
         self.WORK_DIR = workDir
         self.IMAGE_DIR = self.WORK_DIR + "/train_image_shrinked"
         self.MASK_DIR = self.WORK_DIR + "/masks_shrinked"
@@ -339,6 +440,8 @@ class ImageDataSetForMask(utils.Dataset):
         specs in image_info.
         """
         image_id = self.image_info[id]["id"]
+        if self.image_pyramid is not None:
+            return self.image_pyramid.get(image_id, (384, 576), "canny")
         img_data = np.full((384,576,4),0)
         image_file = self.IMAGE_DIR + "/" + image_id + ".jpg"
         image = cv2.imread(image_file)
@@ -10,6 +10,7 @@ from __future__ import division
 
 import warnings
 import os
+import sys
 import random
 import datetime
 import re
@@ -38,7 +39,15 @@ import keras.backend as K
 import keras.layers as KL
 import keras.engine as KE
 import keras.models as KM
+from mymrcnn import buildcache
 from mymrcnn import datagenerator
+from mymrcnn import checkpoints
+from mymrcnn import cpu_parallel
+from mymrcnn import optimizers
+from mymrcnn import samplers
+from mymrcnn import tfdata
+from mymrcnn import tiling
+from mymrcnn import inferenceexport
 DENSENET_121_WEIGHTS_PATH = r'https://github.com/titu1994/DenseNet/releases/download/v3.0/DenseNet-BC-121-32.h5'
 DENSENET_161_WEIGHTS_PATH = r'https://github.com/titu1994/DenseNet/releases/download/v3.0/DenseNet-BC-161-48.h5'
 DENSENET_169_WEIGHTS_PATH = r'https://github.com/titu1994/DenseNet/releases/download/v3.0/DenseNet-BC-169-32.h5'
@@ -722,7 +731,10 @@ class MyBackboneModel:
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
-        self.keras_model = self.buildModel(mode,config)
+        self.keras_model = buildcache.cached_build(
+            lambda: self.buildModel(mode, config), mode, config, [sys.modules[__name__]])
+        # Folded copy for predict_tiled(), exported on first use
+        self.inference_model = None
     def buildModel(self,mode,config):
         input_image = KL.Input(
                 shape=[384, 576, config.IMAGE_SHAPE[2]], name="input_image")
@@ -754,9 +766,7 @@ class MyBackboneModel:
         return KM.Model(inputs, outputs, name='mask_backbone')
     
     def compile(self,learning_rate, momentum):
-        optimizer = keras.optimizers.SGD(
-            lr=learning_rate, momentum=momentum,
-            clipnorm=self.config.GRADIENT_CLIP_NORM)
+        optimizer = optimizers.training_optimizer(learning_rate, momentum, self.config)
         self.keras_model._losses = []
         self.keras_model._per_input_losses = {}
         loss_names = ["mask_loss_l"]
@@ -828,77 +838,41 @@ class MyBackboneModel:
         self.checkpoint_path = self.checkpoint_path.replace(
             "*epoch*", "{epoch:04d}")
     
+    def predict_tiled(self, images, **kwargs):
+        """Predicts the masks of full resolution images tile by tile.
+        images: List or iterable of [height, width, channels] images.
+        kwargs: TiledPredictor arguments, such as scale or output_shape.
+            The others default to config.INFERENCE_TILE_*.
+        Returns a list of [out height, out width, classes] predictions.
+        """
+        # The folded inference model is exported once and reused until the
+        # weights change
+        if self.inference_model is None:
+            self.inference_model = inferenceexport.export_inference_model(self.keras_model)
+        predictor = tiling.TiledPredictor.from_model(self.keras_model, self.config,
+                                                     inference_model=self.inference_model, **kwargs)
+        return predictor.predict(images)
+
     def load_weights(self, filepath, by_name=False, exclude=None):
         """Modified version of the corresponding Keras function with
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exclude: list of layer names to exclude
+        The layer layout of the file is cached next to it, see
+        checkpoints.load_weights().
         """
-        import h5py
-        # Conditional import to support versions of Keras before 2.2
-        # TODO: remove in about 6 months (end of 2018)
-        try:
-            from keras.engine import saving
-        except ImportError:
-            # Keras before 2.2 used the 'topology' namespace.
-            from keras.engine import topology as saving
-
-        if exclude:
-            by_name = True
-
-        if h5py is None:
-            raise ImportError('`load_weights` requires h5py.')
-        f = h5py.File(filepath, mode='r')
-        if 'layer_names' not in f.attrs and 'model_weights' in f:
-            f = f['model_weights']
-
-        # In multi-GPU training, we wrap the model. Get layers
-        # of the inner model because they have the weights.
-        keras_model = self.keras_model
-        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
-            else keras_model.layers
-
-        # Exclude some layers
-        if exclude:
-            layers = filter(lambda l: l.name not in exclude, layers)
-
-        if by_name:
-            saving.load_weights_from_hdf5_group_by_name(f, layers)
-        else:
-            saving.load_weights_from_hdf5_group(f, layers)
-        if hasattr(f, 'close'):
-            f.close()
+        checkpoints.load_weights(self.keras_model, filepath, by_name=by_name, exclude=exclude)
+        self.inference_model = None
 
         # Update the log directory
         self.set_log_dir(filepath)
     def find_last(self):
         """Finds the last checkpoint file of the last trained model in the
-        model directory.
+        model directory, from the checkpoint index of the directory.
         Returns:
             The path of the last checkpoint file
         """
-        # Get directory names. Each directory corresponds to a model
-        dir_names = next(os.walk(self.model_dir))[1]
-        key = self.config.NAME.lower()
-        dir_names = filter(lambda f: f.startswith(key), dir_names)
-        dir_names = sorted(dir_names)
-        if not dir_names:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT,
-                "Could not find model directory under {}".format(self.model_dir))
-        # Pick last directory
-        dir_name = os.path.join(self.model_dir, dir_names[-1])
-        # Find the last checkpoint
-        checkpoints = next(os.walk(dir_name))[2]
-        checkpoints = filter(lambda f: f.startswith("mask_rcnn"), checkpoints)
-        checkpoints = sorted(checkpoints)
-        if not checkpoints:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT, "Could not find weight files in {}".format(dir_name))
-        checkpoint = os.path.join(dir_name, checkpoints[-1])
-        return checkpoint
+        return checkpoints.CheckpointIndex(self.model_dir).last(self.config.NAME.lower())
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
               augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
@@ -935,6 +909,7 @@ class MyBackboneModel:
             defined in the Dataset class.
         """
         assert self.mode == "training", "Create model in training mode."
+        self.inference_model = None
 
         # Pre-defined layer regular expressions
         layer_regex = {
@@ -944,13 +919,42 @@ class MyBackboneModel:
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_generator = datagenerator.data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        if self.config.CPU_WORKERS > 1:
+            # Data parallel over local worker processes, see cpu_parallel
+            cpu_parallel.train(self, datagenerator.data_generator, train_dataset, val_dataset,
+                               learning_rate, epochs, self.config.CPU_WORKERS,
+                               train_kwargs=dict(augmentation=augmentation,
+                                                 no_augmentation_sources=no_augmentation_sources))
+            return
+
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        else:
+            workers = multiprocessing.cpu_count()
+        if self.config.INPUT_PIPELINE == "tf.data":
+            # TensorFlow threads load the batches, see tfdata
+            assert augmentation is None, "The tf.data pipeline has no imgaug augmentation"
+            workers = 0
+
+        # Data generators. The sampler continues the sample order of the
+        # checkpoint this run resumes from, one shard per Keras worker, so
+        # there can't be more workers than images.
+        workers = min(workers, len(train_dataset.image_ids))
+        sampler = samplers.resume(self, train_dataset, workers=max(1, workers))
+        if self.config.INPUT_PIPELINE == "tf.data":
+            train_generator, val_generator = tfdata.training_generators(
+                train_dataset, val_dataset, self.config, sampler=sampler)
+        else:
+            train_generator = datagenerator.data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources,
+                                             sampler=sampler)
+            val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -960,8 +964,8 @@ class MyBackboneModel:
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
                                         histogram_freq=0, write_graph=True, write_images=False),
-            keras.callbacks.ModelCheckpoint(self.checkpoint_path,
-                                            verbose=0, save_weights_only=True),
+            checkpoints.checkpoint_callback(self.model_dir, self.checkpoint_path, self.config,
+                                            sampler=sampler),
         ]
         
         # Add custom callbacks to the list
@@ -974,14 +978,6 @@ class MyBackboneModel:
         #self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
-
         self.keras_model.fit_generator(
             train_generator,
             initial_epoch=self.epoch,
@@ -992,7 +988,7 @@ class MyBackboneModel:
             validation_steps=self.config.VALIDATION_STEPS,
             max_queue_size=100,
             workers=workers,
-            use_multiprocessing=True,
+            use_multiprocessing=workers > 0,
         )
         self.epoch = max(self.epoch, epochs)
 
@@ -0,0 +1,170 @@
+"""
+Batch augmentation for the training generators.
+
+The generators augmented one sample at a time: DataGenerator built an
+albumentations Compose for every image, and load_image_gt runs an imgaug
+to_deterministic() per sample. BatchAugmenter draws the parameters of a
+whole batch at once instead and applies them to the image and mask stacks:
+
+- Samples that are only flipped are written one at a time from reversed
+  strided views, a single copy each. Grouping them by flip combination
+  into one fancy-indexed write gathers a second copy and is slower.
+- Samples with a shift/scale/rotate are warped one at a time, with their
+  flips folded into the affine matrix so they aren't copied twice. cv2
+  warps at most 4 channels per call, wider stacks go in chunks of 4.
+
+The transforms are those of the albumentations pipeline it replaces,
+HorizontalFlip, VerticalFlip and ShiftScaleRotate with its defaults
+(p=0.5, BORDER_REFLECT_101, linear for images, nearest for masks).
+
+It is called where the batch is assembled, so with Keras workers it runs
+in the prefetch processes. Each process draws from its own random state.
+"""
+
+import os
+import numpy as np
+import cv2
+
+# cv2.warpAffine works on up to 4 channels at a time
+_WARP_CHANNELS = 4
+
+
+def rotation_matrices(angles, scales, dx, dy, shape):
+    """[n, 2, 3] matrices of cv2.getRotationMatrix2D about the image
+    center, shifted by dx, dy fractions of the width and height, like
+    albumentations' ShiftScaleRotate.
+    """
+    height, width = shape[:2]
+    cx, cy = width / 2., height / 2.
+    radians = np.deg2rad(angles)
+    alpha = scales * np.cos(radians)
+    beta = scales * np.sin(radians)
+    matrices = np.empty((len(angles), 2, 3), dtype=np.float64)
+    matrices[:, 0, 0] = alpha
+    matrices[:, 0, 1] = beta
+    matrices[:, 0, 2] = (1 - alpha) * cx - beta * cy + dx * width
+    matrices[:, 1, 0] = -beta
+    matrices[:, 1, 1] = alpha
+    matrices[:, 1, 2] = beta * cx + (1 - alpha) * cy + dy * height
+    return matrices
+
+
+def fold_flips(matrices, hflip, vflip, shape):
+    """The matrices applied after flipping the source, as one warp each."""
+    height, width = shape[:2]
+    flips = np.tile(np.eye(3), (len(matrices), 1, 1))
+    flips[hflip, 0, 0] = -1
+    flips[hflip, 0, 2] = width - 1
+    flips[vflip, 1, 1] = -1
+    flips[vflip, 1, 2] = height - 1
+    return np.matmul(matrices, flips)
+
+
+def _warp(image, matrix, interpolation, border_mode):
+    height, width = image.shape[:2]
+    if image.ndim == 2 or image.shape[2] <= _WARP_CHANNELS:
+        warped = cv2.warpAffine(image, matrix, (width, height), flags=interpolation,
+                                borderMode=border_mode)
+        return warped.reshape(image.shape)
+    return np.concatenate([_warp(image[..., c:c + _WARP_CHANNELS], matrix, interpolation, border_mode)
+                           for c in range(0, image.shape[2], _WARP_CHANNELS)], axis=2)
+
+
+class BatchAugmenter(object):
+    """Random flips and shift/scale/rotate of image and mask batches.
+
+    hflip, vflip: Probability of a horizontal and a vertical flip.
+    affine: Probability of a shift/scale/rotate.
+    shift_limit: Largest shift, as a fraction of the image size.
+    scale_limit: Largest scale change, scales are in [1 - limit, 1 + limit].
+    rotate_limit: Largest rotation in degrees.
+    border_mode: cv2 border of the warps.
+    seed: Optional. Seed of the random state. By default every process
+        draws from fresh entropy.
+    """
+
+    def __init__(self, hflip=0.5, vflip=0.5, affine=0.5, shift_limit=0.0625, scale_limit=0.1,
+                 rotate_limit=45, border_mode=cv2.BORDER_REFLECT_101, seed=None):
+        self.hflip = hflip
+        self.vflip = vflip
+        self.affine = affine
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.border_mode = border_mode
+        self.seed = seed
+        self._rng = None
+        self._pid = None
+
+    @property
+    def rng(self):
+        # Worker processes fork with a copy of the state, so take a new one
+        if self._pid != os.getpid():
+            self._rng = np.random.RandomState(self.seed)
+            self._pid = os.getpid()
+        return self._rng
+
+    def sample(self, count):
+        """Parameters of `count` samples, a dict of arrays."""
+        rng = self.rng
+        return {
+            "hflip": rng.random_sample(count) < self.hflip,
+            "vflip": rng.random_sample(count) < self.vflip,
+            "affine": rng.random_sample(count) < self.affine,
+            "angle": rng.uniform(-self.rotate_limit, self.rotate_limit, count),
+            "scale": rng.uniform(1 - self.scale_limit, 1 + self.scale_limit, count),
+            "dx": rng.uniform(-self.shift_limit, self.shift_limit, count),
+            "dy": rng.uniform(-self.shift_limit, self.shift_limit, count),
+        }
+
+    def apply(self, images, masks=None, params=None):
+        """Augments a batch. Returns new arrays, the inputs are left alone.
+
+        images: [batch, height, width, channels]
+        masks: Optional. [batch, height, width, classes], transformed like
+            the images but with nearest neighbour warps.
+        params: Optional. Parameters from sample(), drawn if not given.
+        """
+        if params is None:
+            params = self.sample(len(images))
+        stacks = [(images, np.empty_like(images), cv2.INTER_LINEAR)]
+        if masks is not None:
+            stacks.append((masks, np.empty_like(masks), cv2.INTER_NEAREST))
+
+        affine = params["affine"]
+        # Flips only, copied once from reversed strided views
+        for i in np.flatnonzero(~affine):
+            rows = -1 if params["vflip"][i] else 1
+            cols = -1 if params["hflip"][i] else 1
+            for source, target, _ in stacks:
+                target[i] = source[i, ::rows, ::cols]
+
+        # Warps, with the flips in the same matrix
+        indices = np.flatnonzero(affine)
+        if len(indices):
+            matrices = rotation_matrices(params["angle"][indices], params["scale"][indices],
+                                         params["dx"][indices], params["dy"][indices],
+                                         images.shape[1:3])
+            matrices = fold_flips(matrices, params["hflip"][indices], params["vflip"][indices],
+                                  images.shape[1:3])
+            for source, target, interpolation in stacks:
+                # cv2 has no int64 images, masks go through uint8
+                warp_dtype = np.uint8 if source.dtype.kind in "iub" else source.dtype
+                for i, matrix in zip(indices, matrices):
+                    warped = _warp(np.ascontiguousarray(source[i], dtype=warp_dtype), matrix,
+                                   interpolation, self.border_mode)
+                    target[i] = warped
+        if masks is None:
+            return stacks[0][1]
+        return stacks[0][1], stacks[1][1]
+
+    __call__ = apply
+
+
+def albumentations_compatible(**kwargs):
+    """The BatchAugmenter of the DataGenerator pipeline, HorizontalFlip,
+    VerticalFlip and ShiftScaleRotate(rotate_limit=30, shift_limit=0.1).
+    """
+    kwargs.setdefault("rotate_limit", 30)
+    kwargs.setdefault("shift_limit", 0.1)
+    return BatchAugmenter(**kwargs)
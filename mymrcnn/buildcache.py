@@ -0,0 +1,197 @@
+"""
+Build cache of the model graphs.
+
+Building a model runs all the Python graph code: the dense_res blocks,
+DenseNet201, the MaskRCNN heads. Evaluation and Grad-CAM scripts and every
+worker process pay that again before the first prediction. cached_build()
+stores the architecture of the built graph as Keras JSON instead, keyed
+by a hash of
+- every config value and the mode,
+- the source of the model modules, so an edit rebuilds,
+- the Python, Keras and TensorFlow versions, Lambda layers are stored as
+  bytecode,
+and later constructions load it with model_from_json(). Weights aren't
+stored, load them as before.
+
+The layers are looked up in the globals of the model modules, which also
+holds what the Lambda functions call (K, tf, the loss graphs). Layers that
+take the config (ProposalLayer, DetectionLayer, ...) get the current one,
+the key guarantees it is the config they were built with. Other custom
+layers need a get_config() of their arguments, like POILayer.
+
+Graphs that can't be stored, e.g. Lambdas that close over the config or
+a tensor, or that don't load back, are marked as such in the cache, and
+built every time like before.
+
+    self.keras_model = buildcache.cached_build(
+        lambda: self.buildModel(mode, config), mode, config, [sys.modules[__name__]])
+
+The cache is off by default, set config.BUILD_CACHE = True to use it.
+mrcnn/buildcache.py is a copy of this module.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import logging
+import functools
+import numpy as np
+import tensorflow as tf
+import keras
+import keras.engine as KE
+import keras.models as KM
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".mymrcnn", "graphs")
+
+
+def _value(value):
+    """A JSON value of a config attribute."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if inspect.isfunction(value) or inspect.isclass(value):
+        return "{}.{}".format(value.__module__, value.__name__)
+    if isinstance(value, (list, tuple)):
+        return [_value(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k): _value(v) for k, v in value.items()}
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    return repr(value)
+
+
+def config_values(config):
+    """The config attributes, the ones display() shows and callables such
+    as a BACKBONE function.
+    """
+    values = {}
+    for name in dir(config):
+        value = getattr(config, name)
+        if name.startswith("__") or inspect.ismethod(value):
+            continue
+        values[name] = _value(value)
+    return values
+
+
+def _source_hash(module):
+    path = os.path.splitext(module.__file__)[0] + ".py"
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def graph_key(config, mode, modules):
+    """Hash of everything a graph is built from."""
+    data = {
+        "config": config_values(config),
+        "mode": mode,
+        "modules": {m.__name__: _source_hash(m) for m in modules},
+        "python": list(sys.version_info[:3]),
+        "keras": keras.__version__,
+        "tensorflow": tf.__version__,
+    }
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()[:20]
+
+
+def _takes_config(cls):
+    try:
+        return "config" in inspect.signature(cls.__init__).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def custom_objects(modules, config):
+    """The names model_from_json() resolves layers and Lambda globals in."""
+    objects = {}
+    for module in modules:
+        for name, value in vars(module).items():
+            if name.startswith("__"):
+                continue
+            if inspect.isclass(value) and issubclass(value, KE.Layer) and _takes_config(value):
+                value = functools.partial(value, config=config)
+            objects[name] = value
+    return objects
+
+
+def _write(path, text):
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # Write then rename, so concurrent builds never read half a file
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+class GraphCache(object):
+    """Keras JSON architectures in a directory, by graph_key()."""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+
+    def _path(self, key, extension):
+        return os.path.join(self.cache_dir, key + extension)
+
+    def skipped(self, key):
+        return os.path.exists(self._path(key, ".skip"))
+
+    def skip(self, key, reason):
+        _write(self._path(key, ".skip"), reason)
+
+    def load(self, key, objects):
+        """The model of the key, None if it isn't cached."""
+        path = self._path(key, ".json")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return KM.model_from_json(f.read(), custom_objects=objects)
+
+    def save(self, key, keras_model):
+        """Stores the architecture. Returns False, and marks the key as
+        skipped, if it can't be serialized.
+        """
+        try:
+            architecture = keras_model.to_json()
+        except (TypeError, ValueError, NotImplementedError) as e:
+            self.skip(key, "{}: {}".format(type(e).__name__, e))
+            return False
+        _write(self._path(key, ".json"), architecture)
+        return True
+
+
+def cached_build(build_fn, mode, config, modules):
+    """Returns the model build_fn() builds, from the cache when it can.
+
+    build_fn: Function () -> Keras model.
+    modules: The modules of the graph code, their globals resolve the
+        layers. The module of a callable config.BACKBONE is added.
+    """
+    if not getattr(config, "BUILD_CACHE", False):
+        return build_fn()
+    modules = list(modules)
+    backbone = getattr(config, "BACKBONE", None)
+    if callable(backbone) and backbone.__module__ in sys.modules:
+        modules.append(sys.modules[backbone.__module__])
+    cache = GraphCache(getattr(config, "BUILD_CACHE_DIR", None))
+    key = graph_key(config, mode, modules)
+    if not cache.skipped(key):
+        start = time.time()
+        try:
+            model = cache.load(key, custom_objects(modules, config))
+        except Exception as e:
+            logging.exception("Build cache entry {} doesn't load, building it".format(key))
+            cache.skip(key, "{}: {}".format(type(e).__name__, e))
+            model = None
+        if model is not None:
+            logging.info("Loaded graph {} from the build cache in {:.1f}s".format(
+                key, time.time() - start))
+            return model
+    start = time.time()
+    model = build_fn()
+    if not cache.skipped(key) and cache.save(key, model):
+        logging.info("Built graph {} in {:.1f}s and cached it".format(key, time.time() - start))
+    return model
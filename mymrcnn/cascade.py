@@ -0,0 +1,206 @@
+"""
+Classifier gated cascade inference.
+
+The 4-way cloud classifier (myBackboneModel_Multi) is much cheaper than the
+mask models, and most images only hold some of the classes. The cascade
+runs the classifier first. A mask branch then only runs on the images
+where one of its classes clears the gate of that class, and the channels
+of absent classes are left at zero.
+
+A branch is a mask predictor of some of the classes: one shared model of
+all 4 classes (its only saving is on images with no class), or one model
+per class. Images are batched per branch, over the images whose active
+classes include the branch's, so batches stay full whatever the mix of
+active sets.
+
+    predictor = CascadePredictor(
+        keras_predict_fn(classifier.keras_model, config, output_index=0),
+        [Branch([0, 1, 2, 3], keras_predict_fn(mask.keras_model, config))],
+        gates=config.CASCADE_GATES)
+    probabilities, masks = predictor.predict(images)
+
+evaluate() runs the cascade and the ungated models on validation images
+and reports the mask compute saved and the Dice change.
+"""
+
+import time
+import collections
+import numpy as np
+import cv2
+from mymrcnn import datagenerator
+from mymrcnn import quantization
+
+
+Branch = collections.namedtuple("Branch", ["classes", "predict_fn", "cost"])
+Branch.__new__.__defaults__ = (1.,)
+Branch.__doc__ = """A mask predictor of some classes.
+classes: Class indices of its output channels, in order.
+predict_fn: Function of a list of images -> [n, height, width, len(classes)].
+cost: Relative cost of one image, to weigh the compute saved.
+"""
+
+
+def keras_predict_fn(keras_model, config, output_index=0, channels=None, preprocess=None,
+                     batch_size=8):
+    """A predict function of a model's first input, for the classifier or
+    a mask branch. Images are resized to the input and molded like in
+    training. Other inputs, such as the ground truth masks or class ids of
+    the training graphs, are fed zeros.
+
+    output_index: Output to return, e.g. 0 for the class probabilities of
+        myBackboneModel_Multi, shaped [n, 1, 1, num_classes].
+    channels: Optional. Image channels the model takes, extra ones are
+        dropped.
+    preprocess: Function image -> model input. datagenerator.mold_image
+        by default.
+    """
+    import keras.backend as K
+    preprocess = preprocess or (lambda image: datagenerator.mold_image(image, config))
+    _, height, width, input_channels = K.int_shape(keras_model.inputs[0])
+    channels = channels or input_channels
+    extra_shapes = [K.int_shape(i)[1:] for i in keras_model.inputs[1:]]
+
+    def predict_fn(images):
+        batch = np.zeros((len(images), height, width, channels), dtype=np.float32)
+        for i, image in enumerate(images):
+            image = image[..., :channels].astype(np.float32)
+            if image.shape[:2] != (height, width):
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+            batch[i] = preprocess(image).reshape(height, width, channels)
+        inputs = [batch] + [np.zeros((len(images),) + s, dtype=np.float32) for s in extra_shapes]
+        outputs = keras_model.predict(inputs if extra_shapes else batch, batch_size=batch_size)
+        return outputs[output_index] if isinstance(outputs, list) else outputs
+    return predict_fn
+
+
+class CascadePredictor(object):
+    """Runs the mask branches only for the classes the classifier finds.
+
+    classify_fn: Function of a list of images -> [n, num_classes]
+        probabilities, or any shape of n * num_classes values such as the
+        [n, 1, 1, num_classes] of the classifier's convolution.
+    branches: List of Branch.
+    gates: Per class probability a class must reach to be predicted.
+        A float applies to every class.
+    batch_size: Images per branch call.
+    """
+
+    def __init__(self, classify_fn, branches, gates=0.5, batch_size=8):
+        self.classify_fn = classify_fn
+        self.branches = [b if isinstance(b, Branch) else Branch(*b) for b in branches]
+        self.num_classes = max(c for b in self.branches for c in b.classes) + 1
+        self.gates = np.broadcast_to(np.asarray(gates, dtype=np.float32), (self.num_classes,))
+        self.batch_size = batch_size
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {"images": 0, "branch_images": 0, "branch_images_full": 0,
+                      "cost": 0., "cost_full": 0.}
+
+    @property
+    def compute_saved(self):
+        """Fraction of the mask branch cost skipped so far."""
+        if not self.stats["cost_full"]:
+            return 0.
+        return 1. - self.stats["cost"] / self.stats["cost_full"]
+
+    def active(self, probabilities):
+        """[n, num_classes] bool, the classes that clear their gate."""
+        return probabilities >= self.gates
+
+    def _run(self, images, active):
+        masks = None
+        for branch in self.branches:
+            selected = np.flatnonzero(active[:, list(branch.classes)].any(axis=1))
+            self.stats["branch_images"] += len(selected)
+            self.stats["branch_images_full"] += len(images)
+            self.stats["cost"] += branch.cost * len(selected)
+            self.stats["cost_full"] += branch.cost * len(images)
+            for start in range(0, len(selected), self.batch_size):
+                indices = selected[start:start + self.batch_size]
+                predictions = branch.predict_fn([images[i] for i in indices])
+                if masks is None:
+                    masks = np.zeros((len(images),) + predictions.shape[1:3] + (self.num_classes,),
+                                     dtype=np.float32)
+                for index, prediction in zip(indices, predictions):
+                    for channel, class_index in enumerate(branch.classes):
+                        # Branches of a shared model also return the gated out classes
+                        if active[index, class_index]:
+                            masks[index, ..., class_index] = prediction[..., channel]
+        return masks
+
+    def predict(self, images):
+        """Returns the class probabilities [n, num_classes] and the masks
+        [n, height, width, num_classes], zero for the gated out classes.
+        Masks is None when no class of any image clears its gate.
+        """
+        images = list(images)
+        probabilities = np.concatenate([
+            np.reshape(self.classify_fn(images[start:start + self.batch_size]), (-1, self.num_classes))
+            for start in range(0, len(images), self.batch_size)])
+        self.stats["images"] += len(images)
+        return probabilities, self._run(images, self.active(probabilities))
+
+    def predict_full(self, images):
+        """The ungated masks, every branch on every image. Not counted in
+        the stats.
+        """
+        images = list(images)
+        stats = dict(self.stats)
+        masks = self._run(images, np.ones((len(images), self.num_classes), dtype=bool))
+        self.stats = stats
+        return masks
+
+
+def _fit_masks(masks, shape):
+    """Sizes ground truth masks [H, W, classes] to the prediction shape."""
+    masks = masks.astype(np.uint8)
+    if masks.shape[:2] != tuple(shape):
+        masks = cv2.resize(masks, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        if masks.ndim == 2:
+            masks = masks[..., np.newaxis]
+    return masks
+
+
+def evaluate(predictor, dataset, count=300, threshold=0.5, seed=2019):
+    """Compares the cascade with the ungated branches on data set images.
+
+    Dice is the mean over image and class pairs, like the competition
+    metric, so a correctly skipped empty class scores 1.
+
+    Returns a dict with the Dice of both, the Dice delta, the fraction of
+    mask compute saved and the mean per image latency in milliseconds.
+    """
+    ids = quantization.sample_ids(dataset, count, seed)
+    predictor.reset_stats()
+    full_dice, cascade_dice, full_time, cascade_time = [], [], [], []
+    for start in range(0, len(ids), predictor.batch_size):
+        batch_ids = ids[start:start + predictor.batch_size]
+        images = [dataset.load_image(i) for i in batch_ids]
+        truths = [dataset.load_mask(i)[0] for i in batch_ids]
+        began = time.time()
+        full = predictor.predict_full(images)
+        full_time.append((time.time() - began) / len(images))
+        began = time.time()
+        _, cascade = predictor.predict(images)
+        cascade_time.append((time.time() - began) / len(images))
+        if cascade is None:
+            cascade = np.zeros_like(full)
+        for truth, full_masks, cascade_masks in zip(truths, full, cascade):
+            truth = _fit_masks(truth, full_masks.shape[:2])
+            for c in range(predictor.num_classes):
+                full_dice.append(quantization.dice(full_masks[..., c], truth[..., c], threshold))
+                cascade_dice.append(quantization.dice(cascade_masks[..., c], truth[..., c], threshold))
+    result = {
+        "images": len(ids),
+        "full_dice": float(np.mean(full_dice)),
+        "cascade_dice": float(np.mean(cascade_dice)),
+        "compute_saved": predictor.compute_saved,
+        "branch_images": predictor.stats["branch_images"],
+        "branch_images_full": predictor.stats["branch_images_full"],
+        # Skip the first, warm up batch in the latencies
+        "full_ms": 1000 * float(np.mean(full_time[1:] or full_time)),
+        "cascade_ms": 1000 * float(np.mean(cascade_time[1:] or cascade_time)),
+    }
+    result["dice_delta"] = result["cascade_dice"] - result["full_dice"]
+    return result
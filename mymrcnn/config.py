@@ -33,6 +33,78 @@ class Config(object):
     # number that your GPU can handle for best performance.
     IMAGES_PER_GPU = 1
 
+    # Tiled inference, see tiling.TiledPredictor. The scale the full resolution
+    # images are resized by before they are cut into model input sized tiles.
+    # None resizes every image to a single tile, like in training. Overlap
+    # is in pixels at the tile resolution, batch in tiles per forward pass.
+    INFERENCE_TILE_SCALE = None
+    INFERENCE_TILE_OVERLAP = 64
+    INFERENCE_TILE_BATCH = 8
+
+    # Probability each class must reach in the classifier for cascade
+    # inference to run its mask branches, see cascade.
+    CASCADE_GATES = [0.5, 0.5, 0.5, 0.5]
+
+    # Knowledge distillation, see distillation. The weight of the teacher's
+    # soft masks in the student loss, the rest goes to the ground truth, and
+    # the student backbone, "short" or "long".
+    DISTILL_ALPHA = 0.5
+    DISTILL_STUDENT = "short"
+
+    # Channel pruning, see pruning. The fractions of the filters of every
+    # prunable conv to remove, ranked by "gamma" or "activation", and the
+    # fine-tuning epochs of each pruned model.
+    PRUNE_RATIOS = [0.25, 0.5, 0.75]
+    PRUNE_CRITERION = "gamma"
+    PRUNE_FINE_TUNE_EPOCHS = 2
+
+    # Number of local worker processes for CPU data parallel training, see
+    # cpu_parallel. Each trains on its own BATCH_SIZE batch, so a step covers
+    # CPU_WORKERS * BATCH_SIZE images. 0 or 1 trains in this process.
+    CPU_WORKERS = 0
+
+    # RAM budget in GB of the planner's batch recommendation, see planner and
+    # display(). None uses the memory of the machine.
+    PLANNER_RAM_GB = None
+
+    # Graph build cache, see buildcache. Built graphs are stored by a hash of
+    # the config, the mode and the model code, and later constructions load
+    # them instead of running the graph code. Off by default. None is
+    # ~/.mymrcnn/graphs.
+    BUILD_CACHE = False
+    BUILD_CACHE_DIR = None
+
+    # Micro-batching of the inference server, see serving. A batch runs when
+    # it holds SERVING_MAX_BATCH_SIZE images or SERVING_MAX_WAIT_MS after its
+    # first one arrived. Requests beyond SERVING_MAX_QUEUE queued get a 503.
+    SERVING_MAX_BATCH_SIZE = 8
+    SERVING_MAX_WAIT_MS = 10
+    SERVING_MAX_QUEUE = 256
+
+    # Checkpoint retention, see checkpoints.CheckpointWriter. A run keeps its
+    # last CHECKPOINT_KEEP_LAST checkpoints plus the CHECKPOINT_KEEP_BEST best
+    # ones by the CHECKPOINT_MONITOR epoch metric ("min" or "max" is better
+    # by CHECKPOINT_MODE). None keeps every checkpoint, the default since
+    # scripts load specific epochs. Runs opt in to pruning, e.g. 3 and 2.
+    CHECKPOINT_KEEP_LAST = None
+    CHECKPOINT_KEEP_BEST = 0
+    CHECKPOINT_MONITOR = "val_loss"
+    CHECKPOINT_MODE = "min"
+
+    # Seed of the training sample order, see samplers. The order and its
+    # cursor are saved with each checkpoint, so resumed runs continue it.
+    SAMPLER_SEED = 2019
+
+    # Training input. "generator" runs datagenerator.data_generator() in
+    # Keras worker processes, "tf.data" a tf.data pipeline in TensorFlow
+    # threads, see tfdata. TFDATA_PARALLEL_CALLS None autotunes, and
+    # TFDATA_CACHE is None, "" to cache decoded images in memory, or a file
+    # path.
+    INPUT_PIPELINE = "generator"
+    TFDATA_PARALLEL_CALLS = None
+    TFDATA_CACHE = None
+    TFDATA_PREFETCH = 4
+
     # Number of training steps per epoch
     # This doesn't need to match the size of the training set. Tensorboard
     # updates are saved at the end of each epoch, so setting this to a
@@ -215,10 +287,17 @@ class Config(object):
     # Gradient norm clipping
     GRADIENT_CLIP_NORM = 5.0
 
+    # Number of batches to accumulate gradients over before each weight
+    # update. The effective batch size is BATCH_SIZE * ACCUMULATION_STEPS,
+    # while the graph only holds BATCH_SIZE images. STEPS_PER_EPOCH counts
+    # batches, not updates. Keep TRAIN_BN = False when accumulating.
+    ACCUMULATION_STEPS = 1
+
     def __init__(self):
         """Set values of computed attributes."""
         # Effective batch size
         self.BATCH_SIZE = self.IMAGES_PER_GPU * self.GPU_COUNT
+        self.EFFECTIVE_BATCH_SIZE = self.BATCH_SIZE * self.ACCUMULATION_STEPS
 
         # Input image size
         if self.IMAGE_RESIZE_MODE == "crop":
@@ -232,10 +311,22 @@ class Config(object):
         # See compose_image_meta() for details
         self.IMAGE_META_SIZE = 1 + 3 + 3 + 4 + 1 + self.NUM_CLASSES
 
-    def display(self):
-        """Display Configuration values."""
+    def display(self, model=None, ram_gb=None):
+        """Display Configuration values.
+
+        model: Optional. A built model (or its keras_model) to also show the
+            memory and FLOPs plan of, see planner.
+        ram_gb: RAM budget of the batch recommendation. Defaults to
+            PLANNER_RAM_GB, then to the machine's memory.
+        """
         print("\nConfigurations:")
         for a in dir(self):
             if not a.startswith("__") and not callable(getattr(self, a)):
                 print("{:30} {}".format(a, getattr(self, a)))
         print("\n")
+        if model is not None:
+            from mymrcnn import planner
+            ram_gb = ram_gb or self.PLANNER_RAM_GB or planner.physical_memory_gb()
+            print(planner.plan(model, self).format(
+                self.BATCH_SIZE, ram_gb, getattr(self, "EFFECTIVE_BATCH_SIZE", self.BATCH_SIZE)))
+            print("\n")
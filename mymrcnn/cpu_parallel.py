@@ -0,0 +1,329 @@
+"""
+Data parallel training on the CPU cores of one machine.
+
+ParallelModel splits a batch over GPUs inside one graph. Without GPUs, one
+TensorFlow session doesn't use a many core machine well. train() here starts
+N worker processes instead. Each worker:
+- is pinned to its own group of cores, with an intra-op thread pool of
+  that size,
+- builds the model and loads the same starting weights,
+- reads its own shard of the sample order, see samplers,
+- computes the gradients of its batch, which AllReduce averages over all
+  workers through shared memory,
+- applies the averaged gradients with the model's own optimizer.
+
+All workers apply the same update to the same weights, so they stay in sync
+without sending weights around. One step trains on workers * BATCH_SIZE
+images. STEPS_PER_EPOCH counts these steps.
+
+Worker 0 writes the checkpoint of each epoch with a CheckpointWriter, which
+adds it to the checkpoint index and applies the CHECKPOINT_KEEP_* policy.
+When training ends, the parent model loads the last one. The
+validation loss is averaged over the workers, each running its share of
+VALIDATION_STEPS. There is no TensorBoard callback in this mode.
+
+BatchNorm: with TRAIN_BN = False (the default) the moving statistics are
+frozen and the workers stay identical. When BN layers train, each worker
+updates its moving averages from its own batches only.
+
+Workers are spawned, not forked, so scripts calling train() need an
+`if __name__ == "__main__":` guard.
+"""
+
+import os
+import time
+import queue
+import random
+import traceback
+import multiprocessing
+import numpy as np
+from mymrcnn import checkpoints
+from mymrcnn import samplers
+
+# Name of the starting weights the workers load, in the log directory
+START_WEIGHTS = "cpu_parallel_start.h5"
+
+
+def core_groups(workers):
+    """Splits the cores this process may use into `workers` contiguous groups."""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(multiprocessing.cpu_count()))
+    if workers > len(cores):
+        raise ValueError("{} workers but only {} cores".format(workers, len(cores)))
+    return [[int(c) for c in group] for group in np.array_split(cores, workers)]
+
+
+class AllReduce(object):
+    """Averages float32 vectors over the workers through shared memory.
+
+    Each worker writes its vector to its row. After a barrier, worker i
+    averages slice i of all rows into the result, so the reduction work is
+    split evenly. After a second barrier every worker reads the whole
+    result. The next write can't overtake a read, because it waits at the
+    first barrier for everyone to finish reading.
+    """
+
+    def __init__(self, context, workers, size):
+        self.workers = workers
+        self.size = size
+        self.rows = context.RawArray("f", workers * size)
+        self.result = context.RawArray("f", size)
+        self.barrier = context.Barrier(workers)
+        self.rank = None
+
+    def attach(self, rank):
+        """Maps the shared buffers in a worker process."""
+        self.rank = rank
+        self._rows = np.frombuffer(self.rows, dtype=np.float32).reshape(self.workers, self.size)
+        self._result = np.frombuffer(self.result, dtype=np.float32)
+        return self
+
+    def mean(self, vector):
+        n = len(vector)
+        self._rows[self.rank, :n] = vector
+        self.barrier.wait()
+        bounds = np.linspace(0, n, self.workers + 1).astype(int)
+        start, stop = bounds[self.rank], bounds[self.rank + 1]
+        np.mean(self._rows[:, start:stop], axis=0, out=self._result[start:stop])
+        self.barrier.wait()
+        return self._result[:n].copy()
+
+
+def _parameter_count(keras_model):
+    import keras.backend as K
+    return int(sum(np.prod(K.int_shape(w)) for w in keras_model.trainable_weights))
+
+
+class _TrainStep(object):
+    """The gradient and update functions of a compiled model, kept apart
+    so the gradients can be averaged in between.
+    """
+
+    def __init__(self, keras_model):
+        import tensorflow as tf
+        import keras.backend as K
+        from mymrcnn import optimizers
+        weights = keras_model.trainable_weights
+        loss = keras_model.total_loss
+        grads = K.gradients(loss, weights)
+        if None in grads:
+            raise ValueError('An operation has `None` for gradient. '
+                             'Please make sure that all of your ops have a '
+                             'gradient defined (i.e. are differentiable).')
+        # Gathers give sparse gradients, the all-reduce needs dense ones
+        grads = [tf.convert_to_tensor(g) for g in grads]
+        self.learning_phase = not isinstance(K.learning_phase(), int)
+        inputs = list(keras_model.inputs)
+        if self.learning_phase:
+            inputs.append(K.learning_phase())
+        self.shapes = [K.int_shape(w) for w in weights]
+        self.splits = np.cumsum([int(np.prod(s)) for s in self.shapes])[:-1]
+        self.gradient_fn = K.function(inputs, [loss] + grads, updates=keras_model.updates)
+        self.loss_fn = K.function(inputs, [loss])
+
+        # The optimizer reads the averaged gradients from placeholders,
+        # clipped like Optimizer.get_gradients would
+        placeholders = [K.placeholder(shape=s, dtype=K.dtype(w)) for s, w in zip(self.shapes, weights)]
+        optimizer = keras_model.optimizer
+        get_gradients = optimizer.get_gradients
+        optimizer.get_gradients = lambda loss, params: optimizers._clip(placeholders, optimizer)
+        try:
+            with K.name_scope('training'):
+                updates = optimizer.get_updates(loss=loss, params=weights)
+        finally:
+            optimizer.get_gradients = get_gradients
+        self.apply_fn = K.function(placeholders, [], updates=updates)
+
+    def _feed(self, inputs, training):
+        inputs = list(inputs)
+        if self.learning_phase:
+            inputs.append(1 if training else 0)
+        return inputs
+
+    def gradients(self, inputs):
+        """Returns the loss and the flat gradient vector of a batch."""
+        outputs = self.gradient_fn(self._feed(inputs, True))
+        return float(np.mean(outputs[0])), \
+            np.concatenate([np.ravel(g) for g in outputs[1:]]).astype(np.float32)
+
+    def apply(self, flat_grads):
+        grads = [g.reshape(s) for g, s in zip(np.split(flat_grads, self.splits), self.shapes)]
+        self.apply_fn(grads)
+
+    def loss(self, inputs):
+        return float(np.mean(self.loss_fn(self._feed(inputs, False))[0]))
+
+
+def _run_worker(rank, spec, allreduce, events):
+    cores = spec["cores"][rank]
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    np.random.seed(spec["seed"] + rank)
+    random.seed(spec["seed"] + rank)
+
+    import tensorflow as tf
+    import keras.backend as K
+    K.set_session(tf.Session(config=tf.ConfigProto(
+        intra_op_parallelism_threads=len(cores), inter_op_parallelism_threads=2)))
+
+    config = spec["config"]
+    model = spec["model_class"](mode="training", config=config, model_dir=spec["model_dir"])
+    model.log_dir = spec["log_dir"]
+    model.checkpoint_path = spec["checkpoint_path"]
+    if spec["layers"] is not None:
+        model.set_trainable(spec["layers"], verbose=0)
+    model.compile(spec["learning_rate"], config.LEARNING_MOMENTUM)
+    checkpoints.load_weights(model.keras_model, spec["weights_path"])
+    step = _TrainStep(model.keras_model)
+    allreduce.attach(rank)
+
+    generator_fn = spec["generator_fn"]
+    sampler = samplers.Sampler.from_state(spec["sampler"], rank=rank)
+    train_generator = generator_fn(spec["train_dataset"], config, shuffle=True,
+                                   batch_size=config.BATCH_SIZE, sampler=sampler,
+                                   **spec["train_kwargs"])
+    val_generator = generator_fn(spec["val_dataset"], config, shuffle=True,
+                                 batch_size=config.BATCH_SIZE)
+    workers = allreduce.workers
+    val_steps = max(1, int(np.ceil(config.VALIDATION_STEPS / float(workers))))
+    writer = None
+    if rank == 0 and spec["save"]:
+        writer = checkpoints.CheckpointWriter(
+            spec["model_dir"], keep_last=config.CHECKPOINT_KEEP_LAST,
+            keep_best=config.CHECKPOINT_KEEP_BEST, monitor=config.CHECKPOINT_MONITOR,
+            mode=config.CHECKPOINT_MODE)
+    for epoch in range(spec["initial_epoch"], spec["epochs"]):
+        start = time.time()
+        losses = []
+        for _ in range(config.STEPS_PER_EPOCH):
+            inputs, _ = next(train_generator)
+            loss, grads = step.gradients(inputs)
+            averaged = allreduce.mean(np.append(grads, np.float32(loss)))
+            step.apply(averaged[:-1])
+            losses.append(averaged[-1])
+        seconds = time.time() - start
+        val_loss = np.mean([step.loss(next(val_generator)[0]) for _ in range(val_steps)])
+        val_loss = float(allreduce.mean(np.array([val_loss], dtype=np.float32))[0])
+        if rank == 0:
+            path = None
+            loss = float(np.mean(losses))
+            if writer is not None:
+                path = model.checkpoint_path.format(epoch=epoch + 1)
+                samples = (epoch + 1) * config.STEPS_PER_EPOCH * workers * config.BATCH_SIZE
+                writer.save(model.keras_model, path, {"loss": loss, "val_loss": val_loss},
+                            sampler.state(samples=samples))
+            events.put(("epoch", rank, {
+                "epoch": epoch + 1,
+                "loss": loss,
+                "val_loss": val_loss,
+                "seconds": seconds,
+                "images_per_second": config.STEPS_PER_EPOCH * workers * config.BATCH_SIZE / seconds,
+                "checkpoint": path,
+            }))
+    if writer is not None:
+        writer.close()
+
+
+def _worker(rank, spec, allreduce, events):
+    try:
+        _run_worker(rank, spec, allreduce, events)
+        events.put(("done", rank, None))
+    except Exception:
+        events.put(("error", rank, traceback.format_exc()))
+        # Release the workers waiting for this one
+        allreduce.barrier.abort()
+
+
+def train(model, generator_fn, train_dataset, val_dataset, learning_rate, epochs, workers,
+          layers=None, train_kwargs=None, save=True, seed=2019):
+    """Trains a model with `workers` processes on the local CPU cores.
+
+    model: A MyBackboneModel or MaskRCNN in training mode. It is rebuilt in
+        every worker from its class, config and model_dir, and starts from
+        its current weights.
+    generator_fn: Module level function (dataset, config, shuffle, batch_size,
+        sampler, **train_kwargs) -> batches, e.g. datagenerator.data_generator.
+        Each worker gets its shard of the run's samplers.Sampler.
+    train_dataset, val_dataset: Data sets, passed to the workers by pickling.
+    layers: Optional. Layer regex passed to model.set_trainable() in the
+        workers.
+    train_kwargs: Optional. More arguments for the training generator, such
+        as augmentation.
+    save: Write a checkpoint per epoch. Off for benchmarks.
+
+    Returns the per epoch results reported by worker 0.
+    """
+    context = multiprocessing.get_context("spawn")
+    if not os.path.exists(model.log_dir):
+        os.makedirs(model.log_dir)
+    if layers is not None:
+        model.set_trainable(layers, verbose=0)
+    weights_path = os.path.join(model.log_dir, START_WEIGHTS)
+    model.keras_model.save_weights(weights_path)
+
+    allreduce = AllReduce(context, workers, _parameter_count(model.keras_model) + 1)
+    samples_per_epoch = model.config.STEPS_PER_EPOCH * workers * model.config.BATCH_SIZE
+    sampler = samplers.resume(model, train_dataset, workers=workers, rank=0,
+                              samples_per_epoch=samples_per_epoch)
+    spec = {
+        "model_class": type(model),
+        "config": model.config,
+        "model_dir": model.model_dir,
+        "log_dir": model.log_dir,
+        "checkpoint_path": model.checkpoint_path,
+        "initial_epoch": model.epoch,
+        "epochs": epochs,
+        "learning_rate": learning_rate,
+        "layers": layers,
+        "weights_path": weights_path,
+        "generator_fn": generator_fn,
+        "train_dataset": train_dataset,
+        "val_dataset": val_dataset,
+        "train_kwargs": train_kwargs or {},
+        "sampler": sampler.state(),
+        "cores": core_groups(workers),
+        "save": save,
+        "seed": seed,
+    }
+    events = context.Queue()
+    processes = [context.Process(target=_worker, args=(rank, spec, allreduce, events), daemon=True)
+                 for rank in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(message):
+        for process in processes:
+            process.terminate()
+        raise RuntimeError(message)
+
+    results = []
+    finished = set()
+    try:
+        while len(finished) < workers:
+            try:
+                kind, rank, payload = events.get(timeout=5)
+            except queue.Empty:
+                failed = [p.exitcode for p in processes if p.exitcode not in (None, 0)]
+                if failed:
+                    stop("CPU parallel worker exited with code {}".format(failed[0]))
+                continue
+            if kind == "error":
+                stop("CPU parallel worker {} failed:\n{}".format(rank, payload))
+            elif kind == "done":
+                finished.add(rank)
+            else:
+                results.append(payload)
+                print("Epoch {epoch}: loss {loss:.4f} val_loss {val_loss:.4f} "
+                      "{seconds:.0f}s {images_per_second:.2f} images/s".format(**payload))
+        for process in processes:
+            process.join()
+    finally:
+        os.remove(weights_path)
+
+    model.epoch = max(model.epoch, epochs)
+    if save and results:
+        checkpoints.load_weights(model.keras_model, results[-1]["checkpoint"])
+    return results
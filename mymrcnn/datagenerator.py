@@ -111,7 +111,7 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
-                   no_augmentation_sources=None):
+                   no_augmentation_sources=None, sampler=None, batch_augmentation=None):
     """A generator that returns images and corresponding target class ids,
     bounding box deltas, and masks.
 
@@ -133,6 +133,12 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     no_augmentation_sources: Optional. List of sources to exclude for
         augmentation. A source is string that identifies a dataset and is
         defined in the Dataset class.
+    sampler: Optional. A samplers.Sampler giving the order of the images
+        instead of shuffling with np.random. Its seed and cursor make the
+        order reproducible and resumable, and its shards keep worker
+        processes from drawing the same images.
+    batch_augmentation: Optional. An augmentation.BatchAugmenter applied to
+        each full batch of images and masks, after `augmentation`.
 
     Returns a Python generator. Upon calling next() on it, the
     generator returns two lists, inputs and outputs. The contents
@@ -162,10 +168,13 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
     # Keras requires a generator to run indefinitely.
     while True:
         try:
-            # Increment index to pick next image. Shuffle if at the start of an epoch.
-            image_index = (image_index + 1) % len(image_ids)
-            if shuffle and image_index == 0:
-                np.random.shuffle(image_ids)
+            if sampler is not None:
+                image_index = sampler.next()
+            else:
+                # Increment index to pick next image. Shuffle if at the start of an epoch.
+                image_index = (image_index + 1) % len(image_ids)
+                if shuffle and image_index == 0:
+                    np.random.shuffle(image_ids)
             image_id = image_ids[image_index]
 
             # If the image source is not to be augmented pass None as augmentation
@@ -200,6 +209,8 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
             # Batch full?
             if b >= batch_size:
+                if batch_augmentation is not None:
+                    batch_images, batch_gt_masks = batch_augmentation(batch_images, batch_gt_masks)
                 inputs = [batch_images,batch_gt_masks]
                 outputs = []
                 yield inputs, outputs
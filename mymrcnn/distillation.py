@@ -0,0 +1,242 @@
+"""
+Knowledge distillation of a mask model into a small CPU student.
+
+The teacher (MyMaskModel's DenseNet, the resnet sm.Unet of
+segmentationModel, ...) is frozen. Its soft masks are computed once and
+cached on disk with featurecache, keyed by the teacher weights and the
+images. The student is dense_graph_simple_short or dense_graph_simple_long
+with a light upsampling decoder, trained on
+
+    loss = alpha * BCE(student, teacher) + (1 - alpha) * BCE+Dice(student, truth)
+
+so it learns the teacher's confidence at the cloud borders as well as the
+labels. report() measures both models on the same validation images: the
+per image latency and the Dice of each against the ground truth.
+
+    distiller = Distiller(teacher.keras_model, config, MODEL_DIR, backbone="short")
+    distiller.train(dataset_train, dataset_val, learning_rate=0.001, epochs=20)
+    print(distiller.report(dataset_val))
+"""
+
+import os
+import time
+import datetime
+import multiprocessing
+import numpy as np
+import cv2
+import keras
+import keras.backend as K
+import keras.layers as KL
+import keras.models as KM
+from mymrcnn import datagenerator
+from mymrcnn import checkpoints
+from mymrcnn import featurecache
+from mymrcnn import inferenceexport
+from mymrcnn import optimizers
+from mymrcnn import quantization
+from mymrcnn import myBackboneModel as backbones
+
+STUDENT_BACKBONES = {
+    "short": backbones.dense_graph_simple_short,
+    "long": backbones.dense_graph_simple_long,
+}
+
+
+def build_student(input_shape, num_classes, backbone="short", filters=32, train_bn=False):
+    """The student: a dense_res backbone and a decoder that upsamples the
+    deepest features, adding each shallower level, up to the input size.
+    Returns a Keras model image -> [H, W, num_classes] sigmoid masks.
+    """
+    input_image = KL.Input(shape=input_shape, name="input_image")
+    features = [f for f in STUDENT_BACKBONES[backbone](input_image, train_bn=train_bn) if f is not None]
+    x = features[-1]
+    for level, feature in enumerate(reversed(features[:-1])):
+        ratio = K.int_shape(feature)[1] // K.int_shape(x)[1]
+        if ratio > 1:
+            x = KL.UpSampling2D(size=(ratio, ratio), name="student_up{}".format(level))(x)
+        x = KL.Concatenate(axis=-1, name="student_concat{}".format(level))([x, feature])
+        x = KL.Conv2D(filters, (3, 3), padding="same", use_bias=False,
+                      name="student_conv{}".format(level))(x)
+        x = backbones.BatchNorm(name="student_bn{}".format(level))(x, training=train_bn)
+        x = KL.Activation("relu")(x)
+    ratio = input_shape[0] // K.int_shape(x)[1]
+    if ratio > 1:
+        x = KL.UpSampling2D(size=(ratio, ratio), name="student_up_final")(x)
+    masks = KL.Conv2D(num_classes, (3, 3), padding="same", activation="sigmoid",
+                      name="student_masks")(x)
+    return KM.Model(input_image, masks, name="student_" + backbone)
+
+
+def distillation_loss(alpha, num_classes, smooth=1.):
+    """Loss of y_true = [teacher masks, ground truth] on the channel axis."""
+    def loss(y_true, y_pred):
+        teacher = y_true[..., :num_classes]
+        truth = y_true[..., num_classes:]
+        soft = K.mean(K.binary_crossentropy(teacher, y_pred))
+        truth_f, pred_f = K.flatten(truth), K.flatten(y_pred)
+        dice = 1. - (2. * K.sum(truth_f * pred_f) + smooth) / (K.sum(truth_f) + K.sum(pred_f) + smooth)
+        hard = K.mean(K.binary_crossentropy(truth, y_pred)) + dice
+        return alpha * soft + (1. - alpha) * hard
+    return loss
+
+
+def teacher_model(keras_model):
+    """The frozen inference graph of a teacher, image -> soft masks."""
+    model = inferenceexport.export_inference_model(keras_model)
+    return KM.Model(model.inputs[0], model.outputs[0], name="teacher")
+
+
+def _fit(masks, height, width, interpolation):
+    """Masks [H, W, channels] as float32 of the given size."""
+    masks = masks.astype(np.float32)
+    if masks.shape[:2] != (height, width):
+        masks = cv2.resize(masks, (width, height), interpolation=interpolation)
+        if masks.ndim == 2:
+            masks = masks[..., np.newaxis]
+    return masks
+
+
+def _fit_truth(masks, output_shape):
+    """Ground truth masks sized like a model output. A single channel
+    output, like the cloud mask of MyMaskModel's DenseNet, gets the union
+    of the classes.
+    """
+    masks = _fit(masks, output_shape[0], output_shape[1], cv2.INTER_NEAREST)
+    if output_shape[-1] == 1 and masks.shape[-1] != 1:
+        masks = np.any(masks, axis=-1, keepdims=True).astype(np.float32)
+    return masks
+
+
+def distillation_generator(store, dataset, config, output_shape, shuffle=True, batch_size=1):
+    """Yields molded images and [teacher masks, ground truth masks] sized
+    to the student output.
+    """
+    image_ids = np.copy(dataset.image_ids)
+    rows = store.rows(dataset, image_ids)
+    height, width = output_shape[:2]
+    while True:
+        order = np.random.permutation(len(image_ids)) if shuffle else np.arange(len(image_ids))
+        # Drop the last partial batch, like data_generator()
+        for start in range(0, len(order) - batch_size + 1, batch_size):
+            batch = order[start:start + batch_size]
+            images, targets = [], []
+            teacher = store.features(rows[batch], [0])[0]
+            for soft, index in zip(teacher, batch):
+                image, _, truth = datagenerator.load_image_gt(dataset, config, image_ids[index])
+                images.append(datagenerator.mold_image(image.astype(np.float32), config))
+                targets.append(np.concatenate([_fit(soft, height, width, cv2.INTER_LINEAR),
+                                               _fit_truth(truth, output_shape)],
+                                              axis=-1))
+            yield np.stack(images), np.stack(targets)
+
+
+class Distiller(object):
+    """Trains a student on a frozen teacher's soft masks.
+
+    teacher: The trained teacher Keras model, e.g. MyBackboneModel.keras_model.
+    model_dir: Where the student checkpoints and the teacher cache go.
+    backbone: "short" or "long", see STUDENT_BACKBONES.
+    """
+
+    def __init__(self, teacher, config, model_dir, backbone="short", cache_dir=None):
+        self.config = config
+        self.model_dir = model_dir
+        self.backbone = backbone
+        self.teacher = teacher_model(teacher)
+        self.cache_dir = cache_dir or os.path.join(model_dir, "teacher_cache")
+        input_shape = K.int_shape(self.teacher.input)[1:]
+        self.num_classes = K.int_shape(self.teacher.output)[-1]
+        self.student = build_student(input_shape, self.num_classes, backbone=backbone,
+                                     train_bn=config.TRAIN_BN)
+        self.set_log_dir()
+
+    def set_log_dir(self, tag=""):
+        """A new log directory for the next train() call, from epoch 0."""
+        self.epoch = 0
+        now = datetime.datetime.now()
+        self.log_dir = os.path.join(self.model_dir, "{}_student_{}{}{:%Y%m%dT%H%M}".format(
+            self.config.NAME.lower(), self.backbone, tag, now))
+        self.checkpoint_path = os.path.join(self.log_dir, "{}_{}_student_{{epoch:04d}}.h5".format(
+            checkpoints.CHECKPOINT_PREFIX, self.config.NAME.lower()))
+
+    def set_student(self, student, tag):
+        """Trains another student from now on, e.g. a pruned copy of this
+        one, in its own log directory.
+        """
+        self.student = student
+        self.set_log_dir(tag)
+
+    def cache_teacher(self, datasets):
+        """The teacher's soft masks of the data sets, computed on first use."""
+        return featurecache.open_or_build(self.cache_dir, self.teacher, datasets, self.config)
+
+    def train(self, train_dataset, val_dataset, learning_rate, epochs, alpha=None,
+              custom_callbacks=None):
+        """Trains the student. alpha weighs the teacher term, config.DISTILL_ALPHA
+        by default.
+        """
+        alpha = self.config.DISTILL_ALPHA if alpha is None else alpha
+        store = self.cache_teacher([train_dataset, val_dataset])
+        output_shape = K.int_shape(self.student.output)[1:]
+        batch_size = self.config.BATCH_SIZE
+        train_generator = distillation_generator(store, train_dataset, self.config, output_shape,
+                                                 batch_size=batch_size)
+        val_generator = distillation_generator(store, val_dataset, self.config, output_shape,
+                                               batch_size=batch_size)
+        optimizer = optimizers.training_optimizer(learning_rate, self.config.LEARNING_MOMENTUM,
+                                                  self.config)
+        self.student.compile(optimizer=optimizer,
+                             loss=distillation_loss(alpha, self.num_classes))
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        callbacks = [
+            keras.callbacks.TensorBoard(log_dir=self.log_dir,
+                                        histogram_freq=0, write_graph=True, write_images=False),
+            checkpoints.checkpoint_callback(self.model_dir, self.checkpoint_path, self.config),
+        ]
+        if custom_callbacks:
+            callbacks += custom_callbacks
+        # Windows can't fork generator workers, see MyBackboneModel.train()
+        workers = 0 if os.name == 'nt' else multiprocessing.cpu_count()
+        self.student.fit_generator(
+            train_generator,
+            initial_epoch=self.epoch,
+            epochs=epochs,
+            steps_per_epoch=self.config.STEPS_PER_EPOCH,
+            callbacks=callbacks,
+            validation_data=val_generator,
+            validation_steps=self.config.VALIDATION_STEPS,
+            max_queue_size=100,
+            workers=workers,
+            use_multiprocessing=workers > 0,
+        )
+        self.epoch = max(self.epoch, epochs)
+
+    def load_weights(self, filepath):
+        checkpoints.load_weights(self.student, filepath)
+
+    def report(self, dataset, count=300, seed=2019):
+        """Latency and Dice of the student and the teacher on the same
+        images, and the Dice gap (student - teacher).
+        """
+        ids = quantization.sample_ids(dataset, count, seed)
+        result = {"images": len(ids)}
+        for name, model in (("teacher", self.teacher), ("student", self.student)):
+            output_shape = K.int_shape(model.output)[1:]
+            dice, seconds = [], []
+            for image_id in ids:
+                image, _, truth = datagenerator.load_image_gt(dataset, self.config, image_id)
+                batch = datagenerator.mold_image(image.astype(np.float32), self.config)[np.newaxis]
+                start = time.time()
+                prediction = model.predict(batch)[0]
+                seconds.append(time.time() - start)
+                truth = _fit_truth(truth, output_shape)
+                dice.append(quantization.dice(prediction, truth))
+            result[name + "_dice"] = float(np.mean(dice))
+            # Skip the first, warm up run
+            result[name + "_ms"] = 1000 * float(np.mean(seconds[1:] or seconds))
+        result["dice_gap"] = result["student_dice"] - result["teacher_dice"]
+        result["speedup"] = result["teacher_ms"] / result["student_ms"]
+        result["student_parameters"] = int(self.student.count_params())
+        result["teacher_parameters"] = int(self.teacher.count_params())
+        return result
@@ -0,0 +1,215 @@
+"""
+Frozen backbone feature cache.
+
+When only the heads train, the backbone gives the same feature maps for an
+image on every epoch. FeatureStore runs the backbone once over the data sets
+and keeps its outputs (C2-C5) on disk, so head epochs only pay for the heads.
+
+Layout of a store, one directory per store_key(): the backbone weights,
+the image size settings and the image ids of the data sets:
+    <cache_dir>/<key>/meta.json     image ids, shapes, state
+    <cache_dir>/<key>/level_<i>.npy [num_images, H, W, C] float16
+
+The levels are plain .npy files so they can be memory mapped. They are
+stored as float16, half the size of the float32 activations. A store is
+only used once meta.json says it's complete, so an interrupted build is
+redone rather than read.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+from mymrcnn import datagenerator
+
+STORE_DTYPE = np.float16
+
+
+def weights_hash(layers):
+    """sha1 of the names, shapes and values of the weights of the given
+    Keras layers. Any change to the backbone weights gives a new key.
+    """
+    digest = hashlib.sha1()
+    for layer in layers:
+        for weight, value in zip(layer.weights, layer.get_weights()):
+            digest.update(weight.name.encode("utf-8"))
+            digest.update(str(value.shape).encode("utf-8"))
+            digest.update(np.ascontiguousarray(value).tobytes())
+    return digest.hexdigest()
+
+
+def store_key(backbone, datasets, config):
+    """sha1 of what the cached features depend on: the backbone weights,
+    the image size settings and the sorted source image ids of the data
+    sets. Another split or new images give a new key, so a store always
+    holds every image it is asked for.
+    """
+    digest = hashlib.sha1(weights_hash(backbone.layers).encode("utf-8"))
+    settings = {
+        "IMAGE_SHAPE": [int(d) for d in config.IMAGE_SHAPE],
+        "IMAGE_MIN_DIM": config.IMAGE_MIN_DIM,
+        "IMAGE_MAX_DIM": config.IMAGE_MAX_DIM,
+    }
+    image_ids = sorted({str(dataset.image_info[image_id]["id"])
+                        for dataset in datasets for image_id in dataset.image_ids})
+    digest.update(json.dumps([settings, image_ids], sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class FeatureStore(object):
+    """Memory mapped feature maps of one backbone over a set of images.
+
+    cache_dir: Directory holding the stores of all backbones.
+    key: store_key() of the backbone and data sets.
+    """
+
+    def __init__(self, cache_dir, key):
+        self.path = os.path.join(cache_dir, key)
+        self.key = key
+        self.meta = None
+        self.levels = None
+        self._rows = None
+
+    def _meta_path(self):
+        return os.path.join(self.path, "meta.json")
+
+    def _level_path(self, i):
+        return os.path.join(self.path, "level_{}.npy".format(i))
+
+    @property
+    def complete(self):
+        meta_path = self._meta_path()
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            return json.load(f).get("complete", False)
+
+    def open(self):
+        """Maps a complete store read only."""
+        assert self.complete, "Feature store {} isn't built".format(self.path)
+        with open(self._meta_path()) as f:
+            self.meta = json.load(f)
+        self.levels = [np.load(self._level_path(i), mmap_mode="r")
+                       for i in range(len(self.meta["shapes"]))]
+        self._rows = {image_id: row for row, image_id in enumerate(self.meta["image_ids"])}
+        return self
+
+    def build(self, backbone, datasets, config, batch_size=None):
+        """Runs the backbone once over every image of the data sets and
+        writes its outputs.
+
+        backbone: Keras model from an image to a list of feature maps.
+        datasets: Data sets to cache. Images they share are run once.
+        batch_size: Images per backbone forward pass. Defaults to
+            config.BATCH_SIZE.
+        """
+        batch_size = batch_size or config.BATCH_SIZE
+        # Unique source ids in first seen order, and where to load them from
+        sources = []
+        seen = set()
+        for dataset in datasets:
+            for image_id in dataset.image_ids:
+                key = str(dataset.image_info[image_id]["id"])
+                if key not in seen:
+                    seen.add(key)
+                    sources.append((key, dataset, image_id))
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self._write_meta(sources, None, complete=False)
+
+        levels = None
+        for start in range(0, len(sources), batch_size):
+            chunk = sources[start:start + batch_size]
+            images = np.stack([
+                datagenerator.mold_image(
+                    datagenerator.load_image_gt(dataset, config, image_id)[0].astype(np.float32),
+                    config)
+                for _, dataset, image_id in chunk])
+            outputs = backbone.predict(images, batch_size=len(chunk))
+            if not isinstance(outputs, list):
+                outputs = [outputs]
+            if levels is None:
+                levels = [np.lib.format.open_memmap(
+                    self._level_path(i), mode="w+", dtype=STORE_DTYPE,
+                    shape=(len(sources),) + output.shape[1:])
+                    for i, output in enumerate(outputs)]
+            for level, output in zip(levels, outputs):
+                level[start:start + len(chunk)] = output.astype(STORE_DTYPE)
+            logging.info("Cached features of {}/{} images".format(
+                start + len(chunk), len(sources)))
+
+        shapes = []
+        for level in levels or []:
+            level.flush()
+            shapes.append(list(level.shape[1:]))
+        del levels
+        self._write_meta(sources, shapes, complete=True)
+        return self.open()
+
+    def _write_meta(self, sources, shapes, complete):
+        meta = {
+            "key": self.key,
+            "dtype": np.dtype(STORE_DTYPE).name,
+            "image_ids": [key for key, _, _ in sources],
+            "shapes": shapes,
+            "complete": complete,
+        }
+        # Write then rename, so readers never see half a file
+        tmp_path = self._meta_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path())
+
+    def rows(self, dataset, image_ids):
+        """Maps data set image ids to store rows."""
+        return np.array([self._rows[str(dataset.image_info[i]["id"])] for i in image_ids])
+
+    def features(self, rows, levels=None):
+        """Returns float32 feature maps [len(rows), H, W, C] for each of the
+        requested levels (indices into C2-C5, all by default).
+        """
+        levels = range(len(self.levels)) if levels is None else levels
+        # Sorted reads are sequential on the memory map
+        order = np.argsort(rows)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return [self.levels[i][rows[order]][inverse].astype(np.float32) for i in levels]
+
+
+def open_or_build(cache_dir, backbone, datasets, config, batch_size=None):
+    """Returns the store for the current backbone weights and data sets,
+    building it first if it doesn't exist yet.
+    """
+    store = FeatureStore(cache_dir, store_key(backbone, datasets, config))
+    if store.complete:
+        return store.open()
+    logging.info("Building feature store {}".format(store.path))
+    return store.build(backbone, datasets, config, batch_size=batch_size)
+
+
+def feature_generator(store, dataset, config, levels, shuffle=True, batch_size=1,
+                      load_targets=None):
+    """A generator over cached features, the counterpart of
+    datagenerator.data_generator() for head models.
+
+    levels: Indices of the cached levels to feed, in head model input order.
+    load_targets: Function (dataset, image_id) -> target array of the head,
+        dataset.load_class by default.
+
+    Augmentation isn't possible here, the features are fixed.
+
+    Yields inputs = [feature maps..., targets], outputs = []
+    """
+    load_targets = load_targets or (lambda d, i: d.load_class(i))
+    image_ids = np.copy(dataset.image_ids)
+    all_rows = store.rows(dataset, image_ids)
+    while True:
+        order = np.random.permutation(len(image_ids)) if shuffle else np.arange(len(image_ids))
+        # Drop the last partial batch, like data_generator()
+        for start in range(0, len(order) - batch_size + 1, batch_size):
+            batch = order[start:start + batch_size]
+            inputs = store.features(all_rows[batch], levels)
+            inputs.append(np.stack([load_targets(dataset, image_ids[i]) for i in batch]))
+            yield inputs, []
@@ -0,0 +1,197 @@
+"""
+Lean inference export of a trained model.
+
+With TRAIN_BN = False every BatchNorm is a fixed per-channel affine
+transform, so a BatchNorm that directly follows a Conv2D can be folded into
+that conv's kernel and bias:
+
+    scale  = gamma / sqrt(moving_variance + epsilon)
+    kernel = kernel * scale
+    bias   = (bias - moving_mean) * scale + beta
+
+export_inference_model() rebuilds a model from its outputs back to its
+inputs and:
+- folds every BatchNorm that is the only consumer of a linear Conv2D
+  (also when both are wrapped in TimeDistributed),
+- runs the BatchNorms it can't fold (e.g. after a ReLU) in inference mode,
+- drops Dropout layers,
+- drops the loss and metric Lambdas and the inputs only they read.
+
+All the other layers are reused as they are, so their weights are shared
+with the source model. Usage:
+
+    inference_model = export_inference_model(model.keras_model)
+    verify(model.keras_model, inference_model, images)
+    save_inference_model(inference_model, "inference.h5")
+"""
+
+import re
+import numpy as np
+import keras
+import keras.layers as KL
+import keras.models as KM
+
+# Output layers that only exist for training
+LOSS_LAYER_NAMES = ("class_loss_l", "mask_loss_l", "mask_acc_l")
+LOSS_LAYER_PATTERN = re.compile(r"(^|_)(loss|acc)(_|$)")
+
+
+def is_loss_layer(layer):
+    return layer.name in LOSS_LAYER_NAMES or \
+        (isinstance(layer, KL.Lambda) and LOSS_LAYER_PATTERN.search(layer.name) is not None)
+
+
+def _unwrap(layer):
+    """Returns (inner layer, True) for TimeDistributed, (layer, False) otherwise."""
+    if isinstance(layer, KL.TimeDistributed):
+        return layer.layer, True
+    return layer, False
+
+
+def _inbound_nodes(layer):
+    # Renamed to _inbound_nodes in Keras 2.1.3
+    return layer._inbound_nodes if hasattr(layer, "_inbound_nodes") else layer.inbound_nodes
+
+
+def _outbound_nodes(layer):
+    return layer._outbound_nodes if hasattr(layer, "_outbound_nodes") else layer.outbound_nodes
+
+
+def _as_list(x):
+    return x if isinstance(x, list) else [x]
+
+
+def fold_batchnorm_weights(conv, bn):
+    """Returns [kernel, bias] of conv with bn folded in.
+
+    conv: A Conv2D layer, channels last.
+    bn: The BatchNormalization layer reading conv's output.
+    """
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    bn_weights = list(bn.get_weights())
+    gamma = bn_weights.pop(0) if bn.scale else np.ones_like(bias)
+    beta = bn_weights.pop(0) if bn.center else np.zeros_like(bias)
+    moving_mean, moving_variance = bn_weights
+    scale = gamma / np.sqrt(moving_variance + bn.epsilon)
+    return [kernel * scale, (bias - moving_mean) * scale + beta]
+
+
+def _foldable(conv, bn):
+    """Can bn be folded into conv? Both already unwrapped."""
+    if type(conv) is not KL.Conv2D or not isinstance(bn, KL.BatchNormalization):
+        return False
+    if conv.data_format != "channels_last" or bn.axis not in (-1, 3, [-1], [3]):
+        return False
+    if conv.get_config()["activation"] != "linear":
+        return False
+    # The conv output must feed the BatchNorm only
+    return len(_outbound_nodes(conv)) == 1
+
+
+class _Exporter(object):
+
+    def __init__(self):
+        self.tensors = {}
+
+    def rebuild(self, tensor):
+        layer, node_index, tensor_index = tensor._keras_history
+        key = (id(layer), node_index)
+        if key not in self.tensors:
+            self.tensors[key] = self.rebuild_node(layer, node_index)
+        return self.tensors[key][tensor_index]
+
+    def rebuild_node(self, layer, node_index):
+        node = _inbound_nodes(layer)[node_index]
+        if isinstance(layer, keras.engine.InputLayer):
+            return [KL.Input(batch_shape=layer.batch_input_shape,
+                             dtype=layer.dtype, name=layer.name)]
+        inputs = [self.rebuild(t) for t in node.input_tensors]
+        if isinstance(_unwrap(layer)[0], KL.Dropout):
+            return inputs
+
+        arguments = dict(getattr(node, "arguments", None) or {})
+        inner, distributed = _unwrap(layer)
+        if isinstance(inner, KL.BatchNormalization):
+            source = node.input_tensors[0]
+            conv_layer, conv_node_index, _ = source._keras_history
+            conv, conv_distributed = _unwrap(conv_layer)
+            if conv_distributed == distributed and _foldable(conv, inner):
+                return [self.folded_conv(conv_layer, conv_node_index, inner)]
+            arguments["training"] = False
+
+        x = inputs if len(inputs) > 1 else inputs[0]
+        return _as_list(layer(x, **arguments))
+
+    def folded_conv(self, conv_layer, node_index, bn):
+        conv, distributed = _unwrap(conv_layer)
+        node = _inbound_nodes(conv_layer)[node_index]
+        inputs = [self.rebuild(t) for t in node.input_tensors]
+        config = conv.get_config()
+        config["use_bias"] = True
+        folded = KL.Conv2D.from_config(config)
+        if distributed:
+            folded = KL.TimeDistributed(folded, name=conv_layer.name)
+        output = folded(inputs[0])
+        folded.set_weights(fold_batchnorm_weights(conv, bn))
+        return output
+
+
+def export_inference_model(keras_model, name=None):
+    """Builds the lean inference model of a trained Keras model.
+
+    keras_model: The trained model. A MyBackboneModel or MaskRCNN instance
+        is accepted as well, its keras_model is used.
+    name: Optional. Name of the new model.
+
+    Returns a Keras model with the same non-loss outputs.
+    """
+    keras_model = getattr(keras_model, "keras_model", keras_model)
+    # In multi-GPU training, we wrap the model. Export the inner model.
+    keras_model = getattr(keras_model, "inner_model", keras_model)
+    exporter = _Exporter()
+    outputs = []
+    for tensor in keras_model.outputs:
+        if is_loss_layer(tensor._keras_history[0]):
+            continue
+        outputs.append(exporter.rebuild(tensor))
+    inputs = [t for t in (exporter.tensors.get((id(l), 0), [None])[0]
+                          for l in keras_model.input_layers) if t is not None]
+    return KM.Model(inputs, outputs, name=name or keras_model.name + "_inference")
+
+
+def inference_outputs(keras_model, inputs, batch_size=1):
+    """Runs the non-loss outputs of the original model, for verify()."""
+    keras_model = getattr(keras_model, "keras_model", keras_model)
+    keep = [i for i, t in enumerate(keras_model.outputs)
+            if not is_loss_layer(t._keras_history[0])]
+    names = [l.name for l in keras_model.input_layers]
+    used = [n for n in names if n in inputs]
+    model = KM.Model([keras_model.inputs[names.index(n)] for n in used],
+                     [keras_model.outputs[i] for i in keep])
+    return _as_list(model.predict([inputs[n] for n in used], batch_size=batch_size))
+
+
+def verify(keras_model, inference_model, inputs, atol=1e-4, rtol=1e-3, batch_size=1):
+    """Checks the exported model against the original one.
+
+    inputs: dict of input layer name -> array, covering the inputs of the
+        inference model.
+    Returns the largest absolute difference over all outputs. Raises
+    AssertionError if any output differs more than the tolerances.
+    """
+    expected = inference_outputs(keras_model, inputs, batch_size=batch_size)
+    actual = _as_list(inference_model.predict(
+        [inputs[l.name] for l in inference_model.input_layers], batch_size=batch_size))
+    max_diff = 0.
+    for e, a in zip(expected, actual):
+        max_diff = max(max_diff, float(np.max(np.abs(e - a))))
+        assert np.allclose(e, a, atol=atol, rtol=rtol), \
+            "Exported model differs from the original by {}".format(max_diff)
+    return max_diff
+
+
+def save_inference_model(inference_model, filepath):
+    """Writes the exported model, without any optimizer state."""
+    inference_model.save(filepath, include_optimizer=False)
@@ -1,4 +1,5 @@
 import os
+import sys
 import random
 import datetime
 import re
@@ -13,7 +14,14 @@ import keras.backend as K
 import keras.layers as KL
 import keras.engine as KE
 import keras.models as KM
+from mymrcnn import buildcache
 from mymrcnn import datagenerator
+from mymrcnn import checkpoints
+from mymrcnn import cpu_parallel
+from mymrcnn import optimizers
+from mymrcnn import samplers
+from mymrcnn import tfdata
+from mymrcnn import featurecache
 class BatchNorm(KL.BatchNormalization):
     """Extends the Keras BatchNormalization class to allow a central place
     to make changes if needed.
@@ -302,15 +310,12 @@ class FeatureTransformLayer(KE.Layer):
     def __init__(self,**kwargs):
         super(FeatureTransformLayer, self).__init__(**kwargs)
     def call(self,inputs):
-        feature_counts = len(inputs)
-        mrcnn_features = tf.concat(inputs, axis=1)
-        shapeP2 = K.int_shape(inputs[0])
-        shape = [-1 if x is None else x for x in shapeP2[:1]] + [feature_counts] + \
-        [-1 if x is None else x for x in shapeP2[1:]]
-        output = tf.reshape(mrcnn_features,shape)
+        # [batch,feature_counts,...] same as concat on axis 1 then reshape,
+        # without baking any dimension into the graph
+        output = tf.stack(inputs, axis=1)
         return output
     def compute_output_shape(self, input_shape):
-        return (1,3,595,7, 256)
+        return (input_shape[0][0],) + (len(input_shape),) + tuple(input_shape[0][1:])
 class FlatConvLayer(KE.Layer):
     def __init__(self,**kwargs):
         super(FlatConvLayer, self).__init__(**kwargs)
@@ -328,7 +333,7 @@ class FlatConvLayer(KE.Layer):
         out = tf.reshape(output,[-1,dim_2])
         return out
     def compute_output_shape(self, input_shape):
-        return (1,133280)
+        return (input_shape[0],) + (input_shape[2] * input_shape[3] * input_shape[4],)
 class SplitConcatLayer(KE.Layer):
     def __init__(self,**kwargs):
         super(SplitConcatLayer, self).__init__(**kwargs)
@@ -349,25 +354,33 @@ class SplitConcatLayer(KE.Layer):
         return (input_shape[0],) + (input_shape[1] / 2,input_shape[2] / 2) + (input_shape[3] * 4,)
 class POILayer(KE.Layer):
     #input shape is [batch,height,width,channel] (number boxesnumber)
-    def __init__(self, pool_shape,SCALE_LIST=[8,4,2,1],IMAGES_COUNT=1,**kwargs):
+    def __init__(self, pool_shape,SCALE_LIST=[8,4,2,1],**kwargs):
         super(POILayer, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
         self.scale_list = SCALE_LIST
-        self.image_count = IMAGES_COUNT
+        # [boxesnumber,(y1,x1,y2,x2)] the boxes never change, build them once
+        self.boxes = np.array(generateBoxByScaleList(self.scale_list),dtype=np.float32)
+    def get_config(self):
+        # For the build cache, the constructor arguments
+        config = super(POILayer, self).get_config()
+        config["pool_shape"] = self.pool_shape
+        config["SCALE_LIST"] = self.scale_list
+        return config
     def call(self, inputs):
-        num_boxes = np.sum([scale ** 2 for scale in self.scale_list])
         images = inputs
-        print('images',K.int_shape(images))
-        boxes = generateBoxByScaleList(self.scale_list)
-        imgTensors = []
-        for box in boxes:
-            imgTensors.append(tf.image.crop_and_resize(images,np.full([self.image_count,4],box),np.arange(self.image_count),self.pool_shape,method="bilinear"))
-        # imageTensors = lists of [batch,7,7,channel] (number boxesnumber)
-        cropedImages_concated = tf.concat(imgTensors,axis=1)
-        # haha switch to [batch,7*boxesnumber,7,channel]
-        return cropedImages_concated
+        num_boxes = self.boxes.shape[0]
+        batch = tf.shape(images)[0]
+        # one crop per (image,box) pair, image major, in a single op
+        boxes = tf.tile(tf.constant(self.boxes),[batch,1])
+        box_ind = tf.reshape(tf.tile(tf.expand_dims(tf.range(batch),1),[1,num_boxes]),[-1])
+        cropedImages = tf.image.crop_and_resize(images,boxes,box_ind,self.pool_shape,method="bilinear")
+        # [batch * boxesnumber,7,7,channel] switch to [batch,7*boxesnumber,7,channel],
+        # the same layout as concatenating the per box crops on axis 1
+        channels = K.int_shape(images)[-1]
+        return tf.reshape(cropedImages,[batch,num_boxes * self.pool_shape[0],self.pool_shape[1],
+                                         tf.shape(images)[-1] if channels is None else channels])
     def compute_output_shape(self, input_shape):
-        return (self.image_count,) + (self.pool_shape[0] * np.sum([scale ** 2 for scale in self.scale_list]),  \
+        return (input_shape[0],) + (self.pool_shape[0] * self.boxes.shape[0],  \
          self.pool_shape[1])+ (input_shape[-1], )
 def msk_class_loss_graph(y_true, y_pred):
     return  K.mean(-y_true * K.log(y_pred + 1e-9) \
@@ -384,7 +397,15 @@ class MyBackboneModel:
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
-        self.keras_model = self.buildModel(mode,config)
+        self.head_layers = None
+        self.keras_model = buildcache.cached_build(
+            lambda: self.buildModel(mode, config), mode, config, [sys.modules[__name__]])
+        # C2-C5, also when the graph came from the build cache
+        self.backbone_outputs = [self.keras_model.get_layer("dense_res_l{}b_out".format(stage)).output
+                                 for stage in range(2, 6)]
+        # and the head convs, so buildHeadModel shares keras_model's weights
+        self.head_layers = [self.keras_model.get_layer("pre_class_conv_l_1"),
+                            self.keras_model.get_layer("classifier_conv_l")]
     def buildModel(self,mode,config):
         input_image = KL.Input(
                 shape=[384, 576, config.IMAGE_SHAPE[2]], name="input_image")
@@ -396,6 +417,8 @@ class MyBackboneModel:
         
         L1, L2, L3,L4,L5 = dense_graph_simple_long(input_image,
                                              stage5=True, train_bn=config.TRAIN_BN)
+        # C2-C5, what the feature cache stores
+        self.backbone_outputs = [L2, L3, L4, L5]
         # # mrcnn_pyramid_features : 3 tensor of [batch 7 * boxnumber,7,256]
         # mrcnn_features = FeatureTransformLayer(name="transform_pyramid_pooling_layer")(mrcnn_pyramid_features)
         # #mrcnn_features : tensor of [batch 3 7 * boxnumber,7,256]
@@ -414,13 +437,10 @@ class MyBackboneModel:
         # num_boxes = np.sum([scale ** 2 for scale in config.POI_BOX_SCALES])
         # # shared = KL.Lambda(lambda x:tf.reshape(x,[config.BATCH_SIZE,3,num_boxes * 7,7,32]) )(shared)
         # P_S_all = KL.Conv2D(256, (3, 3),name='pre_class_conv_s_1',padding="same")(S4)
-        P_L_all = KL.Conv2D(256, (7, 7),name='pre_class_conv_l_1',padding="same")(L5)
         # classifierLayer_s = KL.Conv2D(config.NUM_CLASSES,(24,36),name='classifier_conv_s',padding="valid")(P_S_all)
-        classifierLayer_l = KL.Conv2D(config.NUM_CLASSES,(24,36),name='classifier_conv_l',padding="valid")(P_L_all)
         # mrcnn_class_logits_s = KL.Lambda(lambda x:K.squeeze(K.squeeze(x,axis=2),axis=1))(classifierLayer_s)
         # mrcnn_class_logits_s = KL.Activation("sigmoid")(classifierLayer_s)
-        mrcnn_class_logits_l = KL.Lambda(lambda x:K.squeeze(K.squeeze(x,axis=2),axis=1))(classifierLayer_l)
-        mrcnn_class_logits_l = KL.Activation("softmax")(classifierLayer_l)
+        mrcnn_class_logits_l, class_loss_l = self.classifier_head(L5,input_class_ids,config)
 
         #  classifierLayer_s_stopped = KL.Lambda(lambda x: K.stop_gradient(x))(mrcnn_class_logits_s)
         # classifierLayer_l_stopped = KL.Lambda(lambda x: K.stop_gradient(x))(mrcnn_class_logits_l)
@@ -432,53 +452,84 @@ class MyBackboneModel:
 
         # class_loss_s = KL.Lambda(lambda x: msk_class_loss_graph(*x), name="class_loss_s")(
         #         [input_class_ids, mrcnn_class_logits_s])
-        class_loss_l = KL.Lambda(lambda x: msk_class_loss_graph(*x), name="class_loss_l")(
-                [input_class_ids, mrcnn_class_logits_l])
         # class_loss_f = KL.Lambda(lambda x: msk_class_loss_graph(*x), name="class_loss_f")(
         #         [input_class_ids, mrcnn_class_logits_f])
         inputs = [input_image,input_class_ids]
         outputs = [mrcnn_class_logits_l,class_loss_l]
         return KM.Model(inputs, outputs, name='mask_backbone')
-    
-    def compile(self,learning_rate, momentum):
-        optimizer = keras.optimizers.SGD(
-            lr=learning_rate, momentum=momentum,
-            clipnorm=self.config.GRADIENT_CLIP_NORM)
-        self.keras_model._losses = []
-        self.keras_model._per_input_losses = {}
+    def classifier_head(self,feature,input_class_ids,config):
+        """Builds the classifier head on a C5 feature map.
+        The conv layers are created once and shared, so the full model and
+        the cached feature head model train the same weights.
+        Returns: [class probabilities, class loss]
+        """
+        if self.head_layers is None:
+            self.head_layers = [
+                KL.Conv2D(256, (7, 7),name='pre_class_conv_l_1',padding="same"),
+                KL.Conv2D(config.NUM_CLASSES,(24,36),name='classifier_conv_l',padding="valid")]
+        pre_class_conv,classifier_conv = self.head_layers
+        P_L_all = pre_class_conv(feature)
+        classifierLayer_l = classifier_conv(P_L_all)
+        mrcnn_class_logits_l = KL.Activation("softmax")(classifierLayer_l)
+        class_loss_l = KL.Lambda(lambda x: msk_class_loss_graph(*x), name="class_loss_l")(
+                [input_class_ids, mrcnn_class_logits_l])
+        return mrcnn_class_logits_l,class_loss_l
+    def buildBackboneModel(self):
+        """The frozen part of the network: input image to C2-C5."""
+        return KM.Model(self.keras_model.input[0], self.backbone_outputs, name='dense_res_l_backbone')
+    def buildHeadModel(self):
+        """The classifier head on its own. Takes a cached C5 feature map
+        instead of an image and shares its weights with keras_model.
+        """
+        input_feature = KL.Input(
+                shape=K.int_shape(self.backbone_outputs[-1])[1:], name="input_backbone_feature")
+        input_class_ids = KL.Input(
+            shape=[self.config.NUM_CLASSES], name="input_image_class_id")
+        mrcnn_class_logits_l, class_loss_l = self.classifier_head(input_feature,input_class_ids,self.config)
+        return KM.Model([input_feature,input_class_ids],[mrcnn_class_logits_l,class_loss_l],
+                        name='classifier_head')
+    def compile(self,learning_rate, momentum, keras_model=None):
+        """keras_model: Optional. The model to compile, keras_model by
+        default. The head model from buildHeadModel() compiles the same way.
+        """
+        if keras_model is None:
+            keras_model = self.keras_model
+        optimizer = optimizers.training_optimizer(learning_rate, momentum, self.config)
+        keras_model._losses = []
+        keras_model._per_input_losses = {}
         loss_names = ["class_loss_l"]
         for name in loss_names:
-            layer = self.keras_model.get_layer(name)
-            if layer.output in self.keras_model.losses:
+            layer = keras_model.get_layer(name)
+            if layer.output in keras_model.losses:
                 continue
             loss = (
                     tf.reduce_mean(layer.output, keepdims=True)
                     * self.config.LOSS_WEIGHTS.get(name, 1.))
-            self.keras_model.add_loss(loss)
+            keras_model.add_loss(loss)
         reg_losses = [
             keras.regularizers.l2(self.config.WEIGHT_DECAY)(w) / tf.cast(tf.size(w), tf.float32)
-            for w in self.keras_model.trainable_weights
+            for w in keras_model.trainable_weights
                 if 'gamma' not in w.name and 'beta' not in w.name]
-        self.keras_model.add_loss(tf.add_n(reg_losses))
-        self.keras_model.compile(
+        keras_model.add_loss(tf.add_n(reg_losses))
+        keras_model.compile(
                 optimizer=optimizer,
-                loss=[None] * len(self.keras_model.outputs))
+                loss=[None] * len(keras_model.outputs))
         # Add metrics for losses
         for name in loss_names:
-            if name in self.keras_model.metrics_names:
+            if name in keras_model.metrics_names:
                 continue
-            layer = self.keras_model.get_layer(name)
-            self.keras_model.metrics_names.append(name)
+            layer = keras_model.get_layer(name)
+            keras_model.metrics_names.append(name)
             loss = (
                 tf.reduce_mean(layer.output, keepdims=True)
                 * self.config.LOSS_WEIGHTS.get(name, 1.))
-            self.keras_model.metrics_tensors.append(loss)
+            keras_model.metrics_tensors.append(loss)
         #add binary acc
-            class_input = self.keras_model.input[1]
-            class_pred_l = self.keras_model.output[0]
-            self.keras_model.metrics_names.append("catlacc")
+            class_input = keras_model.input[1]
+            class_pred_l = keras_model.output[0]
+            keras_model.metrics_names.append("catlacc")
             catlacc = K.mean(K.equal(K.argmax(class_input, axis=-1), K.argmax(class_pred_l, axis=-1)))
-            self.keras_model.metrics_tensors.append(catlacc)
+            keras_model.metrics_tensors.append(catlacc)
     def set_log_dir(self, model_path=None):
         """Sets the model log directory and epoch counter.
 
@@ -522,72 +573,20 @@ class MyBackboneModel:
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exclude: list of layer names to exclude
+        The layer layout of the file is cached next to it, see
+        checkpoints.load_weights().
         """
-        import h5py
-        # Conditional import to support versions of Keras before 2.2
-        # TODO: remove in about 6 months (end of 2018)
-        try:
-            from keras.engine import saving
-        except ImportError:
-            # Keras before 2.2 used the 'topology' namespace.
-            from keras.engine import topology as saving
-
-        if exclude:
-            by_name = True
-
-        if h5py is None:
-            raise ImportError('`load_weights` requires h5py.')
-        f = h5py.File(filepath, mode='r')
-        if 'layer_names' not in f.attrs and 'model_weights' in f:
-            f = f['model_weights']
-
-        # In multi-GPU training, we wrap the model. Get layers
-        # of the inner model because they have the weights.
-        keras_model = self.keras_model
-        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
-            else keras_model.layers
-
-        # Exclude some layers
-        if exclude:
-            layers = filter(lambda l: l.name not in exclude, layers)
-
-        if by_name:
-            saving.load_weights_from_hdf5_group_by_name(f, layers)
-        else:
-            saving.load_weights_from_hdf5_group(f, layers)
-        if hasattr(f, 'close'):
-            f.close()
+        checkpoints.load_weights(self.keras_model, filepath, by_name=by_name, exclude=exclude)
 
         # Update the log directory
         self.set_log_dir(filepath)
     def find_last(self):
         """Finds the last checkpoint file of the last trained model in the
-        model directory.
+        model directory, from the checkpoint index of the directory.
         Returns:
             The path of the last checkpoint file
         """
-        # Get directory names. Each directory corresponds to a model
-        dir_names = next(os.walk(self.model_dir))[1]
-        key = self.config.NAME.lower()
-        dir_names = filter(lambda f: f.startswith(key), dir_names)
-        dir_names = sorted(dir_names)
-        if not dir_names:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT,
-                "Could not find model directory under {}".format(self.model_dir))
-        # Pick last directory
-        dir_name = os.path.join(self.model_dir, dir_names[-1])
-        # Find the last checkpoint
-        checkpoints = next(os.walk(dir_name))[2]
-        checkpoints = filter(lambda f: f.startswith("mask_rcnn"), checkpoints)
-        checkpoints = sorted(checkpoints)
-        if not checkpoints:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT, "Could not find weight files in {}".format(dir_name))
-        checkpoint = os.path.join(dir_name, checkpoints[-1])
-        return checkpoint
+        return checkpoints.CheckpointIndex(self.model_dir).last(self.config.NAME.lower())
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
               augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
@@ -633,13 +632,42 @@ class MyBackboneModel:
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_generator = datagenerator.data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        if self.config.CPU_WORKERS > 1:
+            # Data parallel over local worker processes, see cpu_parallel
+            cpu_parallel.train(self, datagenerator.data_generator, train_dataset, val_dataset,
+                               learning_rate, epochs, self.config.CPU_WORKERS,
+                               train_kwargs=dict(augmentation=augmentation,
+                                                 no_augmentation_sources=no_augmentation_sources))
+            return
+
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        else:
+            workers = multiprocessing.cpu_count()
+        if self.config.INPUT_PIPELINE == "tf.data":
+            # TensorFlow threads load the batches, see tfdata
+            assert augmentation is None, "The tf.data pipeline has no imgaug augmentation"
+            workers = 0
+
+        # Data generators. The sampler continues the sample order of the
+        # checkpoint this run resumes from, one shard per Keras worker, so
+        # there can't be more workers than images.
+        workers = min(workers, len(train_dataset.image_ids))
+        sampler = samplers.resume(self, train_dataset, workers=max(1, workers))
+        if self.config.INPUT_PIPELINE == "tf.data":
+            train_generator, val_generator = tfdata.training_generators(
+                train_dataset, val_dataset, self.config, sampler=sampler)
+        else:
+            train_generator = datagenerator.data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources,
+                                             sampler=sampler)
+            val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -649,8 +677,8 @@ class MyBackboneModel:
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
                                         histogram_freq=0, write_graph=True, write_images=False),
-            keras.callbacks.ModelCheckpoint(self.checkpoint_path,
-                                            verbose=0, save_weights_only=True),
+            checkpoints.checkpoint_callback(self.model_dir, self.checkpoint_path, self.config,
+                                            sampler=sampler),
         ]
         
         # Add custom callbacks to the list
@@ -663,14 +691,6 @@ class MyBackboneModel:
         #self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
-
         self.keras_model.fit_generator(
             train_generator,
             initial_epoch=self.epoch,
@@ -681,7 +701,64 @@ class MyBackboneModel:
             validation_steps=self.config.VALIDATION_STEPS,
             max_queue_size=100,
             workers=workers,
-            use_multiprocessing=True,
+            use_multiprocessing=workers > 0,
+        )
+        self.epoch = max(self.epoch, epochs)
+
+    def train_heads_cached(self, train_dataset, val_dataset, learning_rate, epochs,
+                           cache_dir=None, custom_callbacks=None):
+        """Train only the classifier head, reading the backbone features from
+        a FeatureStore instead of running the backbone on every step.
+        The store is keyed by the backbone weights and the data set images,
+        and built on first use, so changing either builds a new one.
+        cache_dir: Where the stores live. Defaults to <model_dir>/feature_cache.
+        Augmentation is not supported, the cached features are fixed.
+        Checkpoints hold the head weights only. They go in their own run
+        directory, heads_<run>, which find_last() doesn't consider. Load
+        them by name into the full model.
+        """
+        assert self.mode == "training", "Create model in training mode."
+        cache_dir = cache_dir or os.path.join(self.model_dir, "feature_cache")
+        store = featurecache.open_or_build(cache_dir, self.buildBackboneModel(),
+                                           [train_dataset, val_dataset], self.config)
+        head_model = self.buildHeadModel()
+        # C5 only, the head doesn't read the other levels
+        levels = [len(self.backbone_outputs) - 1]
+        train_generator = featurecache.feature_generator(store, train_dataset, self.config, levels,
+                                                         shuffle=True, batch_size=self.config.BATCH_SIZE)
+        val_generator = featurecache.feature_generator(store, val_dataset, self.config, levels,
+                                                       shuffle=True, batch_size=self.config.BATCH_SIZE)
+
+        # The run directory doesn't start with the config name, so the index
+        # never gives a head only checkpoint as the last one of the model
+        head_log_dir = os.path.join(self.model_dir, "heads_" + os.path.basename(self.log_dir))
+        head_checkpoint_path = os.path.join(head_log_dir, os.path.basename(self.checkpoint_path))
+        if not os.path.exists(head_log_dir):
+            os.makedirs(head_log_dir)
+        callbacks = [
+            keras.callbacks.TensorBoard(log_dir=head_log_dir,
+                                        histogram_freq=0, write_graph=True, write_images=False),
+            checkpoints.checkpoint_callback(self.model_dir, head_checkpoint_path, self.config),
+        ]
+        if custom_callbacks:
+            callbacks += custom_callbacks
+
+        log("\nStarting cached head training at epoch {}. LR={}\n".format(self.epoch, learning_rate))
+        log("Feature store: {}".format(store.path))
+        log("Checkpoint Path: {}".format(head_checkpoint_path))
+        self.compile(learning_rate, self.config.LEARNING_MOMENTUM, keras_model=head_model)
+        # Batches are slices of a memory map, one reader thread is enough
+        head_model.fit_generator(
+            train_generator,
+            initial_epoch=self.epoch,
+            epochs=epochs,
+            steps_per_epoch=self.config.STEPS_PER_EPOCH,
+            callbacks=callbacks,
+            validation_data=val_generator,
+            validation_steps=self.config.VALIDATION_STEPS,
+            max_queue_size=100,
+            workers=1,
+            use_multiprocessing=False,
         )
         self.epoch = max(self.epoch, epochs)
 
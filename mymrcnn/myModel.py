@@ -77,6 +77,13 @@ def msk_class_loss_graph(input_class_id, pred_class_logits):
 def mrcnn_mask_loss_graph(reshaped_input_gt_true_mask, pred_masks):
     return K.binary_crossentropy(target=reshaped_input_gt_true_mask, output=pred_masks)
 
+def crop_whole_images(images, crop_size):
+    """crop_and_resize every image of the batch with the box [0,0,1,1].
+    The boxes are built from the runtime batch size.
+    """
+    batch = tf.shape(images)[0]
+    boxes = tf.tile(tf.constant([[0., 0., 1., 1.]]),[batch,1])
+    return tf.image.crop_and_resize(images,boxes,tf.range(batch),crop_size)
 class MyMRCNN_Model():
     def __init__(self, mode, config, model_dir,backboneModel):
         """
@@ -102,13 +109,8 @@ class MyMRCNN_Model():
 
         LastConvLayer = self.backboneModel.get_layer("mrcnn_class_bn2_shared")
         shared = KL.Activation('relu')(LastConvLayer)
-        boxBounds = []
-        for i in range(config.BATCH_SIZE):
-            boxBounds.append([0, 0, 1, 1])
-        
-        maskPredLayer = KL.TimeDistributed(KL.Lambda(lambda x: tf.image.crop_and_resize(
-                x,boxBounds,np.arange(config.BATCH_SIZE),[14,14],
-                method="bilinear"),name="added_mask_pred_layer"))(shared)
+        maskPredLayer = KL.TimeDistributed(KL.Lambda(lambda x: crop_whole_images(x,[14,14]),
+                name="added_mask_pred_layer"))(shared)
     
         maskLayer = KL.TimeDistributed(KL.Conv2D(32, (3, 3), padding="same"),
                            name="mrcnn_mask_conv1")(maskPredLayer)
@@ -498,13 +500,9 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
 
     # put it here, to see if the mask is need to be resized
-    image, window, scale, padding, crop = utils.resize_image(
-        image,
-        min_dim=config.IMAGE_MIN_DIM,
-        min_scale=config.IMAGE_MIN_SCALE,
-        max_dim=config.IMAGE_MAX_DIM,
-        mode=config.IMAGE_RESIZE_MODE)
-    mask = utils.resize_mask(mask, scale, padding, crop)
+    plan = utils.get_resize_plan(image.shape, config)
+    image, window, scale, padding, crop = plan.resize_image(image)
+    mask = plan.resize_mask(mask, crop)
 
     # Random horizontal flips.
     # TODO: will be removed in a future update in favor of augmentation
@@ -567,7 +565,7 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
 
     # Resize masks to smaller size to reduce memory usage
     if use_mini_mask:
-        mask = utils.minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
+        mask = utils.batch_minimize_mask(bbox, mask, config.MINI_MASK_SHAPE)
 
     # Image meta data
 
@@ -1,4 +1,5 @@
 import os
+import sys
 import random
 import datetime
 import re
@@ -13,7 +14,13 @@ import keras.backend as K
 import keras.layers as KL
 import keras.engine as KE
 import keras.models as KM
+from mymrcnn import buildcache
 from mymrcnn import datagenerator
+from mymrcnn import checkpoints
+from mymrcnn import cpu_parallel
+from mymrcnn import optimizers
+from mymrcnn import samplers
+from mymrcnn import tfdata
 class BatchNorm(KL.BatchNormalization):
     """Extends the Keras BatchNormalization class to allow a central place
     to make changes if needed.
@@ -148,6 +155,13 @@ def resnet_graph(input_image,stage4=True, train_bn=True):
     C4 = x
     return [C1, C2, C3, C4]
 
+def crop_whole_images(images, crop_size):
+    """crop_and_resize every image of the batch with the box [0,0,1,1].
+    The boxes are built from the runtime batch size.
+    """
+    batch = tf.shape(images)[0]
+    boxes = tf.tile(tf.constant([[0., 0., 1., 1.]]),[batch,1])
+    return tf.image.crop_and_resize(images,boxes,tf.range(batch),crop_size)
 def generateBoxByScaleList(lst):
     boxes = []
     for scale in lst:
@@ -159,15 +173,12 @@ class FeatureTransformLayer(KE.Layer):
     def __init__(self,**kwargs):
         super(FeatureTransformLayer, self).__init__(**kwargs)
     def call(self,inputs):
-        feature_counts = len(inputs)
-        mrcnn_features = tf.concat(inputs, axis=1)
-        shapeP2 = K.int_shape(inputs[0])
-        shape = [-1 if x is None else x for x in shapeP2[:1]] + [feature_counts] + \
-        [-1 if x is None else x for x in shapeP2[1:]]
-        output = tf.reshape(mrcnn_features,shape)
+        # [batch,feature_counts,...] same as concat on axis 1 then reshape,
+        # without baking any dimension into the graph
+        output = tf.stack(inputs, axis=1)
         return output
     def compute_output_shape(self, input_shape):
-        return (input_shape[0][0],) + (len(input_shape),) + (input_shape[0][1:])
+        return (input_shape[0][0],) + (len(input_shape),) + tuple(input_shape[0][1:])
 
 class ConcatFeatureLayer(KE.Layer):
     def __init__(self,**kwargs):
@@ -205,7 +216,7 @@ class FlatConvLayer(KE.Layer):
         out = tf.reshape(output,[-1,dim_2])
         return out
     def compute_output_shape(self, input_shape):
-        return (1,) + (input_shape[1] *input_shape[2] *input_shape[3],)
+        return (input_shape[0],) + (input_shape[2] * input_shape[3] * input_shape[4],)
 def mrcnn_mask_loss_graph(reshaped_input_gt_true_mask, pred_masks):
     return K.mean(K.binary_crossentropy(target=reshaped_input_gt_true_mask, output=pred_masks))
 def msk_loss_graph(pred_mask,true_mask,num_classes,batchSize):
@@ -252,7 +263,8 @@ class MyBackboneModel:
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
-        self.keras_model = self.buildModel(mode,config)
+        self.keras_model = buildcache.cached_build(
+            lambda: self.buildModel(mode, config), mode, config, [sys.modules[__name__]])
     def buildModel(self,mode,config):
         input_image = KL.Input(
                 shape=[384, 576, config.IMAGE_SHAPE[2]], name="input_image")
@@ -275,9 +287,9 @@ class MyBackboneModel:
         P4_Conv = KL.Conv2D(512, (3, 3), name='fpn_p4conv',padding="same")(P4_Cat)
         P4_Conv = BatchNorm(name='fpn_bn_p4conv')(P4_Conv, training=config.TRAIN_BN)
 
-        P4 = KL.Lambda(lambda x:tf.image.crop_and_resize(x,np.full([config.BATCH_SIZE,4],[0.,0.,1.,1.]),np.arange(config.BATCH_SIZE),config.MASK_SHAPE))(P4_Conv)
-        P3 = KL.Lambda(lambda x:tf.image.crop_and_resize(x,np.full([config.BATCH_SIZE,4],[0.,0.,1.,1.]),np.arange(config.BATCH_SIZE),config.MASK_SHAPE))(P3_Conv)
-        P2 = KL.Lambda(lambda x:tf.image.crop_and_resize(x,np.full([config.BATCH_SIZE,4],[0.,0.,1.,1.]),np.arange(config.BATCH_SIZE),config.MASK_SHAPE))(P2_Conv)
+        P4 = KL.Lambda(lambda x:crop_whole_images(x,config.MASK_SHAPE))(P4_Conv)
+        P3 = KL.Lambda(lambda x:crop_whole_images(x,config.MASK_SHAPE))(P3_Conv)
+        P2 = KL.Lambda(lambda x:crop_whole_images(x,config.MASK_SHAPE))(P2_Conv)
         share = ConcatFeatureLayer(name="fpn_p2p3p4concat")([P2,P3,P4])
         mask_output = KL.Conv2D(config.NUM_CLASSES, (7, 7),padding="same",name="mrcnn_class_conv_mask_graph_7")(share)
         mask_output = KL.Activation('sigmoid')(mask_output)
@@ -315,9 +327,7 @@ class MyBackboneModel:
         # mask_layer = KL.Lambda(lambda x:concatFeatures(x),name="concat_feacture_layer")(mask_layer)
     
     def compile(self,learning_rate, momentum):
-        optimizer = keras.optimizers.SGD(
-            lr=learning_rate, momentum=momentum,
-            clipnorm=self.config.GRADIENT_CLIP_NORM)
+        optimizer = optimizers.training_optimizer(learning_rate, momentum, self.config)
         self.keras_model._losses = []
         self.keras_model._per_input_losses = {}
         loss_names = ["mask_loss"]
@@ -396,72 +406,20 @@ class MyBackboneModel:
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exclude: list of layer names to exclude
+        The layer layout of the file is cached next to it, see
+        checkpoints.load_weights().
         """
-        import h5py
-        # Conditional import to support versions of Keras before 2.2
-        # TODO: remove in about 6 months (end of 2018)
-        try:
-            from keras.engine import saving
-        except ImportError:
-            # Keras before 2.2 used the 'topology' namespace.
-            from keras.engine import topology as saving
-
-        if exclude:
-            by_name = True
-
-        if h5py is None:
-            raise ImportError('`load_weights` requires h5py.')
-        f = h5py.File(filepath, mode='r')
-        if 'layer_names' not in f.attrs and 'model_weights' in f:
-            f = f['model_weights']
-
-        # In multi-GPU training, we wrap the model. Get layers
-        # of the inner model because they have the weights.
-        keras_model = self.keras_model
-        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
-            else keras_model.layers
-
-        # Exclude some layers
-        if exclude:
-            layers = filter(lambda l: l.name not in exclude, layers)
-
-        if by_name:
-            saving.load_weights_from_hdf5_group_by_name(f, layers)
-        else:
-            saving.load_weights_from_hdf5_group(f, layers)
-        if hasattr(f, 'close'):
-            f.close()
+        checkpoints.load_weights(self.keras_model, filepath, by_name=by_name, exclude=exclude)
 
         # Update the log directory
         self.set_log_dir(filepath)
     def find_last(self):
         """Finds the last checkpoint file of the last trained model in the
-        model directory.
+        model directory, from the checkpoint index of the directory.
         Returns:
             The path of the last checkpoint file
         """
-        # Get directory names. Each directory corresponds to a model
-        dir_names = next(os.walk(self.model_dir))[1]
-        key = self.config.NAME.lower()
-        dir_names = filter(lambda f: f.startswith(key), dir_names)
-        dir_names = sorted(dir_names)
-        if not dir_names:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT,
-                "Could not find model directory under {}".format(self.model_dir))
-        # Pick last directory
-        dir_name = os.path.join(self.model_dir, dir_names[-1])
-        # Find the last checkpoint
-        checkpoints = next(os.walk(dir_name))[2]
-        checkpoints = filter(lambda f: f.startswith("mask_rcnn"), checkpoints)
-        checkpoints = sorted(checkpoints)
-        if not checkpoints:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT, "Could not find weight files in {}".format(dir_name))
-        checkpoint = os.path.join(dir_name, checkpoints[-1])
-        return checkpoint
+        return checkpoints.CheckpointIndex(self.model_dir).last(self.config.NAME.lower())
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
               augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
@@ -507,13 +465,42 @@ class MyBackboneModel:
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
 
-        # Data generators
-        train_generator = datagenerator.data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        if self.config.CPU_WORKERS > 1:
+            # Data parallel over local worker processes, see cpu_parallel
+            cpu_parallel.train(self, datagenerator.data_generator, train_dataset, val_dataset,
+                               learning_rate, epochs, self.config.CPU_WORKERS,
+                               train_kwargs=dict(augmentation=augmentation,
+                                                 no_augmentation_sources=no_augmentation_sources))
+            return
+
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        else:
+            workers = multiprocessing.cpu_count()
+        if self.config.INPUT_PIPELINE == "tf.data":
+            # TensorFlow threads load the batches, see tfdata
+            assert augmentation is None, "The tf.data pipeline has no imgaug augmentation"
+            workers = 0
+
+        # Data generators. The sampler continues the sample order of the
+        # checkpoint this run resumes from, one shard per Keras worker, so
+        # there can't be more workers than images.
+        workers = min(workers, len(train_dataset.image_ids))
+        sampler = samplers.resume(self, train_dataset, workers=max(1, workers))
+        if self.config.INPUT_PIPELINE == "tf.data":
+            train_generator, val_generator = tfdata.training_generators(
+                train_dataset, val_dataset, self.config, sampler=sampler)
+        else:
+            train_generator = datagenerator.data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources,
+                                             sampler=sampler)
+            val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -523,8 +510,8 @@ class MyBackboneModel:
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
                                         histogram_freq=0, write_graph=True, write_images=False),
-            keras.callbacks.ModelCheckpoint(self.checkpoint_path,
-                                            verbose=0, save_weights_only=True),
+            checkpoints.checkpoint_callback(self.model_dir, self.checkpoint_path, self.config,
+                                            sampler=sampler),
         ]
         
         # Add custom callbacks to the list
@@ -537,14 +524,6 @@ class MyBackboneModel:
         #self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
-
         self.keras_model.fit_generator(
             train_generator,
             initial_epoch=self.epoch,
@@ -555,7 +534,7 @@ class MyBackboneModel:
             validation_steps=self.config.VALIDATION_STEPS,
             max_queue_size=100,
             workers=workers,
-            use_multiprocessing=True,
+            use_multiprocessing=workers > 0,
         )
         self.epoch = max(self.epoch, epochs)
 
@@ -0,0 +1,134 @@
+"""
+Gradient accumulation for any Keras optimizer.
+
+A 384x576 batch of one image is about what fits, so a larger batch is
+simulated by summing the gradients of ACCUMULATION_STEPS batches and
+applying their mean once. The graph still holds one batch.
+
+AccumulateOptimizer wraps an optimizer (SGD with momentum by default here).
+The wrapped optimizer builds its updates as usual from the averaged
+gradients, but every variable update it makes only takes effect on the
+last batch of a cycle. So momentum, the iteration count and lr decay all
+advance once per effective batch. clipnorm and clipvalue of the wrapped
+optimizer apply to the averaged gradients, as they would for the large
+batch.
+
+BatchNorm: with TRAIN_BN = False (the default) the moving statistics are
+frozen, and gamma and beta are ordinary weights, so accumulation is exact.
+When BN layers train, their moving averages still update on every batch
+with statistics of that batch only. Keep TRAIN_BN = False when
+accumulating.
+"""
+
+import contextlib
+import keras
+import keras.backend as K
+import tensorflow as tf
+
+
+@contextlib.contextmanager
+def _gated_updates(condition):
+    """Makes the K.update* calls in the block only write when condition
+    is true, and leave the variable as it is otherwise.
+    """
+    update, update_add, update_sub = K.update, K.update_add, K.update_sub
+
+    def gated_update(x, new_x):
+        return update(x, K.switch(condition, new_x, x))
+
+    def gated_update_add(x, increment):
+        return update_add(x, K.cast(condition, K.dtype(x)) * increment)
+
+    def gated_update_sub(x, decrement):
+        return update_sub(x, K.cast(condition, K.dtype(x)) * decrement)
+
+    K.update, K.update_add, K.update_sub = gated_update, gated_update_add, gated_update_sub
+    try:
+        yield
+    finally:
+        K.update, K.update_add, K.update_sub = update, update_add, update_sub
+
+
+def _clip(grads, optimizer):
+    """The clipping of Optimizer.get_gradients, on given gradients."""
+    if getattr(optimizer, "clipnorm", 0) > 0:
+        norm = K.sqrt(sum([K.sum(K.square(g)) for g in grads]))
+        grads = [keras.optimizers.clip_norm(g, optimizer.clipnorm, norm) for g in grads]
+    if getattr(optimizer, "clipvalue", 0) > 0:
+        grads = [K.clip(g, -optimizer.clipvalue, optimizer.clipvalue) for g in grads]
+    return grads
+
+
+class AccumulateOptimizer(keras.optimizers.Optimizer):
+    """Applies the mean gradient of every `steps` batches with the wrapped
+    optimizer.
+
+    optimizer: A Keras optimizer instance or name.
+    steps: Batches per update. 1 behaves like the wrapped optimizer.
+    """
+
+    def __init__(self, optimizer, steps, **kwargs):
+        if steps < 1:
+            raise ValueError("steps must be >= 1")
+        super(AccumulateOptimizer, self).__init__(**kwargs)
+        self.optimizer = keras.optimizers.get(optimizer)
+        self.steps = steps
+        with K.name_scope(self.__class__.__name__):
+            self.iterations = K.variable(0, dtype='int64', name='iterations')
+
+    # Learning rate callbacks set the rate of the wrapped optimizer
+    @property
+    def lr(self):
+        return self.optimizer.lr
+
+    @lr.setter
+    def lr(self, value):
+        self.optimizer.lr = value
+
+    def get_updates(self, loss, params):
+        # Unclipped, the wrapper has no clipnorm of its own
+        grads = self.get_gradients(loss, params)
+        accumulators = [K.zeros(K.int_shape(p), dtype=K.dtype(p)) for p in params]
+        # Apply on the last batch of each cycle
+        apply = K.equal((self.iterations + 1) % self.steps, 0)
+        averaged = [(a + g) / float(self.steps) for a, g in zip(accumulators, grads)]
+        averaged = _clip(averaged, self.optimizer)
+
+        inner = self.optimizer
+        inner.get_gradients = lambda loss, params: averaged
+        with _gated_updates(apply):
+            inner_updates = inner.get_updates(loss, params)
+
+        # Reset the sums once the wrapped optimizer has read them
+        keep = 1. - K.cast(apply, K.floatx())
+        with tf.control_dependencies(inner_updates):
+            self.updates = [K.update(a, keep * (a + g)) for a, g in zip(accumulators, grads)]
+            self.updates.append(K.update_add(self.iterations, 1))
+        self.updates += inner_updates
+        self.weights = [self.iterations] + accumulators + inner.weights
+        return self.updates
+
+    def get_config(self):
+        config = {"optimizer": keras.optimizers.serialize(self.optimizer),
+                  "steps": self.steps}
+        base_config = super(AccumulateOptimizer, self).get_config()
+        return dict(list(base_config.items()) + list(config.items()))
+
+    @classmethod
+    def from_config(cls, config):
+        config = dict(config)
+        optimizer = keras.optimizers.deserialize(config.pop("optimizer"))
+        return cls(optimizer, **config)
+
+
+def training_optimizer(learning_rate, momentum, config):
+    """The optimizer of MyBackboneModel.compile(): SGD with momentum and
+    clipnorm, accumulated over config.ACCUMULATION_STEPS batches.
+    """
+    optimizer = keras.optimizers.SGD(
+        lr=learning_rate, momentum=momentum,
+        clipnorm=config.GRADIENT_CLIP_NORM)
+    steps = getattr(config, "ACCUMULATION_STEPS", 1)
+    if steps > 1:
+        optimizer = AccumulateOptimizer(optimizer, steps)
+    return optimizer
@@ -0,0 +1,315 @@
+"""
+Static memory and FLOPs planner of a built Keras graph.
+
+A config that doesn't fit (IMAGE_SHAPE, POI_BOX_SCALES, MASK_SHAPE,
+BATCH_SIZE, ...) otherwise shows up as an out of memory error mid-epoch.
+plan() walks the graph of a MyBackboneModel or MaskRCNN once it is built,
+before any session runs, and counts per layer:
+
+- activations: the outputs of every call of the layer, per image,
+- parameters: its weights, and for training their gradients and
+  optimizer slots (SGD momentum, the AccumulateOptimizer accumulators),
+- FLOPs: 2 x the multiply-adds of the layers with kernels (convs, dense
+  and TimeDistributed of those), per image. The other layers are memory
+  bound and not counted.
+
+Training keeps every activation for the backward pass and as much again
+for its gradient, so an image costs about twice its activations. From
+that fit() gives the largest batch that fits a RAM budget, and
+recommend() splits the effective batch of the config into a batch and
+ACCUMULATION_STEPS that fit.
+
+Nested models (the MaskRCNN RPN) are counted from their call input, as
+stride 1 layers at the input resolution, which is what the RPN is.
+Dimensions that are only known at run time (e.g. the detections of
+inference graphs) count as 0, such layers are listed as unknown.
+
+    config.display(model)                 # the plan under the config values
+    print(plan(model.keras_model, config).format(ram_gb=16))
+
+This module only depends on Keras, mrcnn/planner.py is a copy of it.
+"""
+
+import os
+import math
+import numpy as np
+import keras.backend as K
+import keras.layers as KL
+import keras.models as KM
+
+GB = 1024. ** 3
+
+
+def _as_list(x):
+    return x if isinstance(x, list) else [x]
+
+
+def _inbound_nodes(layer):
+    # Renamed to _inbound_nodes in Keras 2.1.3
+    return layer._inbound_nodes if hasattr(layer, "_inbound_nodes") else layer.inbound_nodes
+
+
+def _model_nodes(keras_model):
+    """Node keys of the calls made inside the model, None if unknown."""
+    nodes = getattr(keras_model, "_network_nodes", None)
+    return nodes if nodes is not None else getattr(keras_model, "container_nodes", None)
+
+
+def _calls(layer, nodes):
+    """(input shapes, output tensors) of each call of the layer in a model."""
+    for index, node in enumerate(_inbound_nodes(layer)):
+        if nodes is not None and "{}_ib-{}".format(layer.name, index) not in nodes:
+            continue
+        yield [K.int_shape(t) for t in _as_list(node.input_tensors)], _as_list(node.output_tensors)
+
+
+def _size(shape):
+    """Elements per image, None if a dimension is unknown."""
+    if shape is None or any(d is None for d in shape[1:]):
+        return None
+    return int(np.prod(shape[1:]))
+
+
+def _positions(shape):
+    """Output positions per image, the dimensions between batch and channels."""
+    if shape is None or any(d is None for d in shape[1:-1]):
+        return None
+    return int(np.prod(shape[1:-1])) if len(shape) > 2 else 1
+
+
+def _kernel_size(layer):
+    return sum(int(np.prod(K.int_shape(w))) for w in layer.weights if len(K.int_shape(w)) >= 2)
+
+
+def layer_flops(layer, input_shapes, output_shape):
+    """FLOPs of one call of the layer per image, None if unknown."""
+    kernel = _kernel_size(layer)
+    if not kernel:
+        return 0
+    inner = layer.layer if isinstance(layer, KL.TimeDistributed) else layer
+    if isinstance(inner, KL.Conv2DTranspose):
+        positions = _positions(input_shapes[0])
+    elif isinstance(layer, KM.Model):
+        positions = _positions(input_shapes[0])
+    else:
+        positions = _positions(output_shape)
+    return None if positions is None else 2 * positions * kernel
+
+
+def _itemsize(tensor):
+    try:
+        return np.dtype(K.dtype(tensor)).itemsize
+    except TypeError:
+        return 4
+
+
+def _nested_activations(model, input_shape):
+    """Bytes per image of the layers inside a nested model called on input_shape."""
+    positions = _positions(input_shape)
+    if positions is None:
+        return None
+    total = 0
+    for layer in model.layers:
+        if isinstance(layer, KL.InputLayer):
+            continue
+        for output in _as_list(layer.get_output_at(0)):
+            total += positions * (K.int_shape(output)[-1] or 0) * _itemsize(output)
+    return total
+
+
+class LayerPlan(object):
+    """Per image activation bytes and FLOPs of a layer, over all its calls,
+    and its parameters.
+    """
+
+    def __init__(self, layer, nodes):
+        self.name = layer.name
+        self.class_name = layer.__class__.__name__
+        self.parameters = int(sum(K.count_params(w) for w in layer.weights))
+        self.trainable = int(sum(K.count_params(w) for w in layer.trainable_weights))
+        self.activation_bytes = 0
+        self.flops = 0
+        self.unknown = False
+        self.output_shapes = []
+        for input_shapes, outputs in _calls(layer, nodes):
+            for output in outputs:
+                shape = K.int_shape(output)
+                self.output_shapes.append(shape)
+                size = _size(shape)
+                if size is None:
+                    self.unknown = True
+                else:
+                    self.activation_bytes += size * _itemsize(output)
+            if isinstance(layer, KM.Model) and input_shapes:
+                nested = _nested_activations(layer, input_shapes[0])
+                if nested is None:
+                    self.unknown = True
+                else:
+                    self.activation_bytes += nested
+            flops = layer_flops(layer, input_shapes, K.int_shape(outputs[0]))
+            if flops is None:
+                self.unknown = True
+            else:
+                self.flops += flops
+
+
+class Plan(object):
+    """Memory and FLOPs of a model.
+
+    optimizer_slots: Variables the optimizer keeps per trainable weight.
+    """
+
+    def __init__(self, keras_model, optimizer_slots=1, dtype_size=4):
+        nodes = _model_nodes(keras_model)
+        self.name = keras_model.name
+        self.layers = [LayerPlan(layer, nodes) for layer in keras_model.layers]
+        self.optimizer_slots = optimizer_slots
+        self.dtype_size = dtype_size
+        self.parameters = int(keras_model.count_params())
+        self.trainable = int(sum(K.count_params(w) for w in keras_model.trainable_weights))
+
+    @property
+    def activation_bytes(self):
+        """Activations of one image in a forward pass."""
+        return sum(l.activation_bytes for l in self.layers)
+
+    @property
+    def flops(self):
+        """FLOPs of one image in a forward pass."""
+        return sum(l.flops for l in self.layers)
+
+    @property
+    def parameter_bytes(self):
+        return self.parameters * self.dtype_size
+
+    @property
+    def gradient_bytes(self):
+        return self.trainable * self.dtype_size
+
+    @property
+    def optimizer_bytes(self):
+        return self.trainable * self.dtype_size * self.optimizer_slots
+
+    @property
+    def unknown_layers(self):
+        return [l.name for l in self.layers if l.unknown]
+
+    def fixed_bytes(self, training=True):
+        """Memory that doesn't grow with the batch."""
+        if not training:
+            return self.parameter_bytes
+        return self.parameter_bytes + self.gradient_bytes + self.optimizer_bytes
+
+    def image_bytes(self, training=True):
+        """Memory of each image in the batch."""
+        return self.activation_bytes * (2 if training else 1)
+
+    def memory(self, batch_size, training=True):
+        return self.fixed_bytes(training) + batch_size * self.image_bytes(training)
+
+    def fit(self, ram_bytes, training=True, headroom=0.2):
+        """Largest batch that fits ram_bytes, leaving `headroom` of it for
+        the data pipeline, TF workspaces and fragmentation. 0 if none does.
+        """
+        free = ram_bytes * (1. - headroom) - self.fixed_bytes(training)
+        if free <= 0:
+            return 0
+        return int(free // max(1, self.image_bytes(training)))
+
+    def recommend(self, ram_bytes, effective_batch, headroom=0.2, accumulation=True):
+        """Batch size and accumulation steps of an effective batch that fit.
+
+        accumulation: False for models trained without gradient
+            accumulation, e.g. MaskRCNN. The batch is then only cut to what
+            fits, in one step.
+
+        Returns a dict of IMAGES_PER_GPU, ACCUMULATION_STEPS, the effective
+        batch they give and the memory of a step, or None if not even one
+        image fits.
+        """
+        batch_size = min(self.fit(ram_bytes, headroom=headroom), effective_batch)
+        if batch_size < 1:
+            return None
+        if accumulation:
+            steps = int(math.ceil(effective_batch / float(batch_size)))
+            # Spread the images evenly over the steps
+            batch_size = int(math.ceil(effective_batch / float(steps)))
+        else:
+            steps = 1
+        return {"IMAGES_PER_GPU": batch_size, "ACCUMULATION_STEPS": steps,
+                "EFFECTIVE_BATCH_SIZE": batch_size * steps,
+                "memory_gb": self.memory(batch_size) / GB}
+
+    def format(self, batch_size=1, ram_gb=None, effective_batch=None, top=15, accumulation=True):
+        """A report of the plan at batch_size, with the `top` layers by
+        activation memory and a recommendation for a RAM budget in GB.
+        accumulation: See recommend().
+        """
+        lines = ["Plan of {}: {} layers, {:,} parameters ({:,} trainable)".format(
+            self.name, len(self.layers), self.parameters, self.trainable)]
+        lines.append("{:40} {:18} {:>12} {:>12} {:>10}".format(
+            "layer", "class", "act MB/img", "params MB", "GFLOPs"))
+        for l in sorted(self.layers, key=lambda l: -l.activation_bytes)[:top]:
+            lines.append("{:40} {:18} {:12.2f} {:12.2f} {:10.3f}".format(
+                l.name[:40], l.class_name[:18], l.activation_bytes / 1024. ** 2,
+                l.parameters * self.dtype_size / 1024. ** 2, l.flops / 1e9))
+        lines.append("per image: activations {:.3f} GB, {:.2f} GFLOPs forward".format(
+            self.activation_bytes / GB, self.flops / 1e9))
+        lines.append("weights {:.3f} GB, gradients {:.3f} GB, optimizer {:.3f} GB".format(
+            self.parameter_bytes / GB, self.gradient_bytes / GB, self.optimizer_bytes / GB))
+        lines.append("batch {}: training {:.3f} GB, inference {:.3f} GB".format(
+            batch_size, self.memory(batch_size) / GB, self.memory(batch_size, False) / GB))
+        if self.unknown_layers:
+            lines.append("sizes only known at run time, not counted: {}".format(
+                ", ".join(self.unknown_layers)))
+        if ram_gb:
+            ram = ram_gb * GB
+            lines.append("{} GB fits batch {} in training, {} in inference".format(
+                ram_gb, self.fit(ram), self.fit(ram, training=False)))
+            recommendation = self.recommend(ram, effective_batch or batch_size,
+                                            accumulation=accumulation)
+            if recommendation is None:
+                lines.append("not one training image fits {} GB".format(ram_gb))
+            elif not accumulation:
+                lines.append("recommended: IMAGES_PER_GPU = {IMAGES_PER_GPU} "
+                             "({memory_gb:.3f} GB)".format(**recommendation))
+            else:
+                lines.append("recommended: IMAGES_PER_GPU = {IMAGES_PER_GPU}, "
+                             "ACCUMULATION_STEPS = {ACCUMULATION_STEPS} "
+                             "(effective batch {EFFECTIVE_BATCH_SIZE}, {memory_gb:.3f} GB)".format(
+                                 **recommendation))
+        return "\n".join(lines)
+
+
+def optimizer_slots(config):
+    """Variables per trainable weight of the training optimizer: the SGD
+    momentum and the AccumulateOptimizer accumulator.
+    """
+    slots = 1 if getattr(config, "LEARNING_MOMENTUM", 0) else 0
+    if getattr(config, "ACCUMULATION_STEPS", 1) > 1:
+        slots += 1
+    return slots
+
+
+def plan(model, config=None):
+    """The Plan of a Keras model, or of a MyBackboneModel / MaskRCNN."""
+    keras_model = getattr(model, "keras_model", model)
+    return Plan(keras_model, optimizer_slots(config) if config is not None else 1)
+
+
+def model_flops(keras_model):
+    """FLOPs of one image in a forward pass."""
+    return Plan(keras_model).flops
+
+
+def physical_memory_gb():
+    """RAM of the machine, None if it can't be told."""
+    try:
+        import psutil
+        return psutil.virtual_memory().total / GB
+    except ImportError:
+        pass
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / GB
+    except (AttributeError, ValueError, OSError):
+        return None
@@ -0,0 +1,297 @@
+"""
+Structured channel pruning of the dense_res graphs.
+
+connectedConv and connectedIdentity concatenate their input with the
+bottleneck output, and connectedConv runs a conv as wide as that concat
+(7x7 in dense_graph_simple_long). Removing whole filters keeps the graph
+dense and makes it cheaper on any CPU, unlike sparse weights.
+
+A filter of a Conv2D is removed along with its BatchNorm channel and the
+matching input channels of every conv that reads it, through the
+Activation, Dropout, pooling and upsampling layers and the concats in
+between. Convs whose channels reach a model output or another kind of
+layer keep all their filters, so the model inputs and outputs don't
+change.
+
+Filters are ranked per conv, by
+- "gamma": |gamma| of the BatchNorm after the conv, the network slimming
+  criterion. Convs without one rank by the L1 norm of their kernel.
+- "activation": the mean activation of each channel after the conv's
+  BatchNorm and ReLU on calibration images.
+
+rebuild() builds the thinner graph from the model config and copies the
+surviving weights over. sweep() prunes a model at several ratios,
+optionally fine-tunes each, and reports the parameters, FLOPs, latency and
+accuracy of each:
+
+    images = calibration_images(dataset_val, config, model)
+    rows = sweep(model, [0.25, 0.5, 0.75], images, criterion="gamma",
+                 fine_tune=fine_tune, evaluate=lambda m: evaluate_dice(m, dataset_val, config))
+"""
+
+import time
+import numpy as np
+import cv2
+import keras.backend as K
+import keras.layers as KL
+import keras.models as KM
+from mymrcnn import inferenceexport
+from mymrcnn import planner
+from mymrcnn import quantization
+from mymrcnn.myBackboneModel import BatchNorm, ConcatFeatureLayer
+
+CUSTOM_OBJECTS = {"BatchNorm": BatchNorm, "ConcatFeatureLayer": ConcatFeatureLayer}
+
+# Layers that keep the channels of their input as they are
+PASSTHROUGH_LAYERS = (KL.BatchNormalization, KL.Activation, KL.Dropout, KL.MaxPooling2D,
+                      KL.AveragePooling2D, KL.UpSampling2D, KL.ZeroPadding2D)
+if hasattr(KL, "ReLU"):
+    PASSTHROUGH_LAYERS += (KL.ReLU,)
+
+
+def _is_conv(layer):
+    # Not the Conv2D subclasses, their kernels are laid out differently
+    return type(layer) is KL.Conv2D and layer.data_format == "channels_last"
+
+
+def _is_concat(layer):
+    if isinstance(layer, ConcatFeatureLayer):
+        return True
+    return isinstance(layer, KL.Concatenate) and layer.axis in (-1, 3)
+
+
+def _is_passthrough(layer):
+    if isinstance(layer, KL.BatchNormalization):
+        return layer.axis in (-1, 3, [-1], [3])
+    return isinstance(layer, PASSTHROUGH_LAYERS)
+
+
+def _inputs(layer):
+    # Layers called once, the graphs here don't share layers
+    return inferenceexport._as_list(layer.get_input_at(0))
+
+
+def _output(layer):
+    return layer.get_output_at(0)
+
+
+class _Graph(object):
+    """Consumers of every tensor of a model, by tensor name."""
+
+    def __init__(self, keras_model):
+        self.model = keras_model
+        self.consumers = {}
+        for layer in keras_model.layers:
+            if isinstance(layer, KL.InputLayer):
+                continue
+            for tensor in _inputs(layer):
+                self.consumers.setdefault(tensor.name, []).append(layer)
+        self.outputs = set(t.name for t in keras_model.outputs)
+
+    def prunable(self, conv):
+        """Do the conv's channels only end up in other convs?"""
+        stack, seen = [_output(conv).name], set()
+        while stack:
+            name = stack.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            if name in self.outputs:
+                return False
+            for layer in self.consumers.get(name, []):
+                if _is_conv(layer):
+                    continue
+                if not (_is_passthrough(layer) or _is_concat(layer)):
+                    return False
+                stack.append(_output(layer).name)
+        return True
+
+    def batchnorm(self, conv):
+        """The BatchNorm reading the conv output, if it is the only consumer."""
+        consumers = self.consumers.get(_output(conv).name, [])
+        if len(consumers) == 1 and isinstance(consumers[0], KL.BatchNormalization):
+            return consumers[0]
+        return None
+
+    def activation(self, conv):
+        """The tensor after the conv and its BatchNorm and ReLU, if any."""
+        layer = conv
+        while True:
+            consumers = self.consumers.get(_output(layer).name, [])
+            if len(consumers) != 1 or \
+                    not isinstance(consumers[0], (KL.BatchNormalization, KL.Activation)):
+                return _output(layer)
+            layer = consumers[0]
+
+
+def prunable_convs(keras_model):
+    """Names of the Conv2D layers whose filters can be removed."""
+    graph = _Graph(keras_model)
+    return [layer.name for layer in keras_model.layers if _is_conv(layer) and graph.prunable(layer)]
+
+
+def calibration_images(dataset, config, keras_model, count=32, preprocess=None, seed=2019):
+    """A batch of molded data set images sized for the model input."""
+    input_shape = K.int_shape(keras_model.inputs[0])[1:]
+    return np.stack([quantization.load_sample(dataset, config, image_id, input_shape, preprocess)[0]
+                     for image_id in quantization.sample_ids(dataset, count, seed)])
+
+
+def filter_scores(keras_model, criterion="gamma", images=None, batch_size=8):
+    """Importance of each filter of the prunable convs, higher is kept.
+
+    criterion: "gamma" or "activation", see the module docstring.
+    images: Calibration batch, for "activation".
+
+    Returns: {conv name: [filters] scores}
+    """
+    graph = _Graph(keras_model)
+    convs = [keras_model.get_layer(name) for name in prunable_convs(keras_model)]
+    if criterion == "gamma":
+        scores = {}
+        for conv in convs:
+            bn = graph.batchnorm(conv)
+            if bn is not None and bn.scale:
+                scores[conv.name] = np.abs(bn.get_weights()[0])
+            else:
+                scores[conv.name] = np.abs(conv.get_weights()[0]).sum(axis=(0, 1, 2))
+        return scores
+    if criterion == "activation":
+        assert images is not None, "Activation scores need calibration images"
+        tensors = [graph.activation(conv) for conv in convs]
+        fn = K.function(keras_model.inputs[:1] + [K.learning_phase()],
+                        [K.mean(K.abs(t), axis=[0, 1, 2]) for t in tensors])
+        totals = [np.zeros(K.int_shape(t)[-1]) for t in tensors]
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size]
+            for total, mean in zip(totals, fn([batch, 0])):
+                total += mean * len(batch)
+        return {conv.name: total / len(images) for conv, total in zip(convs, totals)}
+    raise ValueError("Unknown pruning criterion {}".format(criterion))
+
+
+def prune_plan(scores, ratio, min_filters=4):
+    """The filters each conv keeps when `ratio` of them are removed.
+
+    Returns: {conv name: sorted filter indices}
+    """
+    plan = {}
+    for name, score in scores.items():
+        keep = max(min(min_filters, len(score)), int(round(len(score) * (1. - ratio))))
+        plan[name] = np.sort(np.argsort(-score, kind="mergesort")[:keep])
+    return plan
+
+
+def rebuild(keras_model, plan):
+    """A thinner copy of the model with the plan's filters and the
+    surviving weights. The source model is left alone.
+    """
+    config = keras_model.get_config()
+    for layer_config in config["layers"]:
+        if layer_config["name"] in plan:
+            layer_config["config"]["filters"] = len(plan[layer_config["name"]])
+    pruned = KM.Model.from_config(config, custom_objects=CUSTOM_OBJECTS)
+
+    # Channels of the source each tensor keeps, None for all of them
+    kept = {}
+    for layer in keras_model.layers:
+        if isinstance(layer, KL.InputLayer):
+            kept[_output(layer).name] = None
+            continue
+        inputs = [kept[t.name] for t in _inputs(layer)]
+        keep_in = inputs[0]
+        keep_out = keep_in
+        weights = layer.get_weights()
+        if _is_conv(layer):
+            keep_out = plan.get(layer.name)
+            if keep_in is not None:
+                weights[0] = weights[0][:, :, keep_in]
+            if keep_out is not None:
+                weights = [weights[0][..., keep_out]] + [w[keep_out] for w in weights[1:]]
+        elif isinstance(layer, KL.BatchNormalization):
+            if keep_in is not None:
+                weights = [w[keep_in] for w in weights]
+        elif _is_concat(layer):
+            if any(k is not None for k in inputs):
+                offsets = np.cumsum([0] + [K.int_shape(t)[-1] for t in _inputs(layer)])
+                keep_out = np.concatenate([
+                    (np.arange(K.int_shape(t)[-1]) if k is None else k) + offset
+                    for t, k, offset in zip(_inputs(layer), inputs, offsets)])
+        else:
+            assert all(k is None for k in inputs) or _is_passthrough(layer), \
+                "{} can't take pruned channels".format(layer.name)
+        kept[_output(layer).name] = keep_out
+        if weights:
+            pruned.get_layer(layer.name).set_weights(weights)
+    return pruned
+
+
+def latency(keras_model, images, batch_size=1, repeat=10):
+    """Mean milliseconds per predict() of batch_size images, after one
+    warm up call.
+    """
+    batch = images[:batch_size]
+    keras_model.predict(batch, batch_size=batch_size)
+    start = time.time()
+    for _ in range(repeat):
+        keras_model.predict(batch, batch_size=batch_size)
+    return 1000 * (time.time() - start) / repeat
+
+
+def evaluate_dice(keras_model, dataset, config, count=100, threshold=0.5, preprocess=None,
+                  seed=2019):
+    """Mean Dice of a mask model's first output on data set images."""
+    input_shape = K.int_shape(keras_model.inputs[0])[1:]
+    height, width = K.int_shape(keras_model.outputs[0])[1:3]
+    scores = []
+    for image_id in quantization.sample_ids(dataset, count, seed + 1):
+        image, masks = quantization.load_sample(dataset, config, image_id, input_shape, preprocess)
+        prediction = keras_model.predict(image[np.newaxis])
+        prediction = (prediction[0] if isinstance(prediction, list) else prediction)[0]
+        masks = masks.astype(np.uint8)
+        if masks.shape[:2] != (height, width):
+            masks = cv2.resize(masks, (width, height), interpolation=cv2.INTER_NEAREST)
+        scores.append(quantization.dice(prediction, masks, threshold))
+    return {"dice": float(np.mean(scores))}
+
+
+def sweep(keras_model, ratios, images, criterion="gamma", fine_tune=None, evaluate=None,
+          min_filters=4):
+    """Prunes the model at each ratio and reports each result.
+
+    images: Calibration batch, for the activation scores and the latency.
+    fine_tune: Optional. Function (pruned model, ratio) -> trained model.
+    evaluate: Optional. Function model -> dict of accuracy metrics.
+
+    Returns a list of dicts, the unpruned model first, with the pruned
+    models under "model".
+    """
+    scores = filter_scores(keras_model, criterion, images)
+
+    def row(model, ratio):
+        result = {"ratio": ratio, "model": model,
+                  "parameters": int(model.count_params()),
+                  "flops": planner.model_flops(model),
+                  "ms": latency(model, images)}
+        if evaluate is not None:
+            result.update(evaluate(model))
+        return result
+
+    rows = [row(keras_model, 0.)]
+    for ratio in ratios:
+        pruned = rebuild(keras_model, prune_plan(scores, ratio, min_filters))
+        if fine_tune is not None:
+            pruned = fine_tune(pruned, ratio) or pruned
+        rows.append(row(pruned, ratio))
+    return rows
+
+
+def format_report(rows):
+    """A table of sweep() rows, the evaluate() metrics last."""
+    metrics = sorted(k for k in rows[0] if k not in ("ratio", "model", "parameters", "flops", "ms"))
+    lines = ["ratio      params   GFLOPs       ms  " + "  ".join(metrics)]
+    for r in rows:
+        lines.append("{:5.2f}  {:10d}  {:7.3f}  {:7.2f}  {}".format(
+            r["ratio"], r["parameters"], r["flops"] / 1e9, r["ms"],
+            "  ".join("{:.4f}".format(r[k]) for k in metrics)))
+    return "\n".join(lines)
@@ -0,0 +1,190 @@
+"""
+Multi-resolution image cache shared by the loaders.
+
+The loaders read the same source JPEGs at different sizes. The UNet
+generator reads them at 320x480 RGB with gamma 0.8, the data sets at
+384x576 BGR plus Canny, and GradCam and the crop scripts at full
+resolution. ImagePyramid decodes a source once and makes every registered
+(size, transform) variant from that one decode: each size is resized once
+and then passed through its transforms. The variants are kept per image
+id, in an LRU bounded by bytes.
+
+Variants are registered on first request, so a loader that asks for
+(size, transform) gets hits from then on. One pyramid per source directory
+is shared through get_pyramid(), so all the models in a process share one
+cache:
+
+    pyramid = get_pyramid(WORK_DIR + "/train_images")
+    image = pyramid.get("0011165", (384, 576), "canny")
+
+Cached arrays are read only. Copy them before changing them in place.
+Pickling a pyramid (e.g. with a data set sent to a worker process) drops
+its cache. The worker gets the shared pyramid of the same directory.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+
+############################################################
+#  Transforms
+############################################################
+
+def _canny(image):
+    """BGR plus a Canny edge channel, as ImageDataSetForMask feeds the models."""
+    return np.dstack([image, cv2.Canny(image, 100, 200)])
+
+
+# Name -> function of a uint8 BGR image, already resized
+TRANSFORMS = {
+    "bgr": lambda image: image,
+    "rgb": lambda image: cv2.cvtColor(image, cv2.COLOR_BGR2RGB),
+    "gray": lambda image: cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)[..., np.newaxis],
+    "canny": _canny,
+}
+
+
+def register_transform(name, fn):
+    """Adds a photometric transform. fn takes a uint8 BGR image."""
+    TRANSFORMS[name] = fn
+    return name
+
+
+def unit_rgb_transform(gamma=None):
+    """RGB scaled to [0, 1] and optionally gamma corrected, like the UNet
+    generator. Returns the transform name.
+    """
+    if gamma is None:
+        name = "rgb_unit"
+        fn = lambda image: cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.
+    else:
+        name = "rgb_unit_gamma{}".format(gamma)
+        fn = lambda image: np.power(
+            cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32) / 255., gamma)
+    if name not in TRANSFORMS:
+        register_transform(name, fn)
+    return name
+
+
+############################################################
+#  Pyramid
+############################################################
+
+class ImagePyramid(object):
+    """Decoded variants of the images of one source directory.
+
+    source_dir: Directory of the full resolution images.
+    extension: Extension of ids given without one.
+    max_bytes: Size of the cache. The least recently used images go first.
+    interpolation: cv2 resize interpolation. INTER_LINEAR, like the
+        cv2.resize calls of the loaders.
+    """
+
+    def __init__(self, source_dir, extension=".jpg", max_bytes=2 * 2 ** 30,
+                 interpolation=cv2.INTER_LINEAR):
+        self.source_dir = source_dir
+        self.extension = extension
+        self.max_bytes = max_bytes
+        self.interpolation = interpolation
+        # (size, transform) keys, size is (height, width) or None for full resolution
+        self.variants = []
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.decodes = 0
+        self.hits = 0
+
+    def __reduce__(self):
+        return (get_pyramid, (self.source_dir, self.extension, self.max_bytes, self.interpolation))
+
+    def register(self, size=None, transform="bgr"):
+        """Makes the variant part of every decode from now on."""
+        assert transform in TRANSFORMS, "Unknown transform {}".format(transform)
+        key = (tuple(size) if size is not None else None, transform)
+        with self._lock:
+            if key not in self.variants:
+                self.variants.append(key)
+        return key
+
+    def source_path(self, image_id):
+        if os.path.splitext(image_id)[1]:
+            return os.path.join(self.source_dir, image_id)
+        return os.path.join(self.source_dir, image_id + self.extension)
+
+    def get(self, image_id, size=None, transform="bgr"):
+        """The image at size (height, width), full resolution if None,
+        through the named transform.
+        """
+        key = self.register(size, transform)
+        image_id = os.path.splitext(str(image_id))[0]
+        with self._lock:
+            entry = self._images.get(image_id)
+            if entry is not None and key in entry:
+                self._images.move_to_end(image_id)
+                self.hits += 1
+                return entry[key]
+        entry = self._decode(image_id, entry or {})
+        return entry[key]
+
+    def _decode(self, image_id, entry):
+        """Decodes the source once and adds the variants the entry lacks."""
+        path = self.source_path(image_id)
+        if not os.path.splitext(path)[1] or not os.path.exists(path):
+            # Crops of the class images are stored as png
+            png_path = os.path.splitext(path)[0] + ".png"
+            path = png_path if os.path.exists(png_path) else path
+        source = cv2.imread(path)
+        if source is None:
+            raise IOError("Could not read image {}".format(path))
+        with self._lock:
+            variants = [key for key in self.variants if key not in entry]
+        entry = dict(entry)
+        by_size = OrderedDict()
+        for size, transform in variants:
+            by_size.setdefault(size, []).append(transform)
+        for size, transforms in by_size.items():
+            if size is None or tuple(size) == source.shape[:2]:
+                resized = source
+            else:
+                resized = cv2.resize(source, (size[1], size[0]), interpolation=self.interpolation)
+            for transform in transforms:
+                image = np.ascontiguousarray(TRANSFORMS[transform](resized))
+                image.flags.writeable = False
+                entry[(size, transform)] = image
+        with self._lock:
+            self.decodes += 1
+            old = self._images.pop(image_id, None)
+            if old is not None:
+                self._bytes -= sum(a.nbytes for a in old.values())
+            self._images[image_id] = entry
+            self._bytes += sum(a.nbytes for a in entry.values())
+            while self._bytes > self.max_bytes and len(self._images) > 1:
+                _, evicted = self._images.popitem(last=False)
+                self._bytes -= sum(a.nbytes for a in evicted.values())
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self._bytes = 0
+
+
+# Source directory -> its shared pyramid
+_PYRAMIDS = {}
+_PYRAMIDS_LOCK = threading.Lock()
+
+
+def get_pyramid(source_dir, extension=".jpg", max_bytes=2 * 2 ** 30,
+                interpolation=cv2.INTER_LINEAR):
+    """The ImagePyramid of a source directory, shared by every caller in
+    the process. The other arguments only apply when it is created.
+    """
+    key = os.path.abspath(source_dir)
+    with _PYRAMIDS_LOCK:
+        if key not in _PYRAMIDS:
+            _PYRAMIDS[key] = ImagePyramid(source_dir, extension=extension, max_bytes=max_bytes,
+                                          interpolation=interpolation)
+        return _PYRAMIDS[key]
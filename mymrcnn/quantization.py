@@ -0,0 +1,190 @@
+"""
+Post-training int8 quantization of the segmentation models for CPU
+inference.
+
+The float model is first reduced with inferenceexport (BatchNorm folded,
+Dropout and loss outputs dropped). It is then converted with the TFLite
+converter. The converter calibrates the activation ranges on images from a
+data set, usually a few hundred from the ImageDataSetForMask validation
+split. Weights and activations are stored as int8. The artifact keeps
+float32 inputs and outputs, so it takes the same molded images as the Keras
+model.
+
+QuantizedRunner runs the artifact. evaluate() reports latency and the Dice
+delta against the float model on the same images, none of which were used
+for calibration.
+"""
+
+import time
+import logging
+import numpy as np
+import cv2
+import tensorflow as tf
+import keras.backend as K
+from mymrcnn import datagenerator
+from mymrcnn import inferenceexport
+
+
+def _tflite():
+    # tf.lite moved out of tf.contrib in TF 1.13
+    return tf.lite if hasattr(tf, "lite") else tf.contrib.lite
+
+
+def load_sample(dataset, config, image_id, input_shape, preprocess=None):
+    """Loads one image and its masks sized for a model input.
+
+    input_shape: [height, width, channels] of the model input. Extra image
+        channels (e.g. the Canny edge channel) are dropped.
+    preprocess: Function image -> model input. datagenerator.mold_image
+        by default.
+
+    Returns: image [height, width, channels] float32, masks [H, W, classes]
+    """
+    preprocess = preprocess or (lambda image: datagenerator.mold_image(image, config))
+    image = dataset.load_image(image_id)
+    masks, _ = dataset.load_mask(image_id)
+    height, width, channels = input_shape
+    if image.shape[:2] != (height, width):
+        image = cv2.resize(image.astype(np.float32), (width, height), interpolation=cv2.INTER_LINEAR)
+    image = preprocess(image[..., :channels].astype(np.float32))
+    return image.astype(np.float32), masks
+
+
+def sample_ids(dataset, count, seed=2019, skip=0):
+    """A fixed random subset of the data set image ids. Subsets of the same
+    seed with different skips are slices of one permutation, so
+    sample_ids(d, n, skip=m) and sample_ids(d, m) don't overlap.
+    """
+    ids = np.copy(dataset.image_ids)
+    np.random.RandomState(seed).shuffle(ids)
+    return ids[skip:skip + count]
+
+
+def quantize(keras_model, dataset, config, output_path, calibration_count=300,
+             preprocess=None, seed=2019):
+    """Writes an int8 TFLite artifact of a model.
+
+    keras_model: The float model. MyBackboneModel instances are accepted.
+    dataset: Calibration images, e.g. the ImageDataSetForMask val set.
+    calibration_count: Number of calibration images.
+
+    Returns output_path.
+    """
+    inference_model = inferenceexport.export_inference_model(keras_model)
+    assert len(inference_model.inputs) == 1, "Only single input models are supported"
+    input_shape = K.int_shape(inference_model.input)[1:]
+    calibration_ids = sample_ids(dataset, calibration_count, seed)
+
+    def representative_dataset():
+        for image_id in calibration_ids:
+            image, _ = load_sample(dataset, config, image_id, input_shape, preprocess)
+            yield [image[np.newaxis]]
+
+    lite = _tflite()
+    converter = lite.TFLiteConverter.from_session(
+        K.get_session(), inference_model.inputs, inference_model.outputs)
+    converter.optimizations = [lite.Optimize.DEFAULT]
+    converter.representative_dataset = representative_dataset
+    converter.target_spec.supported_ops = [lite.OpsSet.TFLITE_BUILTINS_INT8]
+    with open(output_path, "wb") as f:
+        f.write(converter.convert())
+    logging.info("Wrote int8 model {} calibrated on {} images".format(
+        output_path, len(calibration_ids)))
+    return output_path
+
+
+class QuantizedRunner(object):
+    """Runs an int8 artifact written by quantize(), one image at a time."""
+
+    def __init__(self, model_path):
+        self.interpreter = _tflite().Interpreter(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_details = self.interpreter.get_output_details()
+
+    @property
+    def input_shape(self):
+        return tuple(self.input_detail["shape"][1:])
+
+    def predict(self, images):
+        """images: [batch, height, width, channels] molded float32 images.
+        Returns the first output [batch, ...].
+        """
+        outputs = []
+        for image in images:
+            self.interpreter.set_tensor(self.input_detail["index"],
+                                        image[np.newaxis].astype(np.float32))
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output_details[0]["index"])[0])
+        return np.stack(outputs)
+
+
+def dice(pred, gt, threshold=0.5):
+    """Dice coefficient of a thresholded prediction, 1 when both are empty.
+    pred, gt: [height, width, channels]
+    """
+    pred = pred >= threshold
+    gt = gt.astype(bool)
+    total = pred.sum() + gt.sum()
+    if total == 0:
+        return 1.
+    return 2. * np.logical_and(pred, gt).sum() / total
+
+
+def _fit_masks(masks, output_shape):
+    """Sizes the ground truth masks like the model output."""
+    height, width, channels = output_shape
+    masks = masks.astype(np.uint8)
+    if masks.shape[:2] != (height, width):
+        masks = cv2.resize(masks, (width, height), interpolation=cv2.INTER_NEAREST)
+        if masks.ndim == 2:
+            masks = masks[..., np.newaxis]
+    if masks.shape[-1] != channels and channels == 1:
+        masks = np.any(masks, axis=-1, keepdims=True)
+    return masks
+
+
+def evaluate(keras_model, runner, dataset, config, count=300, preprocess=None, seed=2019,
+             calibration_count=300, class_names=None):
+    """Compares the int8 artifact with the float model on the same images.
+
+    calibration_count: The calibration_count of quantize(). Scoring takes
+        the images after the calibration ones in the same permutation.
+    class_names: Class of each model output channel, in order. None when
+        the outputs follow the data set classes, like the masks.
+
+    Returns a dict with the mean Dice of both models, the Dice delta and
+    the mean per image latency in milliseconds.
+    """
+    float_model = inferenceexport.export_inference_model(keras_model)
+    input_shape = K.int_shape(float_model.input)[1:]
+    output_shape = K.int_shape(float_model.output)[1:]
+    float_dice, int8_dice, float_time, int8_time = [], [], [], []
+    ids = sample_ids(dataset, count, seed, skip=calibration_count)
+    if not len(ids):
+        raise ValueError("No images left to score after the {} calibration ones".format(
+            calibration_count))
+    for image_id in ids:
+        image, masks = load_sample(dataset, config, image_id, input_shape, preprocess)
+        if class_names is not None:
+            masks = masks[..., [dataset.classes.index(name) for name in class_names]]
+        masks = _fit_masks(masks, output_shape)
+        batch = image[np.newaxis]
+        start = time.time()
+        float_pred = float_model.predict(batch)[0]
+        float_time.append(time.time() - start)
+        start = time.time()
+        int8_pred = runner.predict(batch)[0]
+        int8_time.append(time.time() - start)
+        float_dice.append(dice(float_pred, masks))
+        int8_dice.append(dice(int8_pred, masks))
+    result = {
+        "images": len(ids),
+        "float_dice": float(np.mean(float_dice)),
+        "int8_dice": float(np.mean(int8_dice)),
+        # Skip the first, warm up run in the latencies
+        "float_ms": 1000 * float(np.mean(float_time[1:] or float_time)),
+        "int8_ms": 1000 * float(np.mean(int8_time[1:] or int8_time)),
+    }
+    result["dice_delta"] = result["int8_dice"] - result["float_dice"]
+    return result
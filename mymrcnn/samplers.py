@@ -0,0 +1,136 @@
+"""
+Deterministic, resumable sample order for data_generator().
+
+data_generator() shuffles with the global np.random state, so a resumed run
+sees a new order and every Keras worker process draws its own copy of the
+whole set. Sampler instead derives the order of each epoch from a seed, and
+splits it into disjoint shards, one per worker:
+
+    epoch e order = RandomState([seed, e]).permutation(num_images)
+    shard of rank r = padded order[r::workers]
+
+The order is padded with its first images to a multiple of workers, so
+every shard has ceil(num_images / workers) samples and no image is left
+out of an epoch. At most workers - 1 images are drawn twice.
+
+Its cursor is the number of samples drawn, so the state of a run is a few
+numbers. AsyncCheckpoint records it in the checkpoint index with each
+checkpoint, and resume() starts a new sampler from the checkpoint a run
+continues from. The order then continues where it stopped.
+
+With several Keras worker processes, each process claims the next free
+rank on its first draw. The set of images of each epoch is deterministic,
+but the order the batches reach the model depends on process timing, and
+a resumed run restarts every shard at its share of the samples seen.
+"""
+
+import os
+import multiprocessing
+import numpy as np
+from mymrcnn import checkpoints
+
+
+class Sampler(object):
+    """Indices into dataset.image_ids, epoch after epoch.
+
+    num_images: Size of the data set.
+    seed: Seed of the epoch orders.
+    shuffle: If False, every epoch is in data set order.
+    workers: Number of shards.
+    rank: Shard of this sampler. None claims a free one in each process on
+        its first draw, for the copies Keras' worker processes make.
+    samples: Samples drawn by all shards together so far.
+    """
+
+    def __init__(self, num_images, seed=2019, shuffle=True, workers=1, rank=None, samples=0):
+        if num_images < workers:
+            raise ValueError("{} images can't be split into {} shards".format(num_images, workers))
+        self.num_images = num_images
+        self.seed = seed
+        self.shuffle = shuffle
+        self.workers = workers
+        self.rank = rank
+        self.shard_size = -(-num_images // workers)
+        self.position = samples // workers
+        self._shard_epoch = None
+        self._shard = None
+        self._pid = os.getpid() if rank is not None else None
+        self._ranks = multiprocessing.Value("i", 0) if rank is None else None
+
+    @classmethod
+    def from_state(cls, state, rank=None):
+        return cls(state["num_images"], seed=state["seed"], shuffle=state["shuffle"],
+                   workers=state["workers"], rank=rank, samples=state["samples"])
+
+    def state(self, samples=None):
+        """The state to resume from. samples: samples drawn by all shards,
+        by default this shard's cursor times the number of shards.
+        """
+        return {
+            "num_images": self.num_images,
+            "seed": self.seed,
+            "shuffle": self.shuffle,
+            "workers": self.workers,
+            "samples": int(self.position * self.workers if samples is None else samples),
+        }
+
+    def order(self, epoch):
+        if not self.shuffle:
+            return np.arange(self.num_images)
+        return np.random.RandomState([self.seed, epoch]).permutation(self.num_images)
+
+    def shard(self, epoch, rank=None):
+        """The indices a rank draws in an epoch."""
+        rank = self.rank if rank is None else rank
+        order = self.order(epoch)
+        order = np.concatenate([order, order[:self.shard_size * self.workers - self.num_images]])
+        return order[rank::self.workers]
+
+    def _claim(self):
+        # A process copy of a sampler without a rank takes the next free one
+        with self._ranks.get_lock():
+            rank = self._ranks.value
+            self._ranks.value += 1
+        if rank >= self.workers:
+            raise ValueError("More processes draw from the sampler than its {} "
+                             "shards".format(self.workers))
+        self.rank = rank
+        self._pid = os.getpid()
+
+    def next(self):
+        if self._pid != os.getpid():
+            self._claim()
+        epoch, index = divmod(self.position, self.shard_size)
+        if epoch != self._shard_epoch:
+            self._shard = self.shard(epoch)
+            self._shard_epoch = epoch
+        self.position += 1
+        return self._shard[index]
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+
+def resume(model, dataset, workers=1, rank=None, samples_per_epoch=None):
+    """The sampler of a training run. It continues from the state recorded
+    with the checkpoint of model.epoch, if the run resumes from one, and
+    starts from config.SAMPLER_SEED otherwise.
+
+    samples_per_epoch: Samples all shards draw per epoch, to place the
+        cursor of checkpoints saved without a state. Defaults to
+        STEPS_PER_EPOCH * BATCH_SIZE.
+    """
+    config = model.config
+    if samples_per_epoch is None:
+        samples_per_epoch = config.STEPS_PER_EPOCH * config.BATCH_SIZE
+    state = {}
+    if model.epoch:
+        path = model.checkpoint_path.format(epoch=model.epoch)
+        state = checkpoints.CheckpointIndex(model.model_dir).sampler(path)
+    return Sampler(len(dataset.image_ids),
+                   seed=state.get("seed", config.SAMPLER_SEED),
+                   shuffle=state.get("shuffle", True),
+                   workers=workers, rank=rank,
+                   samples=state.get("samples", model.epoch * samples_per_epoch))
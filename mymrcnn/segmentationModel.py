@@ -1,4 +1,5 @@
 import os
+import sys
 import random
 import datetime
 import re
@@ -13,7 +14,16 @@ import keras.backend as K
 import keras.layers as KL
 import keras.engine as KE
 import keras.models as KM
+from mymrcnn import buildcache
 from mymrcnn import datagenerator
+from mymrcnn import checkpoints
+from mymrcnn import cpu_parallel
+from mymrcnn import optimizers
+from mymrcnn import samplers
+from mymrcnn import tfdata
+from mymrcnn import augmentation as batchaugmentation
+from mymrcnn import tiling
+from mymrcnn import inferenceexport
 import segmentation_models as sm
 class BatchNorm(KL.BatchNormalization):
     """Extends the Keras BatchNormalization class to allow a central place
@@ -304,15 +314,12 @@ class FeatureTransformLayer(KE.Layer):
     def __init__(self,**kwargs):
         super(FeatureTransformLayer, self).__init__(**kwargs)
     def call(self,inputs):
-        feature_counts = len(inputs)
-        mrcnn_features = tf.concat(inputs, axis=1)
-        shapeP2 = K.int_shape(inputs[0])
-        shape = [-1 if x is None else x for x in shapeP2[:1]] + [feature_counts] + \
-        [-1 if x is None else x for x in shapeP2[1:]]
-        output = tf.reshape(mrcnn_features,shape)
+        # [batch,feature_counts,...] same as concat on axis 1 then reshape,
+        # without baking any dimension into the graph
+        output = tf.stack(inputs, axis=1)
         return output
     def compute_output_shape(self, input_shape):
-        return (1,3,595,7, 256)
+        return (input_shape[0][0],) + (len(input_shape),) + tuple(input_shape[0][1:])
 class FlatConvLayer(KE.Layer):
     def __init__(self,**kwargs):
         super(FlatConvLayer, self).__init__(**kwargs)
@@ -330,7 +337,7 @@ class FlatConvLayer(KE.Layer):
         out = tf.reshape(output,[-1,dim_2])
         return out
     def compute_output_shape(self, input_shape):
-        return (1,133280)
+        return (input_shape[0],) + (input_shape[2] * input_shape[3] * input_shape[4],)
 class SplitConcatLayer(KE.Layer):
     def __init__(self,**kwargs):
         super(SplitConcatLayer, self).__init__(**kwargs)
@@ -351,25 +358,33 @@ class SplitConcatLayer(KE.Layer):
         return (input_shape[0],) + (input_shape[1] / 2,input_shape[2] / 2) + (input_shape[3] * 4,)
 class POILayer(KE.Layer):
     #input shape is [batch,height,width,channel] (number boxesnumber)
-    def __init__(self, pool_shape,SCALE_LIST=[8,4,2,1],IMAGES_COUNT=1,**kwargs):
+    def __init__(self, pool_shape,SCALE_LIST=[8,4,2,1],**kwargs):
         super(POILayer, self).__init__(**kwargs)
         self.pool_shape = tuple(pool_shape)
         self.scale_list = SCALE_LIST
-        self.image_count = IMAGES_COUNT
+        # [boxesnumber,(y1,x1,y2,x2)] the boxes never change, build them once
+        self.boxes = np.array(generateBoxByScaleList(self.scale_list),dtype=np.float32)
+    def get_config(self):
+        # For the build cache, the constructor arguments
+        config = super(POILayer, self).get_config()
+        config["pool_shape"] = self.pool_shape
+        config["SCALE_LIST"] = self.scale_list
+        return config
     def call(self, inputs):
-        num_boxes = np.sum([scale ** 2 for scale in self.scale_list])
         images = inputs
-        print('images',K.int_shape(images))
-        boxes = generateBoxByScaleList(self.scale_list)
-        imgTensors = []
-        for box in boxes:
-            imgTensors.append(tf.image.crop_and_resize(images,np.full([self.image_count,4],box),np.arange(self.image_count),self.pool_shape,method="bilinear"))
-        # imageTensors = lists of [batch,7,7,channel] (number boxesnumber)
-        cropedImages_concated = tf.concat(imgTensors,axis=1)
-        # haha switch to [batch,7*boxesnumber,7,channel]
-        return cropedImages_concated
+        num_boxes = self.boxes.shape[0]
+        batch = tf.shape(images)[0]
+        # one crop per (image,box) pair, image major, in a single op
+        boxes = tf.tile(tf.constant(self.boxes),[batch,1])
+        box_ind = tf.reshape(tf.tile(tf.expand_dims(tf.range(batch),1),[1,num_boxes]),[-1])
+        cropedImages = tf.image.crop_and_resize(images,boxes,box_ind,self.pool_shape,method="bilinear")
+        # [batch * boxesnumber,7,7,channel] switch to [batch,7*boxesnumber,7,channel],
+        # the same layout as concatenating the per box crops on axis 1
+        channels = K.int_shape(images)[-1]
+        return tf.reshape(cropedImages,[batch,num_boxes * self.pool_shape[0],self.pool_shape[1],
+                                         tf.shape(images)[-1] if channels is None else channels])
     def compute_output_shape(self, input_shape):
-        return (self.image_count,) + (self.pool_shape[0] * np.sum([scale ** 2 for scale in self.scale_list]),  \
+        return (input_shape[0],) + (self.pool_shape[0] * self.boxes.shape[0],  \
          self.pool_shape[1])+ (input_shape[-1], )
 def msk_class_loss_graph(y_true, y_pred):
     return  K.mean(- y_true * K.log(y_pred + 1e-9) \
@@ -446,7 +461,10 @@ class MyBackboneModel:
         self.config = config
         self.model_dir = model_dir
         self.set_log_dir()
-        self.keras_model = self.buildModel(mode,config)
+        self.keras_model = buildcache.cached_build(
+            lambda: self.buildModel(mode, config), mode, config, [sys.modules[__name__]])
+        # Folded copy for predict_tiled(), exported on first use
+        self.inference_model = None
     def buildModel(self,mode,config):
         # input_image = KL.Input(
         #         shape=[384, 576, config.IMAGE_SHAPE[2]], name="input_image")
@@ -469,10 +487,8 @@ class MyBackboneModel:
         # return KM.Model(inputs, outputs, name='mask_backbone')
     
     def compile(self,learning_rate, momentum):
-        optimizer = keras.optimizers.SGD(
-            lr=learning_rate, momentum=momentum,
-            clipnorm=self.config.GRADIENT_CLIP_NORM)
-        self.keras_model.compile(optimizer=opt,loss=bce_dice_loss, metrics=[dice_coef])
+        optimizer = optimizers.training_optimizer(learning_rate, momentum, self.config)
+        self.keras_model.compile(optimizer=optimizer,loss=bce_dice_loss, metrics=[dice_coef])
         # self.keras_model._losses = []
         # self.keras_model._per_input_losses = {}
         # loss_names = ["mask_loss_l"]
@@ -544,77 +560,41 @@ class MyBackboneModel:
         self.checkpoint_path = self.checkpoint_path.replace(
             "*epoch*", "{epoch:04d}")
     
+    def predict_tiled(self, images, **kwargs):
+        """Predicts the masks of full resolution images tile by tile.
+        images: List or iterable of [height, width, channels] images.
+        kwargs: TiledPredictor arguments, such as scale or output_shape.
+            The others default to config.INFERENCE_TILE_*.
+        Returns a list of [out height, out width, classes] predictions.
+        """
+        # The folded inference model is exported once and reused until the
+        # weights change
+        if self.inference_model is None:
+            self.inference_model = inferenceexport.export_inference_model(self.keras_model)
+        predictor = tiling.TiledPredictor.from_model(self.keras_model, self.config,
+                                                     inference_model=self.inference_model, **kwargs)
+        return predictor.predict(images)
+
     def load_weights(self, filepath, by_name=False, exclude=None):
         """Modified version of the corresponding Keras function with
         the addition of multi-GPU support and the ability to exclude
         some layers from loading.
         exclude: list of layer names to exclude
+        The layer layout of the file is cached next to it, see
+        checkpoints.load_weights().
         """
-        import h5py
-        # Conditional import to support versions of Keras before 2.2
-        # TODO: remove in about 6 months (end of 2018)
-        try:
-            from keras.engine import saving
-        except ImportError:
-            # Keras before 2.2 used the 'topology' namespace.
-            from keras.engine import topology as saving
-
-        if exclude:
-            by_name = True
-
-        if h5py is None:
-            raise ImportError('`load_weights` requires h5py.')
-        f = h5py.File(filepath, mode='r')
-        if 'layer_names' not in f.attrs and 'model_weights' in f:
-            f = f['model_weights']
-
-        # In multi-GPU training, we wrap the model. Get layers
-        # of the inner model because they have the weights.
-        keras_model = self.keras_model
-        layers = keras_model.inner_model.layers if hasattr(keras_model, "inner_model")\
-            else keras_model.layers
-
-        # Exclude some layers
-        if exclude:
-            layers = filter(lambda l: l.name not in exclude, layers)
-
-        if by_name:
-            saving.load_weights_from_hdf5_group_by_name(f, layers)
-        else:
-            saving.load_weights_from_hdf5_group(f, layers)
-        if hasattr(f, 'close'):
-            f.close()
+        checkpoints.load_weights(self.keras_model, filepath, by_name=by_name, exclude=exclude)
+        self.inference_model = None
 
         # Update the log directory
         self.set_log_dir(filepath)
     def find_last(self):
         """Finds the last checkpoint file of the last trained model in the
-        model directory.
+        model directory, from the checkpoint index of the directory.
         Returns:
             The path of the last checkpoint file
         """
-        # Get directory names. Each directory corresponds to a model
-        dir_names = next(os.walk(self.model_dir))[1]
-        key = self.config.NAME.lower()
-        dir_names = filter(lambda f: f.startswith(key), dir_names)
-        dir_names = sorted(dir_names)
-        if not dir_names:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT,
-                "Could not find model directory under {}".format(self.model_dir))
-        # Pick last directory
-        dir_name = os.path.join(self.model_dir, dir_names[-1])
-        # Find the last checkpoint
-        checkpoints = next(os.walk(dir_name))[2]
-        checkpoints = filter(lambda f: f.startswith("mask_rcnn"), checkpoints)
-        checkpoints = sorted(checkpoints)
-        if not checkpoints:
-            import errno
-            raise FileNotFoundError(
-                errno.ENOENT, "Could not find weight files in {}".format(dir_name))
-        checkpoint = os.path.join(dir_name, checkpoints[-1])
-        return checkpoint
+        return checkpoints.CheckpointIndex(self.model_dir).last(self.config.NAME.lower())
 
     def train(self, train_dataset, val_dataset, learning_rate, epochs, layers,
               augmentation=None, custom_callbacks=None, no_augmentation_sources=None):
@@ -651,6 +631,7 @@ class MyBackboneModel:
             defined in the Dataset class.
         """
         assert self.mode == "training", "Create model in training mode."
+        self.inference_model = None
 
         # Pre-defined layer regular expressions
         layer_regex = {
@@ -659,14 +640,43 @@ class MyBackboneModel:
         }
         if layers in layer_regex.keys():
             layers = layer_regex[layers]
-        # Data generators
-        
-        datagenerator.data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+
+        if self.config.CPU_WORKERS > 1:
+            # Data parallel over local worker processes, see cpu_parallel
+            cpu_parallel.train(self, datagenerator.data_generator, train_dataset, val_dataset,
+                               learning_rate, epochs, self.config.CPU_WORKERS,
+                               train_kwargs=dict(augmentation=augmentation,
+                                                 no_augmentation_sources=no_augmentation_sources))
+            return
+
+        # Work-around for Windows: Keras fails on Windows when using
+        # multiprocessing workers. See discussion here:
+        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
+        if os.name is 'nt':
+            workers = 0
+        else:
+            workers = multiprocessing.cpu_count()
+        if self.config.INPUT_PIPELINE == "tf.data":
+            # TensorFlow threads load the batches, see tfdata
+            assert augmentation is None, "The tf.data pipeline has no imgaug augmentation"
+            workers = 0
+
+        # Data generators. The sampler continues the sample order of the
+        # checkpoint this run resumes from, one shard per Keras worker, so
+        # there can't be more workers than images.
+        workers = min(workers, len(train_dataset.image_ids))
+        sampler = samplers.resume(self, train_dataset, workers=max(1, workers))
+        if self.config.INPUT_PIPELINE == "tf.data":
+            train_generator, val_generator = tfdata.training_generators(
+                train_dataset, val_dataset, self.config, sampler=sampler)
+        else:
+            train_generator = datagenerator.data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources,
+                                             sampler=sampler)
+            val_generator = datagenerator.data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -676,8 +686,8 @@ class MyBackboneModel:
         callbacks = [
             keras.callbacks.TensorBoard(log_dir=self.log_dir,
                                         histogram_freq=0, write_graph=True, write_images=False),
-            keras.callbacks.ModelCheckpoint(self.checkpoint_path,
-                                            verbose=0, save_weights_only=True),
+            checkpoints.checkpoint_callback(self.model_dir, self.checkpoint_path, self.config,
+                                            sampler=sampler),
         ]
         
         # Add custom callbacks to the list
@@ -690,14 +700,6 @@ class MyBackboneModel:
         #self.set_trainable(layers)
         self.compile(learning_rate, self.config.LEARNING_MOMENTUM)
 
-        # Work-around for Windows: Keras fails on Windows when using
-        # multiprocessing workers. See discussion here:
-        # https://github.com/matterport/Mask_RCNN/issues/13#issuecomment-353124009
-        if os.name is 'nt':
-            workers = 0
-        else:
-            workers = multiprocessing.cpu_count()
-
         self.keras_model.fit_generator(
             train_generator,
             initial_epoch=self.epoch,
@@ -708,7 +710,7 @@ class MyBackboneModel:
             validation_steps=self.config.VALIDATION_STEPS,
             max_queue_size=100,
             workers=workers,
-            use_multiprocessing=True,
+            use_multiprocessing=workers > 0,
         )
         self.epoch = max(self.epoch, epochs)
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
@@ -835,6 +837,7 @@ class DataGenerator(keras.utils.Sequence):
         self.gamma = gamma
         self.n_channels = n_channels
         self.augment = augment
+        self.augmenter = batchaugmentation.albumentations_compatible() if augment else None
         self.n_classes = n_classes
         self.shuffle = shuffle
         self.random_state = random_state
@@ -938,25 +941,9 @@ class DataGenerator(keras.utils.Sequence):
 
         return img
     
-    def __random_transform(self, img, masks):
-        composition = albu.Compose([
-            albu.HorizontalFlip(),
-            albu.VerticalFlip(),
-            albu.ShiftScaleRotate(rotate_limit=30, shift_limit=0.1)
-        ])
-        
-        composed = composition(image=img, mask=masks)
-        aug_img = composed['image']
-        aug_masks = composed['mask']
-        
-        return aug_img, aug_masks
-    
     def __augment_batch(self, img_batch, masks_batch):
-        for i in range(img_batch.shape[0]):
-            img_batch[i, ], masks_batch[i, ] = self.__random_transform(
-                img_batch[i, ], masks_batch[i, ])
-        
-        return img_batch, masks_batch
+        # Parameters are drawn for the whole batch, see mymrcnn.augmentation
+        return self.augmenter(img_batch, masks_batch)
 
         
         
@@ -0,0 +1,504 @@
+"""
+Local micro-batching inference server.
+
+Predictions ran as scripts over folders of images (runTesting). The
+server keeps one warm model in memory and scores images as they arrive
+over HTTP:
+
+    POST /predict   body: an encoded image (jpg, png). Returns JSON with the
+                    masks RLE encoded in the train.csv format, or the class
+                    probabilities of a classifier.
+    GET  /metrics   request, batch and latency counters as JSON.
+    GET  /health
+
+Requests from concurrent connections go into one queue. MicroBatcher runs
+them through the model in batches: a batch is closed when it holds
+max_batch_size images, or max_wait_ms after its first image arrived. So a
+lone request waits at most max_wait_ms, and under load the batches fill.
+When the queue holds max_queue requests, new ones get a 503.
+
+The models are wrapped as predict functions of a list of decoded images
+-> a list of JSON results:
+- mask_predict_fn: MyBackboneModel mask models and the sm.Unet of
+  segmentationModel, through cascade.keras_predict_fn,
+- classifier_predict_fn: myBackboneModel_Multi,
+- detect_predict_fn: mrcnn MaskRCNN.detect in inference mode.
+
+    server = InferenceServer(mask_predict_fn(model.keras_model, config, CLASS_NAMES),
+                             max_batch_size=8, max_wait_ms=10)
+    server.serve_forever()
+
+load_test() is a local load generator of concurrent clients, and reports
+the throughput and latency percentiles seen from the client side.
+"""
+
+import json
+import time
+import queue
+import socket
+import logging
+import threading
+import collections
+import socketserver
+from concurrent.futures import Future
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib import request as urlrequest
+from urllib.error import HTTPError
+import numpy as np
+import cv2
+from mymrcnn import utils
+
+CLASS_NAMES = ["Gravel", "Sugar", "Fish", "Flower"]
+
+
+class QueueFull(Exception):
+    pass
+
+
+############################################################
+#  Metrics and batching
+############################################################
+
+def _percentiles(values, scale=1000.):
+    if not values:
+        return {"p50": None, "p90": None, "p99": None, "mean": None}
+    values = np.asarray(values) * scale
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {"p50": float(p50), "p90": float(p90), "p99": float(p99), "mean": float(values.mean())}
+
+
+class Metrics(object):
+    """Counters of a MicroBatcher. Timings keep the last `window` values."""
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.completed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.batches = 0
+        self.batch_sizes = collections.Counter()
+        self.latencies = collections.deque(maxlen=window)
+        self.queue_waits = collections.deque(maxlen=window)
+        self.batch_times = collections.deque(maxlen=window)
+        self.completion_times = collections.deque(maxlen=window)
+
+    def record_batch(self, arrivals, started, finished, failed=False):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes[len(arrivals)] += 1
+            self.batch_times.append(finished - started)
+            for arrived in arrivals:
+                self.queue_waits.append(started - arrived)
+                self.latencies.append(finished - arrived)
+                self.completion_times.append(finished)
+            if failed:
+                self.errors += len(arrivals)
+            else:
+                self.completed += len(arrivals)
+
+    def snapshot(self, recent=60.):
+        """The counters as a JSON dict. Latencies are in milliseconds and
+        throughput in images per second, overall and over the last
+        `recent` seconds.
+        """
+        now = time.time()
+        with self.lock:
+            uptime = now - self.started
+            recent_count = sum(1 for t in self.completion_times if t >= now - recent)
+            images = sum(size * count for size, count in self.batch_sizes.items())
+            return {
+                "uptime_s": uptime,
+                "requests": self.requests,
+                "completed": self.completed,
+                "errors": self.errors,
+                "rejected": self.rejected,
+                "batches": self.batches,
+                "mean_batch_size": images / float(self.batches) if self.batches else 0.,
+                "batch_sizes": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                "throughput": self.completed / uptime if uptime > 0 else 0.,
+                "recent_throughput": recent_count / min(recent, uptime) if uptime > 0 else 0.,
+                "latency_ms": _percentiles(list(self.latencies)),
+                "queue_wait_ms": _percentiles(list(self.queue_waits)),
+                "batch_ms": _percentiles(list(self.batch_times)),
+            }
+
+
+class MicroBatcher(object):
+    """Runs queued images through predict_fn in batches, on one thread.
+
+    predict_fn: Function of a list of images -> a list of results.
+    max_batch_size: Images per predict_fn call.
+    max_wait_ms: Longest a batch waits to fill after its first image.
+    max_queue: Queued images before submit() raises QueueFull.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_wait_ms=10., max_queue=256,
+                 metrics=None):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.queue = queue.Queue(max_queue)
+        self.metrics = metrics or Metrics()
+        self._closing = False
+        self._thread = threading.Thread(target=self._run, name="micro-batcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def submit(self, image):
+        """Queues an image. Returns a Future of its result."""
+        future = Future()
+        with self.metrics.lock:
+            self.metrics.requests += 1
+        try:
+            self.queue.put_nowait((image, future, time.time()))
+        except queue.Full:
+            with self.metrics.lock:
+                self.metrics.rejected += 1
+            raise QueueFull("{} requests queued".format(self.queue.maxsize))
+        return future
+
+    def predict(self, image, timeout=None):
+        return self.submit(image).result(timeout)
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._closing = True
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while not self._closing:
+            batch = self._collect()
+            if batch is None:
+                break
+            images, futures, arrivals = zip(*batch)
+            started = time.time()
+            try:
+                results = self.predict_fn(list(images))
+            except Exception as e:
+                logging.exception("Prediction of a batch of {} failed".format(len(batch)))
+                self.metrics.record_batch(arrivals, started, time.time(), failed=True)
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            self.metrics.record_batch(arrivals, started, time.time())
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def close(self):
+        """Finishes the queued requests and stops the thread."""
+        self.queue.put(None)
+        self._thread.join()
+
+
+############################################################
+#  Model predict functions
+############################################################
+
+def in_session(fn, keras_model):
+    """Runs fn in the graph and session of the thread that built the
+    model, the batcher calls it from its own thread.
+    """
+    import keras.backend as K
+    # Keras builds the predict function lazily, which isn't thread safe
+    keras_model._make_predict_function()
+    session = K.get_session()
+    graph = session.graph
+
+    def run(*args, **kwargs):
+        with graph.as_default(), session.as_default():
+            return fn(*args, **kwargs)
+    return run
+
+
+def input_channels(keras_model):
+    import keras.backend as K
+    return K.int_shape(keras_model.inputs[0])[-1]
+
+
+def decode_image(data, canny=False):
+    """An encoded image -> [height, width, 3] BGR, like cv2.imread. With
+    canny, the Canny edges are added as a 4th channel like
+    ImageDataSetForMask.load_image().
+    """
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("The request body isn't an image")
+    if canny:
+        image = np.dstack([image, cv2.Canny(image, 100, 200)])
+    return image
+
+
+def mask_response(probabilities, shape, class_names, threshold=0.5):
+    """JSON of [H, W, classes] mask probabilities, sized to shape."""
+    height, width = shape[:2]
+    if probabilities.shape[:2] != (height, width):
+        probabilities = cv2.resize(probabilities, (width, height), interpolation=cv2.INTER_LINEAR)
+        if probabilities.ndim == 2:
+            probabilities = probabilities[..., np.newaxis]
+    masks = []
+    for c in range(probabilities.shape[-1]):
+        mask = probabilities[..., c] >= threshold
+        masks.append({
+            "class": class_names[c] if class_names else str(c),
+            "rle": utils.mask_to_rle(mask),
+            "pixels": int(mask.sum()),
+            "max_probability": float(probabilities[..., c].max()),
+        })
+    return {"height": height, "width": width, "masks": masks}
+
+
+def mask_predict_fn(keras_model, config, class_names=CLASS_NAMES, threshold=0.5, output_index=0,
+                    preprocess=None, output_shape=None):
+    """Predict function of a mask model. The masks are returned at the
+    request image size, or at output_shape [height, width] if given.
+    """
+    from mymrcnn import cascade
+    forward = in_session(cascade.keras_predict_fn(
+        keras_model, config, output_index=output_index, preprocess=preprocess), keras_model)
+
+    def predict(images):
+        outputs = forward(images)
+        return [mask_response(output, output_shape or image.shape, class_names, threshold)
+                for image, output in zip(images, outputs)]
+    return predict
+
+
+def classifier_predict_fn(keras_model, config, class_names=CLASS_NAMES, output_index=0, channels=None):
+    """Predict function of the myBackboneModel_Multi classifier. Its
+    first output is the class probabilities, [n, 1, 1, num_classes].
+    """
+    from mymrcnn import cascade
+    forward = in_session(cascade.keras_predict_fn(
+        keras_model, config, output_index=output_index, channels=channels), keras_model)
+
+    def predict(images):
+        return [{"probabilities": {name: float(p)
+                                   for name, p in zip(class_names, np.reshape(probabilities, -1))}}
+                for probabilities in forward(images)]
+    return predict
+
+
+def detect_predict_fn(model, class_names=CLASS_NAMES):
+    """Predict function of an inference mode MaskRCNN. Batches are padded
+    to config.BATCH_SIZE, so serve it with max_batch_size BATCH_SIZE.
+    """
+    batch_size = model.config.BATCH_SIZE
+    detect = in_session(model.detect, model.keras_model)
+
+    def predict(images):
+        # detect() takes exactly BATCH_SIZE images
+        padded = list(images) + [images[-1]] * (batch_size - len(images))
+        results = []
+        for image, r in zip(images, detect(padded)):
+            instances = []
+            for i, class_id in enumerate(r["class_ids"]):
+                instances.append({
+                    # Class 0 is the background
+                    "class": class_names[class_id - 1] if class_names else str(class_id),
+                    "class_id": int(class_id),
+                    "score": float(r["scores"][i]),
+                    "roi": [int(v) for v in r["rois"][i]],
+                    "rle": utils.mask_to_rle(r["masks"][..., i]),
+                })
+            results.append({"height": image.shape[0], "width": image.shape[1],
+                            "instances": instances})
+        return results
+    return predict
+
+
+############################################################
+#  HTTP server
+############################################################
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        batcher = self.server.batcher
+        if self.path == "/metrics":
+            metrics = batcher.metrics.snapshot()
+            metrics["queue_depth"] = batcher.depth
+            metrics["max_batch_size"] = batcher.max_batch_size
+            metrics["max_wait_ms"] = 1000 * batcher.max_wait
+            self._reply(200, metrics)
+        elif self.path == "/health":
+            self._reply(200, {"status": "ok"})
+        else:
+            self._reply(404, {"error": "Unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._reply(404, {"error": "Unknown path {}".format(self.path)})
+            return
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            image = self.server.decode(data)
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+            return
+        try:
+            future = self.server.batcher.submit(image)
+        except QueueFull as e:
+            self._reply(503, {"error": str(e)})
+            return
+        try:
+            self._reply(200, future.result(self.server.timeout_s))
+        except Exception as e:
+            self._reply(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+    def log_message(self, format, *args):
+        logging.debug("%s - " + format, self.address_string(), *args)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class InferenceServer(object):
+    """HTTP server of one predict function.
+
+    decode: Function request body -> image, decode_image by default.
+    timeout_s: Longest a request waits for its result.
+    port: 0 picks a free port, see url.
+    """
+
+    def __init__(self, predict_fn, host="127.0.0.1", port=8500, max_batch_size=8,
+                 max_wait_ms=10., max_queue=256, decode=decode_image, timeout_s=60.):
+        self.batcher = MicroBatcher(predict_fn, max_batch_size, max_wait_ms, max_queue)
+        self.httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self.httpd.batcher = self.batcher
+        self.httpd.decode = decode
+        self.httpd.timeout_s = timeout_s
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def warmup(self, image, count=2):
+        """Runs a few batches so the first requests don't pay the graph
+        setup.
+        """
+        for _ in range(count):
+            self.batcher.predict(image)
+        return self
+
+    def start(self):
+        """Serves on a background thread."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name="inference-server")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        logging.info("Serving on {}".format(self.url))
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._thread is not None:
+            self.httpd.shutdown()
+            self._thread.join()
+            self._thread = None
+        self.httpd.server_close()
+        self.batcher.close()
+
+
+############################################################
+#  Load generator
+############################################################
+
+def post_image(url, data, timeout=60.):
+    """POSTs encoded image bytes to /predict. Returns the decoded JSON."""
+    req = urlrequest.Request(url.rstrip("/") + "/predict", data=data,
+                             headers={"Content-Type": "application/octet-stream"})
+    response = urlrequest.urlopen(req, timeout=timeout)
+    try:
+        return json.loads(response.read().decode("utf-8"))
+    finally:
+        response.close()
+
+
+def get_metrics(url, timeout=10.):
+    response = urlrequest.urlopen(url.rstrip("/") + "/metrics", timeout=timeout)
+    try:
+        return json.loads(response.read().decode("utf-8"))
+    finally:
+        response.close()
+
+
+def load_test(url, payloads, requests=200, concurrency=8, timeout=60.):
+    """Sends `requests` POSTs of the encoded images in payloads, cycling
+    through them, from `concurrency` client threads.
+
+    Returns a dict of the throughput, the client side latencies in
+    milliseconds, the status counts and the server metrics after the run.
+    """
+    lock = threading.Lock()
+    counter = [0]
+    latencies, statuses = [], collections.Counter()
+
+    def client():
+        while True:
+            with lock:
+                index = counter[0]
+                counter[0] += 1
+            if index >= requests:
+                return
+            start = time.time()
+            try:
+                post_image(url, payloads[index % len(payloads)], timeout)
+                status = 200
+            except HTTPError as e:
+                status = e.code
+            except (socket.timeout, OSError):
+                status = "error"
+            with lock:
+                latencies.append(time.time() - start)
+                statuses[str(status)] += 1
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return {
+        "requests": requests,
+        "concurrency": concurrency,
+        "seconds": elapsed,
+        "throughput": statuses["200"] / elapsed,
+        "latency_ms": _percentiles(latencies),
+        "statuses": dict(statuses),
+        "server": get_metrics(url),
+    }
@@ -0,0 +1,171 @@
+"""
+tf.data input pipeline for the ImageDataSet classes.
+
+fit_generator with use_multiprocessing forks the process once per core and
+pickles every batch back. training_dataset() builds the same batches as
+datagenerator.data_generator() in a tf.data pipeline instead, run by the
+TensorFlow thread pool of the training process:
+
+    image indices
+      -> decode       dataset.load_image / load_mask, num_parallel_calls
+      -> cache        optional, decoded samples in memory or a file
+      -> shuffle, repeat
+      -> prepare      resize to IMAGE_MAX_DIM x IMAGE_MIN_DIM and mold, in
+                      TF ops, num_parallel_calls
+      -> batch, prefetch
+
+Decoding goes through the data set's own load methods, so the image
+pyramid, Canny channels and mask layouts are those of the generator. cv2
+releases the GIL while it decodes, so the decode calls run in parallel.
+
+batches() turns the dataset into the generator fit_generator expects,
+pulling each batch with one session.run. Train with workers=0 then, the
+parallelism is in the pipeline. Models use it when
+config.INPUT_PIPELINE is "tf.data".
+
+The order comes from a samplers.Sampler when one is given, so resumed runs
+continue it. A cache stores samples in first pass order, so cached
+pipelines shuffle with a buffer instead and don't resume the order.
+"""
+
+import logging
+import numpy as np
+import tensorflow as tf
+import keras.backend as K
+
+
+def _autotune(parallel_calls):
+    if parallel_calls is not None:
+        return parallel_calls
+    experimental = getattr(tf.data, "experimental", None)
+    if experimental is not None and hasattr(experimental, "AUTOTUNE"):
+        return experimental.AUTOTUNE
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def _ignore_errors(samples):
+    # Skip images that fail to load, like data_generator()
+    experimental = getattr(tf.data, "experimental", None)
+    if experimental is not None and hasattr(experimental, "ignore_errors"):
+        return samples.apply(experimental.ignore_errors())
+    return samples.apply(tf.contrib.data.ignore_errors())
+
+
+def _resize_bilinear(image, size):
+    # Half pixel centers sample like cv2.INTER_LINEAR
+    try:
+        return tf.image.resize_bilinear(image[tf.newaxis], size, half_pixel_centers=True)[0]
+    except TypeError:
+        return tf.image.resize_images(image, size)
+
+
+def decode_fn(dataset, image_ids):
+    """Function of an index into image_ids -> (image, mask) as float32,
+    through the data set's load methods.
+    """
+    def decode(index):
+        image_id = image_ids[index]
+        try:
+            image = dataset.load_image(image_id)
+            mask, _ = dataset.load_mask(image_id)
+        except Exception:
+            logging.exception("Error processing image {}".format(dataset.image_info[image_id]))
+            raise
+        return image.astype(np.float32), mask.astype(np.float32)
+    return decode
+
+
+def training_dataset(dataset, config, batch_size=None, shuffle=True, sampler=None,
+                     parallel_calls=None, cache=None, shuffle_buffer=256, prefetch=4,
+                     batch_augmentation=None, seed=None):
+    """The batches of data_generator() as a tf.data.Dataset of
+    (images, masks), repeating forever.
+
+    dataset: An ImageDataSet, ImageDataSetForMRCNN or ImageDataSetForMask.
+    batch_size: Defaults to config.BATCH_SIZE.
+    sampler: Optional. A samplers.Sampler with one shard, giving the order.
+    parallel_calls: Decode and prepare calls in flight. None autotunes.
+    cache: Optional. "" caches decoded samples in memory, a path in files.
+    shuffle_buffer: Shuffle buffer of cached pipelines, in samples.
+    batch_augmentation: Optional. An augmentation.BatchAugmenter applied
+        to each batch.
+    """
+    if sampler is not None and cache is not None:
+        raise ValueError("A cached pipeline can't follow the sampler order")
+    batch_size = batch_size or config.BATCH_SIZE
+    parallel_calls = _autotune(parallel_calls)
+    image_ids = np.copy(dataset.image_ids)
+    # Probe one sample for the channel counts
+    image, mask = decode_fn(dataset, image_ids)(0)
+    image_shape = [None, None, image.shape[-1]]
+    mask_shape = [None, None, mask.shape[-1]]
+
+    decode = decode_fn(dataset, image_ids)
+
+    def load(index):
+        image, mask = tf.py_func(decode, [index], [tf.float32, tf.float32], stateful=False)
+        image.set_shape(image_shape)
+        mask.set_shape(mask_shape)
+        return image, mask
+
+    if sampler is not None:
+        indices = tf.data.Dataset.from_generator(lambda: sampler, tf.int64, tf.TensorShape([]))
+    else:
+        indices = tf.data.Dataset.range(len(image_ids))
+        if shuffle and cache is None:
+            indices = indices.shuffle(len(image_ids), seed=seed, reshuffle_each_iteration=True)
+        if cache is None:
+            indices = indices.repeat()
+    samples = _ignore_errors(indices.map(load, num_parallel_calls=parallel_calls))
+    if cache is not None:
+        samples = samples.cache(cache)
+        if shuffle:
+            samples = samples.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+        samples = samples.repeat()
+
+    size = [config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM]
+
+    def prepare(image, mask):
+        image = _resize_bilinear(image, size)
+        # datagenerator.mold_image, minus the per image channel means
+        image = image - tf.reduce_mean(image, axis=[0, 1], keepdims=True)
+        return image, mask
+
+    samples = samples.map(prepare, num_parallel_calls=parallel_calls)
+    try:
+        batches = samples.batch(batch_size, drop_remainder=True)
+    except TypeError:
+        batches = samples.apply(tf.contrib.data.batch_and_drop_remainder(batch_size))
+    if batch_augmentation is not None:
+        def augment(images, masks):
+            images, masks = tf.py_func(lambda i, m: batch_augmentation(i, m), [images, masks],
+                                       [tf.float32, tf.float32], stateful=True)
+            return images, masks
+        batches = batches.map(augment, num_parallel_calls=1)
+    return batches.prefetch(prefetch)
+
+
+def batches(tf_dataset, session=None):
+    """Generator of ([images, masks], []) from a training_dataset(), for
+    fit_generator. The pipeline is built in the Keras session's graph.
+    """
+    session = session or K.get_session()
+    with session.graph.as_default():
+        next_batch = tf_dataset.make_one_shot_iterator().get_next()
+    while True:
+        images, masks = session.run(next_batch)
+        yield [images, masks], []
+
+
+def training_generators(train_dataset, val_dataset, config, sampler=None):
+    """The train and validation generators of MyBackboneModel.train() on
+    tf.data, with the TFDATA_* settings of the config.
+    """
+    cache = config.TFDATA_CACHE
+    train = training_dataset(train_dataset, config, sampler=sampler if cache is None else None,
+                             parallel_calls=config.TFDATA_PARALLEL_CALLS, cache=cache,
+                             prefetch=config.TFDATA_PREFETCH)
+    val = training_dataset(val_dataset, config, parallel_calls=config.TFDATA_PARALLEL_CALLS,
+                           cache=cache and cache + "_val", prefetch=config.TFDATA_PREFETCH)
+    return batches(train), batches(val)
@@ -0,0 +1,249 @@
+"""
+Tiled inference on full resolution images.
+
+The models take fixed 384x576 inputs, so images are usually shrunk to that
+size as a whole. TiledPredictor instead resizes them by an explicit scale
+(1.0 is full resolution), cuts them into overlapping tiles of the model
+input size, and stitches the tile predictions back together. The scale is
+the trade between resolution and throughput: 2100x1400 at 1.0 is 20 tiles
+per image, at 0.5 it is 4.
+
+- Tiles of several images share each forward pass, batch_size tiles at a
+  time.
+- Overlaps are blended with a raised cosine window. Each pixel is the
+  window weighted mean of the tiles covering it, so seams fade out
+  instead of showing tile borders.
+- Every image gets one canvas, allocated once, plus a weight plane at
+  the output resolution. At most max_pending images are in flight, which
+  bounds memory whatever the number of images.
+
+Usage:
+
+    predictor = TiledPredictor.from_model(model.keras_model, config, scale=0.5)
+    for index, prediction in predictor.predict_iter(images):
+        ...
+"""
+
+import collections
+import numpy as np
+import cv2
+
+
+def tile_origins(length, tile, overlap):
+    """Start offsets of tiles covering [0, length). The last tile is
+    aligned to the end, so it may overlap its neighbour more.
+    """
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    origins = list(range(0, length - tile + 1, stride))
+    if origins[-1] != length - tile:
+        origins.append(length - tile)
+    return origins
+
+
+def blend_window(shape, overlap, floor=1e-3):
+    """Weights [height, width] of one tile: 1 inside, a raised cosine over
+    the `overlap` pixels of each border. The floor keeps image borders,
+    covered by one tile only, from dividing by zero.
+    """
+    def ramp(n, o):
+        o = min(o, n // 2)
+        weights = np.ones(n, dtype=np.float32)
+        if o > 0:
+            edge = 0.5 - 0.5 * np.cos(np.pi * (np.arange(o) + 0.5) / o)
+            weights[:o] = edge
+            weights[n - o:] = edge[::-1]
+        return np.maximum(weights, floor)
+    return np.outer(ramp(shape[0], overlap[0]), ramp(shape[1], overlap[1]))
+
+
+class _Canvas(object):
+    """Blended output of one image. It is allocated with the first tile
+    prediction, once the output scale and channel count are known.
+
+    shape: (height, width) of the padded image.
+    image_shape: (height, width) before padding.
+    tiles: Number of tiles still to add.
+    """
+
+    def __init__(self, shape, image_shape, tiles):
+        self.shape = shape
+        self.image_shape = image_shape
+        self.remaining = tiles
+        self.values = None
+        self.weights = None
+
+    def allocate(self, ratio, channels):
+        height = int(round(self.shape[0] * ratio[0]))
+        width = int(round(self.shape[1] * ratio[1]))
+        self.values = np.zeros((height, width, channels), dtype=np.float32)
+        self.weights = np.zeros((height, width), dtype=np.float32)
+
+    def add(self, y, x, prediction, window):
+        h, w = window.shape
+        self.values[y:y + h, x:x + w] += prediction * window[..., np.newaxis]
+        self.weights[y:y + h, x:x + w] += window
+        self.remaining -= 1
+
+    def result(self):
+        return self.values / self.weights[..., np.newaxis]
+
+
+class TiledPredictor(object):
+    """Runs a tile model over images of any size.
+
+    predict_fn: Function [n, tile height, tile width, channels] ->
+        [n, out height, out width, out channels]. The output may be smaller
+        than the tile (a strided mask head), as long as it is a fixed scale
+        of it.
+    tile_shape: (height, width) of the model input.
+    overlap: Pixels shared by neighbouring tiles, at the tile resolution.
+    batch_size: Tiles per forward pass.
+    scale: Resize factor of the images before tiling. None resizes each
+        image to exactly one tile, the way the models are trained.
+    output_shape: Optional. (height, width) to resize the predictions to,
+        e.g. (350, 525) for submissions. By default they are at the
+        scaled image resolution times the output/tile ratio.
+    preprocess: Optional. Function applied to each resized image before
+        tiling, e.g. datagenerator.mold_image.
+    channels: Optional. Input channels of the model. Extra image channels
+        are dropped.
+    max_pending: Images with an open canvas at a time.
+    """
+
+    def __init__(self, predict_fn, tile_shape, overlap=64, batch_size=8, scale=None,
+                 output_shape=None, preprocess=None, channels=None, max_pending=2):
+        assert overlap < min(tile_shape) // 2, "overlap must be under half a tile"
+        self.predict_fn = predict_fn
+        self.tile_shape = tuple(tile_shape)
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.scale = scale
+        self.output_shape = output_shape
+        self.preprocess = preprocess
+        self.channels = channels
+        self.max_pending = max(1, max_pending)
+        # Output tile shape, its ratio to the tile and the window, known
+        # after the first batch
+        self.out_shape = None
+        self.ratio = None
+        self.window = None
+
+    @classmethod
+    def from_model(cls, keras_model, config, inference_model=None, **kwargs):
+        """A predictor over the inference model of a trained model. Its
+        input size is the tile size, and images are molded like in training.
+        inference_model: Optional. The export_inference_model() of
+            keras_model, if the caller keeps it. Exporting rebuilds and folds
+            the whole graph.
+        Other arguments default to config.INFERENCE_TILE_*.
+        """
+        import keras.backend as K
+        from mymrcnn import datagenerator
+        from mymrcnn import inferenceexport
+        model = inference_model or inferenceexport.export_inference_model(keras_model)
+        _, height, width, channels = K.int_shape(model.input)
+
+        def predict_fn(tiles):
+            outputs = model.predict(tiles, batch_size=len(tiles))
+            return outputs[0] if isinstance(outputs, list) else outputs
+        kwargs.setdefault("overlap", config.INFERENCE_TILE_OVERLAP)
+        kwargs.setdefault("batch_size", config.INFERENCE_TILE_BATCH)
+        kwargs.setdefault("scale", config.INFERENCE_TILE_SCALE)
+        kwargs.setdefault("preprocess", lambda image: datagenerator.mold_image(image, config))
+        kwargs.setdefault("channels", channels)
+        return cls(predict_fn, (height, width), **kwargs)
+
+    def prepare(self, image):
+        """Resizes, preprocesses and pads one image. Returns the image and
+        its (height, width) before padding.
+        """
+        if self.channels is not None and image.ndim == 3:
+            image = image[..., :self.channels]
+        th, tw = self.tile_shape
+        if self.scale is None:
+            size = (tw, th)
+        else:
+            size = (int(round(image.shape[1] * self.scale)), int(round(image.shape[0] * self.scale)))
+        if (image.shape[1], image.shape[0]) != size:
+            image = cv2.resize(image.astype(np.float32), size, interpolation=cv2.INTER_LINEAR)
+        image = image.astype(np.float32)
+        if self.preprocess is not None:
+            image = self.preprocess(image)
+        shape = image.shape[:2]
+        # Images smaller than a tile are padded up to one
+        pad_y, pad_x = max(0, th - shape[0]), max(0, tw - shape[1])
+        if pad_y or pad_x:
+            image = cv2.copyMakeBorder(image, 0, pad_y, 0, pad_x, cv2.BORDER_REFLECT_101)
+        return image, shape
+
+    def _output_offset(self, origin, out_length, tile, out_tile):
+        """Where a tile starting at origin lands on the output canvas."""
+        offset = int(round(origin * out_tile / float(tile)))
+        return min(offset, out_length - out_tile)
+
+    def _run(self, queue, canvases):
+        batch = queue[:self.batch_size]
+        del queue[:self.batch_size]
+        predictions = self.predict_fn(np.stack([tile for _, _, _, tile in batch]))
+        if self.out_shape is None:
+            self.out_shape = predictions.shape[1:3]
+            self.ratio = (self.out_shape[0] / float(self.tile_shape[0]),
+                          self.out_shape[1] / float(self.tile_shape[1]))
+            self.window = blend_window(self.out_shape, (int(round(self.overlap * self.ratio[0])),
+                                                        int(round(self.overlap * self.ratio[1]))))
+        for (index, y, x, _), prediction in zip(batch, predictions):
+            canvas = canvases[index]
+            if canvas.values is None:
+                canvas.allocate(self.ratio, prediction.shape[-1])
+            oy = self._output_offset(y, canvas.values.shape[0], self.tile_shape[0], self.out_shape[0])
+            ox = self._output_offset(x, canvas.values.shape[1], self.tile_shape[1], self.out_shape[1])
+            canvas.add(oy, ox, prediction, self.window)
+
+    def _finished(self, canvases):
+        while canvases:
+            index, canvas = next(iter(canvases.items()))
+            if canvas.remaining:
+                return
+            del canvases[index]
+            yield index, self._finish(canvas)
+
+    def _finish(self, canvas):
+        result = canvas.result()
+        # Crop the padding, at the output resolution
+        height = int(round(canvas.image_shape[0] * self.ratio[0]))
+        width = int(round(canvas.image_shape[1] * self.ratio[1]))
+        result = result[:height, :width]
+        if self.output_shape is not None:
+            channels = result.shape[-1]
+            result = cv2.resize(result, (self.output_shape[1], self.output_shape[0]),
+                                interpolation=cv2.INTER_LINEAR)
+            result = result.reshape(tuple(self.output_shape) + (channels,))
+        return result
+
+    def predict_iter(self, images):
+        """Yields (index, prediction) for an iterable of images, in order.
+        images: [height, width, channels] arrays, of any size.
+        """
+        queue = []
+        canvases = collections.OrderedDict()
+        for index, image in enumerate(images):
+            image, shape = self.prepare(image)
+            ys = tile_origins(image.shape[0], self.tile_shape[0], self.overlap)
+            xs = tile_origins(image.shape[1], self.tile_shape[1], self.overlap)
+            canvases[index] = _Canvas(image.shape[:2], shape, len(ys) * len(xs))
+            th, tw = self.tile_shape
+            queue.extend((index, y, x, image[y:y + th, x:x + tw]) for y in ys for x in xs)
+            while len(queue) >= self.batch_size or (len(canvases) > self.max_pending and queue):
+                self._run(queue, canvases)
+                for result in self._finished(canvases):
+                    yield result
+        while queue:
+            self._run(queue, canvases)
+            for result in self._finished(canvases):
+                yield result
+
+    def predict(self, images):
+        """Predictions of all images, as a list."""
+        return [prediction for _, prediction in self.predict_iter(images)]
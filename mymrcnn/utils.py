@@ -14,6 +14,7 @@ import math
 import random
 import numpy as np
 import tensorflow as tf
+import cv2
 import scipy
 import skimage.color
 import skimage.io
@@ -37,24 +38,81 @@ def extract_bboxes(mask):
 
     Returns: bbox array [num_instances, (y1, x1, y2, x2)].
     """
-    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
-    for i in range(mask.shape[-1]):
-        m = mask[:, :, i]
-        # Bounding box.
-        horizontal_indicies = np.where(np.any(m, axis=0))[0]
-        vertical_indicies = np.where(np.any(m, axis=1))[0]
-        if horizontal_indicies.shape[0]:
-            x1, x2 = horizontal_indicies[[0, -1]]
-            y1, y2 = vertical_indicies[[0, -1]]
-            # x2 and y2 should not be part of the box. Increment by 1.
-            x2 += 1
-            y2 += 1
-        else:
-            # No mask for this instance. Might happen due to
-            # resizing or cropping. Set bbox to zeros
-            x1, x2, y1, y2 = 0, 0, 0, 0
-        boxes[i] = np.array([y1, x1, y2, x2])
-    return boxes.astype(np.int32)
+    if mask.shape[-1] == 0:
+        return np.zeros([0, 4], dtype=np.int32)
+    # Reduce all instances at once: [width, num_instances] and
+    # [height, num_instances]
+    horizontal = np.any(mask, axis=0)
+    vertical = np.any(mask, axis=1)
+    # First set index, and one past the last set index found from the
+    # reversed arrays. x2 and y2 are not part of the box.
+    x1 = np.argmax(horizontal, axis=0)
+    x2 = horizontal.shape[0] - np.argmax(horizontal[::-1], axis=0)
+    y1 = np.argmax(vertical, axis=0)
+    y2 = vertical.shape[0] - np.argmax(vertical[::-1], axis=0)
+    boxes = np.stack([y1, x1, y2, x2], axis=1).astype(np.int32)
+    # No mask for this instance. Might happen due to
+    # resizing or cropping. Set bbox to zeros
+    boxes[~np.any(horizontal, axis=0)] = 0
+    return boxes
+
+
+def _parse_rle(rle):
+    """Returns the (starts, lengths) arrays of one RLE mask. starts are
+    0-based. Accepts an RLE string, a flat sequence of numbers, or -1 / ""
+    for an empty mask.
+    """
+    if isinstance(rle, str):
+        rle = np.array(rle.split(), dtype=np.int64)
+    elif rle is None or np.isscalar(rle):
+        rle = np.zeros([0], dtype=np.int64)
+    else:
+        rle = np.asarray(rle, dtype=np.int64).ravel()
+    return rle[0::2] - 1, rle[1::2]
+
+
+def mask_to_rle(mask):
+    """Run length encodes a [height, width] mask in the train.csv format:
+    "start length" pairs, 1-based starts counted down the columns first.
+    An empty mask is "".
+    """
+    pixels = np.concatenate([[0], np.asarray(mask, dtype=bool).T.ravel(), [0]]).astype(np.int8)
+    runs = np.flatnonzero(pixels[1:] != pixels[:-1]) + 1
+    runs[1::2] -= runs[::2]
+    return " ".join(str(x) for x in runs)
+
+
+def extract_bboxes_rle(rles, height, width):
+    """Compute bounding boxes straight from run length encoded masks,
+    without decoding them.
+
+    rles: List of RLE masks, one per instance. Each is a string of
+        "start length" pairs with 1-based starts counted down the columns
+        first (the train.csv format), or the same numbers as a sequence.
+        -1 or "" marks an empty mask.
+    height, width: The size of the decoded masks.
+
+    Returns: bbox array [num_instances, (y1, x1, y2, x2)], the same as
+    extract_bboxes() on the decoded masks.
+    """
+    boxes = np.zeros([len(rles), 4], dtype=np.int32)
+    for i, rle in enumerate(rles):
+        starts, lengths = _parse_rle(rle)
+        keep = lengths > 0
+        if not np.any(keep):
+            continue
+        starts, lengths = starts[keep], lengths[keep]
+        ends = starts + lengths - 1
+        rows = starts % height
+        # A run that crosses into the next column covers the bottom row of
+        # one column and the top row of the next.
+        wraps = rows + lengths > height
+        x1 = starts.min() // height
+        x2 = min(ends.max() // height + 1, width)
+        y1 = 0 if np.any(wraps) else rows.min()
+        y2 = height if np.any(wraps) else (rows + lengths).max()
+        boxes[i] = [y1, x1, y2, x2]
+    return boxes
 
 
 def compute_iou(box, boxes, box_area, boxes_area):
@@ -236,6 +294,65 @@ def box_refinement(box, gt_box):
 #  Dataset
 ############################################################
 
+class _Record(object):
+    """Base of the __slots__ records in Dataset.image_info and class_info.
+    They replace the per-item dicts but keep dict style reads working,
+    e.g. dataset.image_info[i]["id"].
+    """
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            extra = getattr(self, "extra", None)
+            if extra and key in extra:
+                return extra[key]
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join(
+            "{}={!r}".format(k, getattr(self, k)) for k in self.__slots__))
+
+
+class ClassRecord(_Record):
+    """One entry of Dataset.class_info."""
+    __slots__ = ("source", "id", "name")
+
+    def __init__(self, source, id, name):
+        self.source = source
+        self.id = id
+        self.name = name
+
+
+class ImageRecord(_Record):
+    """One entry of Dataset.image_info. Keyword arguments other than width
+    and height go to extra, which stays None when there are none.
+    """
+    __slots__ = ("id", "source", "path", "width", "height", "extra")
+
+    def __init__(self, id, source, path, width=None, height=None, **kwargs):
+        self.id = id
+        self.source = source
+        self.path = path
+        self.width = width
+        self.height = height
+        self.extra = kwargs or None
+
+
 class Dataset(object):
     """The base class for dataset classes.
     To use it, create a new class that adds functions specific to the dataset
@@ -256,31 +373,22 @@ class Dataset(object):
         self._image_ids = []
         self.image_info = []
         # Background is always the first class
-        self.class_info = [{"source": "", "id": 0, "name": "BG"}]
+        self.class_info = [ClassRecord("", 0, "BG")]
         self.source_class_ids = {}
+        self._image_from_source_map = None
 
     def add_class(self, source, class_id, class_name):
         assert "." not in source, "Source name cannot contain a dot"
         # Does the class exist already?
         for info in self.class_info:
-            if info['source'] == source and info["id"] == class_id:
+            if info.source == source and info.id == class_id:
                 # source.class_id combination already available, skip
                 return
         # Add the class
-        self.class_info.append({
-            "source": source,
-            "id": class_id,
-            "name": class_name,
-        })
+        self.class_info.append(ClassRecord(source, class_id, class_name))
 
     def add_image(self, source, image_id, path, **kwargs):
-        image_info = {
-            "id": image_id,
-            "source": source,
-            "path": path,
-        }
-        image_info.update(kwargs)
-        self.image_info.append(image_info)
+        self.image_info.append(ImageRecord(image_id, source, path, **kwargs))
 
     def image_reference(self, image_id):
         """Return a link to the image in its source Website or details about
@@ -302,21 +410,22 @@ class Dataset(object):
             """Returns a shorter version of object names for cleaner display."""
             return ",".join(name.split(",")[:1])
 
-        # Build (or rebuild) everything else from the info dicts.
+        # Build (or rebuild) everything else from the info records. Only the
+        # class tables are built here. The per image map is built on first
+        # use, so prepare() is a single pass over the images.
         self.num_classes = len(self.class_info)
         self.class_ids = np.arange(self.num_classes)
-        self.class_names = [clean_name(c["name"]) for c in self.class_info]
+        self.class_names = [clean_name(c.name) for c in self.class_info]
         self.num_images = len(self.image_info)
         self._image_ids = np.arange(self.num_images)
+        self._image_from_source_map = None
 
-        # Mapping from source class and image IDs to internal IDs
-        self.class_from_source_map = {"{}.{}".format(info['source'], info['id']): id
+        # Mapping from source class IDs to internal IDs
+        self.class_from_source_map = {"{}.{}".format(info.source, info.id): id
                                       for info, id in zip(self.class_info, self.class_ids)}
-        self.image_from_source_map = {"{}.{}".format(info['source'], info['id']): id
-                                      for info, id in zip(self.image_info, self.image_ids)}
 
         # Map sources to class_ids they support
-        self.sources = list(set([i['source'] for i in self.class_info]))
+        self.sources = list(set([i.source for i in self.class_info]))
         self.source_class_ids = {}
         # Loop over datasets
         for source in self.sources:
@@ -324,9 +433,18 @@ class Dataset(object):
             # Find classes that belong to this dataset
             for i, info in enumerate(self.class_info):
                 # Include BG class in all datasets
-                if i == 0 or source == info['source']:
+                if i == 0 or source == info.source:
                     self.source_class_ids[source].append(i)
 
+    @property
+    def image_from_source_map(self):
+        """Mapping from "source.id" image IDs to internal IDs."""
+        if self._image_from_source_map is None:
+            self._image_from_source_map = {
+                "{}.{}".format(info.source, info.id): id
+                for info, id in zip(self.image_info, self.image_ids)}
+        return self._image_from_source_map
+
     def map_source_class_id(self, source_class_id):
         """Takes a source class ID and returns the int class ID assigned to it.
 
@@ -338,8 +456,8 @@ class Dataset(object):
     def get_source_class_id(self, class_id, source):
         """Map an internal class ID to the corresponding class ID in the source dataset."""
         info = self.class_info[class_id]
-        assert info['source'] == source
-        return info['id']
+        assert info.source == source
+        return info.id
 
     @property
     def image_ids(self):
@@ -350,13 +468,13 @@ class Dataset(object):
         Override this to return a URL to the image if it's available online for easy
         debugging.
         """
-        return self.image_info[image_id]["path"]
+        return self.image_info[image_id].path
 
     def load_image(self, image_id):
         """Load the specified image and return a [H,W,3] Numpy array.
         """
         # Load image
-        image = skimage.io.imread(self.image_info[image_id]['path'])
+        image = skimage.io.imread(self.image_info[image_id].path)
         # If grayscale. Convert to RGB for consistency.
         if image.ndim != 3:
             image = skimage.color.gray2rgb(image)
@@ -576,6 +694,294 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def batch_minimize_mask(bbox, mask, mini_shape, out=None):
+    """Batched, OpenCV-backed version of minimize_mask().
+
+    Crops every instance to its bounding box and resizes it to mini_shape
+    with cv2.resize() in a single pass over the instance stack. The result
+    is written into a preallocated uint8 buffer, so there is no float64
+    round trip per instance like in the scikit-image path.
+
+    bbox: [num_instances, (y1, x1, y2, x2)]
+    mask: [height, width, num_instances]. Mask pixels are either 1 or 0.
+    mini_shape: (height, width) of the mini-mask.
+    out: Optional. A preallocated uint8 or bool array of shape
+        [num_instances, mini_height, mini_width] to write the result into.
+
+    Returns: bool array [mini_height, mini_width, num_instances]. It's a
+        view on out when out is given.
+    """
+    count = mask.shape[-1]
+    if out is None:
+        out = np.empty((count,) + tuple(mini_shape), dtype=np.uint8)
+    buf = out.view(np.uint8)
+    # One transposing copy so every instance plane is contiguous
+    planes = np.ascontiguousarray(np.moveaxis(mask, -1, 0), dtype=np.uint8)
+    size = (mini_shape[1], mini_shape[0])
+    for i in range(count):
+        y1, x1, y2, x2 = bbox[i][:4]
+        m = planes[i, y1:y2, x1:x2]
+        if m.size == 0:
+            raise Exception("Invalid bounding box with area of zero")
+        # Bilinear interpolation of 0/1 values rounds to the nearest
+        # integer, like np.around() on the float result except at exact 0.5
+        # ties: cv2's fixed point rounding gives 1, np.around rounds half to
+        # even, 0. The masks benchmark allows for these in MAX_MISMATCH.
+        buf[i] = cv2.resize(m, size, interpolation=cv2.INTER_LINEAR)
+    return np.moveaxis(buf.view(bool), 0, -1)
+
+
+def batch_expand_mask(bbox, mini_mask, image_shape, out=None):
+    """Batched, OpenCV-backed version of expand_mask().
+
+    bbox: [num_instances, (y1, x1, y2, x2)]
+    mini_mask: [mini_height, mini_width, num_instances]
+    image_shape: [height, width, ...] of the full size mask.
+    out: Optional. A preallocated uint8 or bool array of shape
+        [height, width, num_instances]. It's cleared before writing.
+
+    Returns: bool array [height, width, num_instances].
+    """
+    count = mini_mask.shape[-1]
+    if out is None:
+        out = np.zeros(tuple(image_shape[:2]) + (count,), dtype=np.uint8)
+    else:
+        out[...] = 0
+    buf = out.view(np.uint8)
+    planes = np.ascontiguousarray(np.moveaxis(mini_mask, -1, 0), dtype=np.uint8)
+    for i in range(count):
+        y1, x1, y2, x2 = bbox[i][:4]
+        h = y2 - y1
+        w = x2 - x1
+        if h <= 0 or w <= 0:
+            continue
+        buf[y1:y2, x1:x2, i] = cv2.resize(planes[i], (w, h),
+                                          interpolation=cv2.INTER_LINEAR)
+    return buf.view(bool)
+
+
+def batch_unmold_mask(masks, boxes, image_shape, threshold=0.5, out=None):
+    """Batched, OpenCV-backed version of unmold_mask().
+
+    masks: [num_instances, height, width] of type float. The small masks
+        predicted by the network, typically MASK_SHAPE.
+    boxes: [num_instances, (y1, x1, y2, x2)]. The boxes to fit the masks in.
+    image_shape: [height, width, ...] of the original image.
+    threshold: Mask pixels >= threshold are set.
+    out: Optional. A preallocated bool array of shape
+        [height, width, num_instances]. It's cleared before writing.
+
+    Returns a bool array [height, width, num_instances] with the same layout
+    the per-instance unmold_mask() loop produced.
+    """
+    count = masks.shape[0]
+    if out is None:
+        out = np.zeros(tuple(image_shape[:2]) + (count,), dtype=bool)
+    else:
+        out[...] = False
+    masks = masks.astype(np.float32, copy=False)
+    for i in range(count):
+        y1, x1, y2, x2 = boxes[i][:4]
+        h = y2 - y1
+        w = x2 - x1
+        if h <= 0 or w <= 0:
+            continue
+        m = cv2.resize(masks[i], (w, h), interpolation=cv2.INTER_LINEAR)
+        out[y1:y2, x1:x2, i] = m >= threshold
+    return out
+
+
+############################################################
+#  Resize Plans
+############################################################
+
+# Dtypes cv2.resize() handles natively. Others go through float32.
+_CV2_RESIZE_DTYPES = (np.uint8, np.uint16, np.int16, np.float32, np.float64)
+# OpenCV's limit on channels per array (CV_CN_MAX).
+_CV2_MAX_CHANNELS = 512
+
+
+def _cv2_resize(image, size, interpolation):
+    """cv2.resize() that keeps the channel axis and the dtype of image.
+    size: (height, width) of the output.
+    """
+    dtype = image.dtype
+    if image.size == 0:
+        return np.zeros(tuple(size) + image.shape[2:], dtype=dtype)
+    if image.ndim == 3 and image.shape[2] > _CV2_MAX_CHANNELS:
+        return np.concatenate(
+            [_cv2_resize(image[..., i:i + _CV2_MAX_CHANNELS], size, interpolation)
+             for i in range(0, image.shape[2], _CV2_MAX_CHANNELS)], axis=2)
+    if dtype == np.bool_:
+        image = image.view(np.uint8)
+    elif dtype.type not in _CV2_RESIZE_DTYPES:
+        image = image.astype(np.float32)
+    resized = cv2.resize(image, (size[1], size[0]), interpolation=interpolation)
+    if resized.ndim < image.ndim:
+        # OpenCV drops a trailing axis of length 1
+        resized = resized[..., np.newaxis]
+    if dtype == np.bool_:
+        return resized.view(bool)
+    return resized.astype(dtype, copy=False)
+
+
+class ResizePlan(object):
+    """Precomputed geometry of resize_image() for one input shape.
+
+    resize_image() and resize_mask() recompute the scale, padding and window
+    for every image. When all inputs share a shape, build the plan once (see
+    get_resize_plan()) and reuse it. The resize itself runs on cv2.resize()
+    and cv2.copyMakeBorder() instead of scikit-image and scipy.
+
+    Arguments and modes are the same as resize_image().
+    """
+
+    def __init__(self, image_shape, min_dim=None, max_dim=None, min_scale=None,
+                 mode="square"):
+        h, w = image_shape[:2]
+        self.input_shape = (h, w)
+        self.mode = mode
+        self.min_dim = min_dim
+        self.scale = 1
+        self.padding = [(0, 0), (0, 0), (0, 0)]
+        self.window = (0, 0, h, w)
+
+        if mode != "none":
+            if min_dim:
+                # Scale up but not down
+                self.scale = max(1, min_dim / min(h, w))
+            if min_scale and self.scale < min_scale:
+                self.scale = min_scale
+            if max_dim and mode == "square":
+                image_max = max(h, w)
+                if round(image_max * self.scale) > max_dim:
+                    self.scale = max_dim / image_max
+        if self.scale != 1:
+            h, w = round(h * self.scale), round(w * self.scale)
+        self.resized_shape = (h, w)
+
+        if mode in ("none", "crop"):
+            pass
+        elif mode == "square":
+            top_pad = (max_dim - h) // 2
+            left_pad = (max_dim - w) // 2
+            self.padding = [(top_pad, max_dim - h - top_pad),
+                            (left_pad, max_dim - w - left_pad), (0, 0)]
+        elif mode == "pad64":
+            assert min_dim % 64 == 0, "Minimum dimension must be a multiple of 64"
+            max_h = h if h % 64 == 0 else h - (h % 64) + 64
+            max_w = w if w % 64 == 0 else w - (w % 64) + 64
+            top_pad = (max_h - h) // 2
+            left_pad = (max_w - w) // 2
+            self.padding = [(top_pad, max_h - h - top_pad),
+                            (left_pad, max_w - w - left_pad), (0, 0)]
+        else:
+            raise Exception("Mode {} not supported".format(mode))
+
+        (top_pad, bottom_pad), (left_pad, right_pad), _ = self.padding
+        if mode == "crop":
+            self.window = (0, 0, min_dim, min_dim)
+            self.output_shape = (min_dim, min_dim)
+        else:
+            self.window = (top_pad, left_pad, h + top_pad, w + left_pad)
+            self.output_shape = (h + top_pad + bottom_pad, w + left_pad + right_pad)
+
+    def _pick_crop(self):
+        """Picks a random crop. Only used in "crop" mode."""
+        h, w = self.resized_shape
+        y = random.randint(0, (h - self.min_dim))
+        x = random.randint(0, (w - self.min_dim))
+        return (y, x, self.min_dim, self.min_dim)
+
+    def _resize_pad(self, image, interpolation, crop=None):
+        if self.scale != 1:
+            image = _cv2_resize(image, self.resized_shape, interpolation)
+        if crop is not None:
+            y, x, h, w = crop
+            return image[y:y + h, x:x + w]
+        (top, bottom), (left, right), _ = self.padding
+        if image.size == 0:
+            return np.zeros(self.output_shape + image.shape[2:], dtype=image.dtype)
+        if image.ndim == 3 and image.shape[2] > _CV2_MAX_CHANNELS:
+            return np.pad(image, self.padding, mode='constant', constant_values=0)
+        if top or bottom or left or right:
+            dtype = image.dtype
+            padded = cv2.copyMakeBorder(
+                image.view(np.uint8) if dtype == np.bool_ else image,
+                top, bottom, left, right, cv2.BORDER_CONSTANT, value=0)
+            if padded.ndim < image.ndim:
+                # OpenCV drops a trailing axis of length 1
+                padded = padded[..., np.newaxis]
+            image = padded.view(bool) if dtype == np.bool_ else padded
+        return image
+
+    def resize_image(self, image):
+        """Drop-in replacement for resize_image() with this plan's geometry.
+
+        Returns the same (image, window, scale, padding, crop) tuple.
+        """
+        assert tuple(image.shape[:2]) == self.input_shape, \
+            "Image shape {} doesn't match the plan {}".format(image.shape[:2], self.input_shape)
+        crop = self._pick_crop() if self.mode == "crop" else None
+        image = self._resize_pad(image, cv2.INTER_LINEAR, crop)
+        return image, self.window, self.scale, self.padding, crop
+
+    def resize_mask(self, mask, crop=None):
+        """Drop-in replacement for resize_mask() with this plan's geometry.
+        Uses nearest neighbor interpolation like resize_mask().
+        """
+        return self._resize_pad(mask, cv2.INTER_NEAREST, crop)
+
+    def apply(self, images, masks=None):
+        """Resizes and pads a batch in one pass.
+
+        images: [batch, height, width, channels] or a list of such images.
+        masks: Optional. [batch, height, width, instances] or a list.
+
+        The outputs are preallocated with zero padding and every resized
+        image is written straight into its window, so no intermediate
+        padded copies are made.
+
+        Returns: (images, masks) with masks None if not given.
+        """
+        assert self.mode != "crop", "Batched apply doesn't support crop mode"
+        y1, x1, y2, x2 = self.window
+
+        def run(batch, interpolation):
+            first = batch[0]
+            out = np.zeros((len(batch),) + self.output_shape + first.shape[2:],
+                           dtype=first.dtype)
+            for i, item in enumerate(batch):
+                if self.scale != 1:
+                    item = _cv2_resize(item, self.resized_shape, interpolation)
+                out[i, y1:y2, x1:x2] = item
+            return out
+
+        images = run(images, cv2.INTER_LINEAR)
+        if masks is not None:
+            masks = run(masks, cv2.INTER_NEAREST)
+        return images, masks
+
+
+# Plans are small and inputs come in very few shapes, so keep them all.
+_RESIZE_PLANS = {}
+
+
+def get_resize_plan(image_shape, config):
+    """Returns the cached ResizePlan for an image shape and a config."""
+    key = (tuple(image_shape[:2]), config.IMAGE_MIN_DIM, config.IMAGE_MAX_DIM,
+           config.IMAGE_MIN_SCALE, config.IMAGE_RESIZE_MODE)
+    plan = _RESIZE_PLANS.get(key)
+    if plan is None:
+        plan = ResizePlan(image_shape,
+                          min_dim=config.IMAGE_MIN_DIM,
+                          max_dim=config.IMAGE_MAX_DIM,
+                          min_scale=config.IMAGE_MIN_SCALE,
+                          mode=config.IMAGE_RESIZE_MODE)
+        _RESIZE_PLANS[key] = plan
+    return plan
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -889,6 +1295,10 @@ def denorm_boxes(boxes, shape):
     return np.around(np.multiply(boxes, scale) + shift).astype(np.int32)
 
 
+# Checked once at import instead of on every resize() call
+_SKIMAGE_HAS_ANTI_ALIASING = LooseVersion(skimage.__version__) >= LooseVersion("0.14")
+
+
 def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,
            preserve_range=False, anti_aliasing=False, anti_aliasing_sigma=None):
     """A wrapper for Scikit-Image resize().
@@ -898,7 +1308,7 @@ def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,
     of skimage. This solves the problem by using different parameters per
     version. And it provides a central place to control resizing defaults.
     """
-    if LooseVersion(skimage.__version__) >= LooseVersion("0.14"):
+    if _SKIMAGE_HAS_ANTI_ALIASING:
         # New in 0.14: anti_aliasing. Default it to False for backward
         # compatibility with skimage 0.13.
         return skimage.transform.resize(
@@ -0,0 +1,631 @@
+import sys
+import time
+import pickle
+import numpy as np
+import cv2
+import mymrcnn.utils as utils
+# Maximum fraction of pixels allowed to differ between a fast path and the
+# reference path. Bilinear kernels only disagree on ties and border pixels.
+MAX_MISMATCH = 0.01
+def timeIt(fn, repeat=10):
+    fn()
+    start = time.time()
+    for i in range(repeat):
+        fn()
+    return (time.time() - start) / repeat
+def randomMasks(count, shape=(384, 576), seed=2019):
+    rng = np.random.RandomState(seed)
+    masks = np.zeros(shape + (count,), dtype=np.uint8)
+    for i in range(count):
+        center = (int(rng.randint(40, shape[1] - 40)), int(rng.randint(40, shape[0] - 40)))
+        axes = (int(rng.randint(10, 200)), int(rng.randint(10, 120)))
+        plane = np.zeros(shape, dtype=np.uint8)
+        cv2.ellipse(plane, center, axes, float(rng.randint(0, 180)), 0, 360, 1, -1)
+        masks[:, :, i] = plane
+    return masks
+def mismatch(a, b):
+    return np.mean(np.not_equal(a.astype(bool), b.astype(bool)))
+def runMaskKernelCheck(count=32):
+    config_mini_shape = (32, 48)
+    masks = randomMasks(count)
+    bbox = utils.extract_bboxes(masks)
+    ref_mini = utils.minimize_mask(bbox, masks, config_mini_shape)
+    fast_mini = utils.batch_minimize_mask(bbox, masks, config_mini_shape)
+    print("minimize_mask mismatch", mismatch(ref_mini, fast_mini))
+    assert mismatch(ref_mini, fast_mini) <= MAX_MISMATCH
+    ref_full = utils.expand_mask(bbox, ref_mini, masks.shape)
+    fast_full = utils.batch_expand_mask(bbox, ref_mini, masks.shape)
+    print("expand_mask mismatch", mismatch(ref_full, fast_full))
+    assert mismatch(ref_full, fast_full) <= MAX_MISMATCH
+    pred = np.random.RandomState(7).rand(count, 64, 96).astype(np.float32)
+    pred = np.stack([cv2.GaussianBlur(p, (9, 9), 0) for p in pred])
+    ref_unmold = np.stack([utils.unmold_mask(pred[i], bbox[i], masks.shape)
+                           for i in range(count)], axis=-1)
+    fast_unmold = utils.batch_unmold_mask(pred, bbox, masks.shape)
+    print("unmold_mask mismatch", mismatch(ref_unmold, fast_unmold))
+    assert mismatch(ref_unmold, fast_unmold) <= MAX_MISMATCH
+    print("minimize_mask       {:8.2f} ms".format(1000 * timeIt(
+        lambda: utils.minimize_mask(bbox, masks, config_mini_shape))))
+    print("batch_minimize_mask {:8.2f} ms".format(1000 * timeIt(
+        lambda: utils.batch_minimize_mask(bbox, masks, config_mini_shape))))
+    print("unmold_mask loop    {:8.2f} ms".format(1000 * timeIt(
+        lambda: [utils.unmold_mask(pred[i], bbox[i], masks.shape) for i in range(count)])))
+    print("batch_unmold_mask   {:8.2f} ms".format(1000 * timeIt(
+        lambda: utils.batch_unmold_mask(pred, bbox, masks.shape))))
+def runResizePlanCheck(count=8):
+    class PlanConfig(object):
+        IMAGE_MIN_DIM = 384
+        IMAGE_MAX_DIM = 576
+        IMAGE_MIN_SCALE = 0
+        IMAGE_RESIZE_MODE = "square"
+    config = PlanConfig()
+    rng = np.random.RandomState(2019)
+    images = [rng.randint(0, 255, (700, 1050, 3)).astype(np.uint8) for i in range(count)]
+    masks = [randomMasks(4, shape=(700, 1050), seed=i) for i in range(count)]
+    plan = utils.get_resize_plan(images[0].shape, config)
+    ref_image, window, scale, padding, crop = utils.resize_image(
+        images[0], min_dim=config.IMAGE_MIN_DIM, max_dim=config.IMAGE_MAX_DIM,
+        min_scale=config.IMAGE_MIN_SCALE, mode=config.IMAGE_RESIZE_MODE)
+    ref_mask = utils.resize_mask(masks[0], scale, padding, crop)
+    fast_images, fast_masks = plan.apply(images, masks)
+    assert fast_images[0].shape == ref_image.shape and fast_masks[0].shape == ref_mask.shape
+    assert tuple(window) == tuple(plan.window) and scale == plan.scale
+    print("image max abs diff", np.abs(ref_image.astype(np.int32) - fast_images[0]).max())
+    print("resize_mask mismatch", mismatch(ref_mask, fast_masks[0]))
+    assert mismatch(ref_mask, fast_masks[0]) <= MAX_MISMATCH
+    def reference():
+        for image, mask in zip(images, masks):
+            image, window, scale, padding, crop = utils.resize_image(
+                image, min_dim=config.IMAGE_MIN_DIM, max_dim=config.IMAGE_MAX_DIM,
+                min_scale=config.IMAGE_MIN_SCALE, mode=config.IMAGE_RESIZE_MODE)
+            utils.resize_mask(mask, scale, padding, crop)
+    print("resize_image/mask loop {:8.2f} ms".format(1000 * timeIt(reference, repeat=3)))
+    print("ResizePlan.apply       {:8.2f} ms".format(1000 * timeIt(
+        lambda: utils.get_resize_plan(images[0].shape, config).apply(images, masks), repeat=3)))
+def loopBboxes(mask):
+    boxes = np.zeros([mask.shape[-1], 4], dtype=np.int32)
+    for i in range(mask.shape[-1]):
+        horizontal_indicies = np.where(np.any(mask[:, :, i], axis=0))[0]
+        vertical_indicies = np.where(np.any(mask[:, :, i], axis=1))[0]
+        if horizontal_indicies.shape[0]:
+            x1, x2 = horizontal_indicies[[0, -1]]
+            y1, y2 = vertical_indicies[[0, -1]]
+            boxes[i] = [y1, x1, y2 + 1, x2 + 1]
+    return boxes
+def maskToRle(mask):
+    # Column major, 1-based starts, the train.csv format
+    pixels = np.concatenate([[0], mask.T.flatten(), [0]])
+    runs = np.where(pixels[1:] != pixels[:-1])[0] + 1
+    runs[1::2] -= runs[::2]
+    return " ".join(str(x) for x in runs)
+def runBboxCheck(count=64):
+    masks = randomMasks(count)
+    masks[:, :, 0] = 0
+    ref = loopBboxes(masks)
+    assert np.array_equal(ref, utils.extract_bboxes(masks))
+    rles = [maskToRle(masks[:, :, i]) for i in range(count)]
+    assert np.array_equal(ref, utils.extract_bboxes_rle(rles, masks.shape[0], masks.shape[1]))
+    print("extract_bboxes loop {:8.2f} ms".format(1000 * timeIt(lambda: loopBboxes(masks))))
+    print("extract_bboxes      {:8.2f} ms".format(1000 * timeIt(lambda: utils.extract_bboxes(masks))))
+    print("extract_bboxes_rle  {:8.2f} ms".format(1000 * timeIt(
+        lambda: utils.extract_bboxes_rle(rles, masks.shape[0], masks.shape[1]))))
+def runRegistryCheck(count=20000):
+    from mymrcnn.ImageDataSet import ImageRegistry, ImageDataSetForMRCNN
+    classes = ["Gravel","Sugar","Fish","Flower"]
+    rng = np.random.RandomState(2019)
+    registry = ImageRegistry(classes)
+    ids = ["{:07x}".format(i) for i in range(count)]
+    for image_id in ids:
+        masks = [[image_id + "_" + clz + "_" + str(k) + ".png" for k in range(rng.randint(0, 3))]
+                 for clz in classes]
+        registry.add(image_id, [len(m) > 0 for m in masks], masks)
+    registry.freeze()
+    dataset = ImageDataSetForMRCNN("D:/MyWork")
+    start = time.time()
+    dataset.preload(ids, classes)
+    dataset.sub_image_info = registry
+    dataset.prepare()
+    print("preload + prepare     {:8.2f} ms".format(1000 * (time.time() - start)))
+    payload = pickle.dumps(dataset, protocol=pickle.HIGHEST_PROTOCOL)
+    print("pickled dataset       {:8.2f} MB".format(len(payload) / 2 ** 20))
+    print("pickle round trip     {:8.2f} ms".format(1000 * timeIt(
+        lambda: pickle.loads(pickle.dumps(dataset, protocol=pickle.HIGHEST_PROTOCOL)), repeat=3)))
+    clone = pickle.loads(payload)
+    assert clone.sub_image_info.masks(ids[5], 1) == registry.masks(ids[5], 1)
+    assert clone.image_info[5]["id"] == ids[5]
+def batchGraphInputs(batch_size, anchors, num_classes, rois=64, seed=2019):
+    # Inputs of the three per-image graphs of mrcnn.model. The detection
+    # target proposals are 8 boxes around the ground truth box and 8 away from
+    # it per image, so every one is sampled and only their order is random.
+    rng = np.random.RandomState(seed)
+    boxes = np.sort(rng.rand(batch_size, anchors, 2, 2), axis=2)
+    inputs = {
+        "probs": rng.rand(batch_size, anchors, 2),
+        "deltas": rng.randn(batch_size, anchors, 4) * 0.1,
+        "anchors": boxes.transpose(0, 1, 3, 2).reshape(batch_size, anchors, 4),
+    }
+    gt_boxes = np.zeros((batch_size, 4, 4))
+    gt_class_ids = np.zeros((batch_size, 4), dtype=np.int32)
+    proposals = np.zeros((batch_size, 24, 4))
+    for b in range(batch_size):
+        y1, x1 = rng.uniform(0.05, 0.2, 2)
+        gt_boxes[b, 0] = [y1, x1, y1 + rng.uniform(0.25, 0.35), x1 + rng.uniform(0.25, 0.35)]
+        gt_class_ids[b, 0] = rng.randint(1, num_classes)
+        proposals[b, :8] = gt_boxes[b, 0] + rng.uniform(-0.02, 0.02, (8, 4))
+        y1, x1 = rng.uniform(0.6, 0.8, (2, 8))
+        proposals[b, 8:16] = np.stack([y1, x1, y1 + 0.15, x1 + 0.15], axis=1)
+    inputs.update({"proposals": proposals, "gt_class_ids": gt_class_ids, "gt_boxes": gt_boxes,
+                   "gt_masks": rng.rand(batch_size, 56, 56, 4) > 0.5})
+    boxes = np.sort(rng.rand(batch_size, rois, 2, 2), axis=2)
+    logits = rng.randn(batch_size, rois, num_classes) * 5
+    inputs.update({
+        "rois": boxes.transpose(0, 1, 3, 2).reshape(batch_size, rois, 4),
+        "mrcnn_class": np.exp(logits) / np.exp(logits).sum(axis=-1, keepdims=True),
+        "mrcnn_bbox": rng.randn(batch_size, rois, num_classes, 4) * 0.1,
+    })
+    return inputs
+def buildBatchGraphs(config, inputs):
+    import tensorflow as tf
+    import mrcnn.model as modellib
+    t = {k: tf.constant(v if v.dtype.kind in "bi" else v.astype(np.float32))
+         for k, v in inputs.items()}
+    proposals = modellib.ProposalLayer(config.POST_NMS_ROIS_INFERENCE, config.RPN_NMS_THRESHOLD,
+                                       config=config)([t["probs"], t["deltas"], t["anchors"]])
+    targets = modellib.DetectionTargetLayer(config)(
+        [t["proposals"], t["gt_class_ids"], t["gt_boxes"], t["gt_masks"]])
+    shape = config.IMAGE_SHAPE
+    meta = np.stack([modellib.compose_image_meta(0, shape, shape, [0, 0, shape[0], shape[1]], 1.,
+                                                 np.ones(config.NUM_CLASSES))
+                     for _ in range(config.BATCH_SIZE)]).astype(np.float32)
+    detections = modellib.DetectionLayer(config)(
+        [t["rois"], t["mrcnn_class"], t["mrcnn_bbox"], tf.constant(meta)])
+    return [proposals] + list(targets) + [detections]
+def sortTargets(rois, class_ids, deltas, masks):
+    # The sampling shuffles the detection targets, put them in roi order
+    result = []
+    for b in range(rois.shape[0]):
+        order = np.lexsort(rois[b].T[::-1])
+        result.append([rois[b][order], class_ids[b][order], deltas[b][order], masks[b][order]])
+    return [np.stack(r) for r in zip(*result)]
+def runBatchGraphCheck(batch_sizes=(1, 8, 32), anchors=4096):
+    import tensorflow as tf
+    from mrcnn.config import Config
+    for batch_size in batch_sizes:
+        results = {}
+        for mode in ("slice", "map"):
+            class GraphConfig(Config):
+                NAME = "graph"
+                NUM_CLASSES = 5
+                IMAGES_PER_GPU = batch_size
+                TRAIN_ROIS_PER_IMAGE = 32
+                ROI_POSITIVE_RATIO = 0.5
+                MAX_GT_INSTANCES = 4
+                BATCH_GRAPH_MODE = mode
+            config = GraphConfig()
+            inputs = batchGraphInputs(batch_size, anchors, config.NUM_CLASSES)
+            graph = tf.Graph()
+            start = time.time()
+            with graph.as_default():
+                outputs = buildBatchGraphs(config, inputs)
+            build = time.time() - start
+            with tf.Session(graph=graph) as session:
+                results[mode] = session.run(outputs)
+                run = timeIt(lambda: session.run(outputs), repeat=3)
+            print("batch {:3d} {:5s} ops {:6d} build {:8.2f} ms run {:8.2f} ms".format(
+                batch_size, mode, len(graph.get_operations()), 1000 * build, 1000 * run))
+        slice_outputs, map_outputs = results["slice"], results["map"]
+        assert np.allclose(slice_outputs[0], map_outputs[0], atol=1e-5), "proposals differ"
+        for a, b in zip(sortTargets(*slice_outputs[1:5]), sortTargets(*map_outputs[1:5])):
+            assert np.allclose(a, b, atol=1e-5), "detection targets differ"
+        assert np.allclose(slice_outputs[5], map_outputs[5], atol=1e-5), "detections differ"
+def loopPOI(images, pool_shape, scale_list, image_count):
+    import tensorflow as tf
+    from mymrcnn.myBackboneModel import generateBoxByScaleList
+    imgTensors = []
+    for box in generateBoxByScaleList(scale_list):
+        imgTensors.append(tf.image.crop_and_resize(images, np.full([image_count, 4], box),
+                                                   np.arange(image_count), pool_shape, method="bilinear"))
+    return tf.concat(imgTensors, axis=1)
+def runPOICheck(batch_size=4, shape=(24, 36, 256), pool_shape=(7, 7)):
+    import tensorflow as tf
+    from mymrcnn.myBackboneModel import POILayer
+    features = np.random.RandomState(2019).rand(batch_size, *shape).astype(np.float32)
+    results = {}
+    for name in ("loop", "batched"):
+        graph = tf.Graph()
+        start = time.time()
+        with graph.as_default():
+            images = tf.constant(features)
+            if name == "loop":
+                output = loopPOI(images, pool_shape, [8, 4, 2, 1], batch_size)
+            else:
+                output = POILayer(pool_shape, [8, 4, 2, 1])(images)
+        build = time.time() - start
+        with tf.Session(graph=graph) as session:
+            results[name] = session.run(output)
+            run = timeIt(lambda: session.run(output))
+        print("POI {:7s} ops {:5d} build {:8.2f} ms run {:8.2f} ms".format(
+            name, len(graph.get_operations()), 1000 * build, 1000 * run))
+    assert results["loop"].shape == results["batched"].shape
+    assert np.array_equal(results["loop"], results["batched"])
+def runThroughputCheck(batch_sizes=(1, 8, 32), repeat=3):
+    import keras.layers as KL
+    import keras.models as KM
+    from mymrcnn.myBackboneModel import dense_graph_simple_long, POILayer, FeatureTransformLayer
+    input_image = KL.Input(shape=[384, 576, 3], name="input_image")
+    L1, L2, L3, L4, L5 = dense_graph_simple_long(input_image, stage5=True, train_bn=False)
+    pooled = [POILayer((7, 7), [8, 4, 2, 1], name="poi_" + str(i))(x)
+              for i, x in enumerate([L5, L5, L5])]
+    features = FeatureTransformLayer(name="transform_pyramid_pooling_layer")(pooled)
+    model = KM.Model(input_image, features)
+    rng = np.random.RandomState(2019)
+    reference = None
+    for batch_size in batch_sizes:
+        images = rng.rand(batch_size, 384, 576, 3).astype(np.float32)
+        if reference is None:
+            reference = (images[:1], model.predict(images[:1]))
+        else:
+            images[:1] = reference[0]
+        output = model.predict(images, batch_size=batch_size)
+        # One set of weights for every batch size, and the same answer
+        assert np.allclose(output[:1], reference[1], atol=1e-5)
+        seconds = timeIt(lambda: model.predict(images, batch_size=batch_size), repeat=repeat)
+        print("batch {:3d} {:8.2f} ms/batch {:8.2f} images/s".format(
+            batch_size, 1000 * seconds, batch_size / seconds))
+def randomizeBatchNorms(model, seed=2019):
+    import keras.layers as KL
+    rng = np.random.RandomState(seed)
+    for layer in model.layers:
+        if isinstance(layer, KL.BatchNormalization):
+            layer.set_weights([rng.uniform(0.5, 1.5, w.shape).astype(np.float32) if i in (0, 3)
+                               else rng.uniform(-0.2, 0.2, w.shape).astype(np.float32)
+                               for i, w in enumerate(layer.get_weights())])
+def runFoldCheck(batch_size=4, repeat=5):
+    import keras.layers as KL
+    import keras.models as KM
+    from mymrcnn.myBackboneModel import dense_graph_simple_long, msk_class_loss_graph
+    from mymrcnn import inferenceexport
+    input_image = KL.Input(shape=[384, 576, 3], name="input_image")
+    input_class_ids = KL.Input(shape=[4], name="input_image_class_id")
+    L1, L2, L3, L4, L5 = dense_graph_simple_long(input_image, stage5=True, train_bn=False)
+    x = KL.Conv2D(256, (7, 7), name='pre_class_conv_l_1', padding="same")(L5)
+    x = KL.Conv2D(4, (24, 36), name='classifier_conv_l', padding="valid")(x)
+    x = KL.Activation("softmax")(x)
+    loss = KL.Lambda(lambda t: msk_class_loss_graph(*t), name="class_loss_l")([input_class_ids, x])
+    model = KM.Model([input_image, input_class_ids], [x, loss])
+    randomizeBatchNorms(model)
+    inference_model = inferenceexport.export_inference_model(model)
+    count = lambda m, cls: sum(isinstance(l, cls) for l in m.layers)
+    print("layers {} -> {}, BatchNorm {} -> {}, Dropout {} -> {}".format(
+        len(model.layers), len(inference_model.layers),
+        count(model, KL.BatchNormalization), count(inference_model, KL.BatchNormalization),
+        count(model, KL.Dropout), count(inference_model, KL.Dropout)))
+    images = np.random.RandomState(7).rand(batch_size, 384, 576, 3).astype(np.float32)
+    max_diff = inferenceexport.verify(model, inference_model, {"input_image": images},
+                                      batch_size=batch_size)
+    print("max abs diff", max_diff)
+    reference = KM.Model(input_image, x)
+    print("original  {:8.2f} ms/batch".format(1000 * timeIt(
+        lambda: reference.predict(images, batch_size=batch_size), repeat=repeat)))
+    print("exported  {:8.2f} ms/batch".format(1000 * timeIt(
+        lambda: inference_model.predict(images, batch_size=batch_size), repeat=repeat)))
+def runAccumulateCheck(steps=4, momentum=0.9, cycles=3):
+    import keras
+    import keras.layers as KL
+    import keras.models as KM
+    from mymrcnn.optimizers import AccumulateOptimizer
+    rng = np.random.RandomState(3)
+    x = rng.rand(steps * cycles, 16).astype(np.float32)
+    y = rng.rand(steps * cycles, 4).astype(np.float32)
+    def build(optimizer):
+        inputs = KL.Input(shape=[16])
+        model = KM.Model(inputs, KL.Dense(4, kernel_initializer=keras.initializers.Constant(0.1))(inputs))
+        model.compile(optimizer=optimizer, loss="mse")
+        return model
+    # One batch of `steps` images against `steps` accumulated batches of one
+    large = build(keras.optimizers.SGD(lr=0.1, momentum=momentum, clipnorm=0.5))
+    small = build(AccumulateOptimizer(keras.optimizers.SGD(lr=0.1, momentum=momentum, clipnorm=0.5), steps))
+    for cycle in range(cycles):
+        batch = slice(cycle * steps, (cycle + 1) * steps)
+        large.train_on_batch(x[batch], y[batch])
+        for i in range(batch.start, batch.stop):
+            small.train_on_batch(x[i:i + 1], y[i:i + 1])
+    diff = max(float(np.max(np.abs(a - b))) for a, b in zip(large.get_weights(), small.get_weights()))
+    print("max weight diff after {} updates: {}".format(cycles, diff))
+    assert diff < 1e-5
+class SyntheticDataset(object):
+    # Input shapes, and image ids for the sampler of cpu_parallel.train
+    def __init__(self, shapes, count):
+        self.shapes = shapes
+        self.image_ids = np.arange(count)
+def syntheticBatches(dataset, config, shuffle=True, batch_size=1, **kwargs):
+    # Random model inputs, so the scaling check measures training only
+    rng = np.random.RandomState()
+    while True:
+        yield [rng.rand(batch_size, *shape).astype(np.float32) for shape in dataset.shapes], []
+def runParallelScalingCheck(max_workers=None, steps=20):
+    import tempfile
+    import keras.backend as K
+    from mymrcnn.config import Config
+    from mymrcnn import cpu_parallel
+    import mymrcnn.myBackboneModel as modellib
+    config = Config()
+    config.NAME = "cpu_parallel_scaling"
+    config.STEPS_PER_EPOCH = steps
+    model_dir = tempfile.mkdtemp()
+    model = modellib.MyBackboneModel(mode="training", config=config, model_dir=model_dir)
+    shapes = [tuple(K.int_shape(t)[1:]) for t in model.keras_model.inputs]
+    max_workers = max_workers or len(cpu_parallel.core_groups(1)[0])
+    counts = sorted(set([1] + [2 ** i for i in range(1, 8) if 2 ** i <= max_workers] + [max_workers]))
+    dataset = SyntheticDataset(shapes, steps * max_workers * config.BATCH_SIZE)
+    base = None
+    for workers in counts:
+        config.VALIDATION_STEPS = workers
+        model.epoch = 0
+        # The first epoch warms up the sessions, report the second
+        results = cpu_parallel.train(model, syntheticBatches, dataset, dataset, 0.001, 2,
+                                     workers, save=False)
+        rate = results[-1]["images_per_second"]
+        base = base or rate
+        print("{:3} workers {:8.2f} images/s  speedup {:5.2f}  efficiency {:4.0%}".format(
+            workers, rate, rate / base, rate / base / workers))
+def runTilingCheck(count=4, shape=(1400, 2100, 3), batch_sizes=(1, 8, 32)):
+    from mymrcnn.tiling import TiledPredictor
+    rng = np.random.RandomState(5)
+    images = [rng.rand(*shape).astype(np.float32) for _ in range(count)]
+    # An identity model must give the image back, whatever the blending
+    for scale in (1.0, 0.5):
+        predictor = TiledPredictor(lambda tiles: tiles.copy(), (384, 576), overlap=64,
+                                   batch_size=8, scale=scale)
+        for image, prediction in zip(images, predictor.predict(images)):
+            expected = cv2.resize(image, (prediction.shape[1], prediction.shape[0]),
+                                  interpolation=cv2.INTER_LINEAR) if scale != 1.0 else image
+            assert prediction.shape == expected.shape
+            assert np.allclose(prediction, expected, atol=1e-5)
+    # A strided head, output 1/32 of the tile
+    predictor = TiledPredictor(lambda tiles: tiles[:, ::32, ::32], (384, 576), overlap=64, scale=1.0)
+    print("strided output", predictor.predict(images[:1])[0].shape)
+    for batch_size in batch_sizes:
+        predictor = TiledPredictor(lambda tiles: tiles.copy(), (384, 576), overlap=64,
+                                   batch_size=batch_size, scale=1.0)
+        print("batch {:3}  {:8.2f} ms/image".format(batch_size, 1000 * timeIt(
+            lambda: predictor.predict(images), repeat=3) / count))
+def runPyramidCheck(count=8, shape=(1400, 2100, 3)):
+    import os
+    import tempfile
+    from mymrcnn import pyramid
+    source_dir = tempfile.mkdtemp()
+    rng = np.random.RandomState(11)
+    ids = ["{:07d}".format(i) for i in range(count)]
+    for image_id in ids:
+        image = cv2.GaussianBlur(rng.randint(0, 256, shape).astype(np.uint8), (0, 0), 3)
+        cv2.imwrite(os.path.join(source_dir, image_id + ".jpg"), image)
+    gamma = pyramid.unit_rgb_transform(0.8)
+    requests = [((384, 576), "canny"), ((320, 480), gamma), ((384, 576), "bgr"), (None, "bgr")]
+    def separate():
+        # What the loaders do today, one decode per request
+        for image_id in ids:
+            path = os.path.join(source_dir, image_id + ".jpg")
+            for size, transform in requests:
+                image = cv2.imread(path)
+                if size is not None:
+                    image = cv2.resize(image, (size[1], size[0]))
+                pyramid.TRANSFORMS[transform](image)
+    def pyramided():
+        image_pyramid = pyramid.ImagePyramid(source_dir)
+        for size, transform in requests:
+            image_pyramid.register(size, transform)
+        for image_id in ids:
+            for size, transform in requests:
+                image_pyramid.get(image_id, size, transform)
+        return image_pyramid
+    image_pyramid = pyramided()
+    assert image_pyramid.decodes == count
+    for image_id in ids:
+        image = cv2.imread(os.path.join(source_dir, image_id + ".jpg"))
+        small = cv2.resize(image, (576, 384))
+        assert np.array_equal(image_pyramid.get(image_id, (384, 576), "canny")[..., :3], small)
+        assert np.array_equal(image_pyramid.get(image_id, None), image)
+        # The UNet path resizes the float image, the pyramid the uint8 one
+        unet = np.power(cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2RGB).astype(np.float32) / 255.,
+                                   (480, 320)), 0.8)
+        assert np.max(np.abs(image_pyramid.get(image_id, (320, 480), gamma) - unet)) < 0.02
+    print("decodes {} for {} requests".format(image_pyramid.decodes, count * len(requests)))
+    print("separate {:8.2f} ms/image".format(1000 * timeIt(separate, repeat=3) / count))
+    print("pyramid  {:8.2f} ms/image".format(1000 * timeIt(pyramided, repeat=3) / count))
+def runSamplerCheck(num_images=5546, workers=4, epochs=3):
+    from mymrcnn import samplers
+    shard_size = samplers.Sampler(num_images, workers=workers).shard_size
+    for epoch in range(epochs):
+        drawn = []
+        for rank in range(workers):
+            sampler = samplers.Sampler(num_images, workers=workers, rank=rank,
+                                       samples=epoch * shard_size * workers)
+            drawn.append([sampler.next() for _ in range(shard_size)])
+        drawn = np.concatenate(drawn)
+        # Together one pass over the data, padded by fewer than workers repeats
+        assert len(np.unique(drawn)) == num_images
+        assert len(drawn) == shard_size * workers < num_images + workers
+    # A sampler resumed from a state continues the same order
+    sampler = samplers.Sampler(num_images, workers=workers, rank=1)
+    first = [sampler.next() for _ in range(shard_size + 17)]
+    state = sampler.state()
+    rest = [sampler.next() for _ in range(100)]
+    resumed = samplers.Sampler.from_state(state, rank=1)
+    assert [resumed.next() for _ in range(100)] == rest
+    print("{} shards of {} images, resume matches".format(workers, shard_size))
+def runAugmentCheck(batch_size=24, shape=(320, 480), classes=4, repeat=5):
+    from mymrcnn import augmentation
+    rng = np.random.RandomState(5)
+    images = rng.random_sample((batch_size,) + shape + (3,)).astype(np.float32)
+    masks = (rng.random_sample((batch_size,) + shape + (classes,)) > 0.7).astype(np.int64)
+    augmenter = augmentation.albumentations_compatible(seed=5)
+    # Flips folded into an identity warp match the strided flips
+    params = augmenter.sample(batch_size)
+    params.update(angle=np.zeros(batch_size), scale=np.ones(batch_size),
+                  dx=np.zeros(batch_size), dy=np.zeros(batch_size))
+    flipped, flipped_masks = augmenter(images, masks, dict(params, affine=np.zeros(batch_size, bool)))
+    warped, warped_masks = augmenter(images, masks, dict(params, affine=np.ones(batch_size, bool)))
+    assert np.allclose(flipped, warped, atol=1e-5) and np.array_equal(flipped_masks, warped_masks)
+    for i in range(batch_size):
+        expected = masks[i, ::-1 if params["vflip"][i] else 1, ::-1 if params["hflip"][i] else 1]
+        assert np.array_equal(flipped_masks[i], expected)
+    print("batch    {:8.2f} ms/batch".format(1000 * timeIt(lambda: augmenter(images, masks), repeat)))
+    try:
+        import albumentations as albu
+    except ImportError:
+        print("albumentations not installed, no per sample comparison")
+        return
+    def perSample():
+        out_images, out_masks = images.copy(), masks.copy()
+        for i in range(batch_size):
+            composition = albu.Compose([
+                albu.HorizontalFlip(),
+                albu.VerticalFlip(),
+                albu.ShiftScaleRotate(rotate_limit=30, shift_limit=0.1)
+            ])
+            composed = composition(image=out_images[i], mask=out_masks[i].astype(np.uint8))
+            out_images[i], out_masks[i] = composed["image"], composed["mask"]
+    print("albu     {:8.2f} ms/batch".format(1000 * timeIt(perSample, repeat)))
+def runPruneCheck(ratio=0.5, batch_size=2, repeat=5):
+    import keras.layers as KL
+    from mymrcnn import distillation
+    from mymrcnn import planner
+    from mymrcnn import pruning
+    model = distillation.build_student((384, 576, 3), 4, backbone="long")
+    randomizeBatchNorms(model)
+    # Zero the BatchNorm channels the plan removes, so they output zeros
+    # and the pruned model must match the original
+    plan = pruning.prune_plan(pruning.filter_scores(model, "gamma"), ratio)
+    for name, keep in plan.items():
+        bn = [l for l in model.layers if isinstance(l, KL.BatchNormalization)
+              and l.get_input_at(0) is model.get_layer(name).get_output_at(0)]
+        if bn:
+            weights = bn[0].get_weights()
+            dropped = np.setdiff1d(np.arange(len(weights[0])), keep)
+            weights[0][dropped] = 0
+            weights[1][dropped] = 0
+            bn[0].set_weights(weights)
+    pruned = pruning.rebuild(model, plan)
+    images = np.random.RandomState(7).rand(batch_size, 384, 576, 3).astype(np.float32)
+    diff = np.abs(model.predict(images) - pruned.predict(images)).max()
+    print("max abs diff", diff)
+    assert diff < 1e-4, diff
+    print("convs pruned {}, params {} -> {}, GFLOPs {:.3f} -> {:.3f}".format(
+        len(plan), model.count_params(), pruned.count_params(),
+        planner.model_flops(model) / 1e9, planner.model_flops(pruned) / 1e9))
+    print("original  {:8.2f} ms/batch".format(pruning.latency(model, images, batch_size, repeat)))
+    print("pruned    {:8.2f} ms/batch".format(pruning.latency(pruned, images, batch_size, repeat)))
+def runPlannerCheck(batch_size=4, ram_gb=8):
+    import keras.layers as KL
+    import keras.models as KM
+    from mymrcnn import distillation
+    from mymrcnn import planner
+    # One conv and one TimeDistributed dense, against the closed forms
+    input_image = KL.Input(shape=[96, 144, 3])
+    x = KL.Conv2D(16, (7, 7), strides=(2, 2), padding="same")(input_image)
+    x = KL.Reshape((48, 72 * 16))(x)
+    x = KL.TimeDistributed(KL.Dense(8))(x)
+    plan = planner.plan(KM.Model(input_image, x))
+    expected = 2 * 48 * 72 * 16 * 7 * 7 * 3 + 2 * 48 * 72 * 16 * 8
+    assert plan.flops == expected, (plan.flops, expected)
+    expected = 4 * (96 * 144 * 3 + 2 * 48 * 72 * 16 + 48 * 8)
+    assert plan.activation_bytes == expected, (plan.activation_bytes, expected)
+    model = distillation.build_student((384, 576, 3), 4, backbone="long")
+    start = time.time()
+    plan = planner.plan(model)
+    print("planned {} layers in {:.2f} s".format(len(plan.layers), time.time() - start))
+    print(plan.format(batch_size, ram_gb, effective_batch=16))
+    # Without gradient accumulation only the batch is cut to what fits
+    ram = plan.memory(4) * 1.3
+    fits = plan.fit(ram)
+    recommendation = plan.recommend(ram, 16, accumulation=False)
+    assert recommendation["ACCUMULATION_STEPS"] == 1, recommendation
+    assert recommendation["IMAGES_PER_GPU"] == min(fits, 16), (recommendation, fits)
+def runBuildCacheCheck(batch_size=2):
+    import shutil
+    import tempfile
+    import keras.backend as K
+    from mymrcnn.config import Config
+    from mymrcnn import buildcache
+    from mymrcnn import distillation
+    import mymrcnn.myBackboneModel as backbones
+    config = Config()
+    config.NAME = "MyMRCNN_WHOLE_Model"
+    config.BUILD_CACHE = True
+    config.BUILD_CACHE_DIR = tempfile.mkdtemp()
+    build = lambda: distillation.build_student((384, 576, 3), 4, backbone="long")
+    modules = [distillation, backbones]
+    try:
+        start = time.time()
+        built = buildcache.cached_build(build, "inference", config, modules)
+        build_time = time.time() - start
+        randomizeBatchNorms(built)
+        weights = built.get_weights()
+        K.clear_session()
+        start = time.time()
+        loaded = buildcache.cached_build(build, "inference", config, modules)
+        load_time = time.time() - start
+        loaded.set_weights(weights)
+        images = np.random.RandomState(7).rand(batch_size, 384, 576, 3).astype(np.float32)
+        reference = build()
+        reference.set_weights(weights)
+        diff = np.abs(reference.predict(images) - loaded.predict(images)).max()
+        print("max abs diff", diff)
+        assert diff < 1e-5, diff
+        print("build {:.2f} s, cached {:.2f} s".format(build_time, load_time))
+    finally:
+        shutil.rmtree(config.BUILD_CACHE_DIR)
+def runServingCheck(requests=200, concurrency=16, batch_ms=20., shape=(384, 576)):
+    from mymrcnn import serving
+    masks = randomMasks(8, shape)
+    for i in range(masks.shape[-1]):
+        assert utils.mask_to_rle(masks[:, :, i]) == maskToRle(masks[:, :, i].astype(np.int8))
+    assert utils.mask_to_rle(np.zeros(shape, dtype=bool)) == ""
+    def predictFn(images):
+        # A model whose batch costs batch_ms whatever its size, like a GPU
+        # that isn't saturated
+        time.sleep(batch_ms / 1000.)
+        return [serving.mask_response(np.dstack([image.mean(axis=-1) / 255.] * 4), image.shape,
+                                      serving.CLASS_NAMES) for image in images]
+    image = (np.random.RandomState(7).rand(shape[0], shape[1], 3) * 255).astype(np.uint8)
+    payload = cv2.imencode(".png", image)[1].tobytes()
+    expected = utils.mask_to_rle(image.mean(axis=-1) / 255. >= 0.5)
+    for max_batch_size in (1, 8, 32):
+        server = serving.InferenceServer(predictFn, port=0, max_batch_size=max_batch_size,
+                                         max_wait_ms=10).start()
+        try:
+            assert serving.post_image(server.url, payload)["masks"][0]["rle"] == expected
+            result = serving.load_test(server.url, [payload], requests=requests,
+                                       concurrency=concurrency)
+        finally:
+            server.close()
+        assert result["statuses"] == {"200": requests}
+        print("max batch {:3}: {:7.1f} images/s, p50 {:7.1f} ms, p99 {:7.1f} ms, mean batch {:.2f}".format(
+            max_batch_size, result["throughput"], result["latency_ms"]["p50"],
+            result["latency_ms"]["p99"], result["server"]["mean_batch_size"]))
+BENCHMARKS = {
+    "masks": runMaskKernelCheck,
+    "resize": runResizePlanCheck,
+    "bboxes": runBboxCheck,
+    "registry": runRegistryCheck,
+    "batchgraph": runBatchGraphCheck,
+    "poi": runPOICheck,
+    "throughput": runThroughputCheck,
+    "fold": runFoldCheck,
+    "accumulate": runAccumulateCheck,
+    "cpuparallel": runParallelScalingCheck,
+    "tiling": runTilingCheck,
+    "pyramid": runPyramidCheck,
+    "sampler": runSamplerCheck,
+    "augment": runAugmentCheck,
+    "prune": runPruneCheck,
+    "planner": runPlannerCheck,
+    "buildcache": runBuildCacheCheck,
+    "serving": runServingCheck,
+}
+if __name__ == "__main__":
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+    for name in names:
+        print("==", name)
+        BENCHMARKS[name]()
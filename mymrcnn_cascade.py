@@ -0,0 +1,44 @@
+import os
+import sys
+import json
+from mymrcnn.config import Config
+import mymrcnn.ImageDataSet as dataSetlib
+import mymrcnn.cascade as cascade
+CLASS_MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myNewmrcnnClassWork_v2"), "logs")
+MASK_MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myMaskmrcnnWork"), "logs")
+WORK_DIR = "D:/MyWork"
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+def loadModels(config):
+    """Returns the classifier and mask keras models, at their last checkpoints."""
+    import mymrcnn.myBackboneModel_Multi as classlib
+    import mymrcnn.MyMaskModel_origin as masklib
+    classifier = classlib.MyBackboneModel(mode="inference", config=config, model_dir=CLASS_MODEL_DIR)
+    classifier.load_weights(classifier.find_last(), by_name=True)
+    mask = masklib.MyBackboneModel(mode="inference", config=config, model_dir=MASK_MODEL_DIR)
+    mask.load_weights(mask.find_last(), by_name=True)
+    return classifier.keras_model, mask.keras_model
+def runCascade(count):
+    config = Config()
+    config.NAME = "MyMRCNN_WHOLE_Model"
+    config.display()
+    dataSetFact = dataSetlib.ImageDataSetForMaskFactory(WORK_DIR)
+    dataSetFact.initialize(WORK_DIR + "/transformed_train.xlsx",
+                        WORK_DIR + '/data_train.xlsx',
+                        WORK_DIR + '/data_val.xlsx')
+    dataSetFact.preload_images()
+    _, dataset_val = dataSetFact.getDataSet()
+    dataset_val.prepare()
+    classifier, mask = loadModels(config)
+    predictor = cascade.CascadePredictor(
+        # Both models take BGR plus Canny, like the dataset's images
+        cascade.keras_predict_fn(classifier, config, output_index=0),
+        [cascade.Branch([0, 1, 2, 3], cascade.keras_predict_fn(mask, config))],
+        gates=config.CASCADE_GATES)
+    result = cascade.evaluate(predictor, dataset_val, count=count)
+    result["gates"] = list(config.CASCADE_GATES)
+    print(json.dumps(result, indent=2))
+    print("dice {:.4f} -> {:.4f} ({:+.4f}), mask compute saved {:.1%}, {:.1f}ms -> {:.1f}ms".format(
+        result["full_dice"], result["cascade_dice"], result["dice_delta"],
+        result["compute_saved"], result["full_ms"], result["cascade_ms"]))
+if __name__ == "__main__":
+    runCascade(COUNT)
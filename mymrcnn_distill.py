@@ -0,0 +1,41 @@
+import os
+import sys
+import json
+from mymrcnn.config import Config
+import mymrcnn.ImageDataSet as dataSetlib
+import mymrcnn.distillation as distillation
+TEACHER_MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myMaskmrcnnWork"), "logs")
+MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myDistillWork"), "logs")
+WORK_DIR = "D:/MyWork"
+STUDENT = sys.argv[1] if len(sys.argv) > 1 else None
+EPOCHS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+def loadTeacher(config):
+    """Returns the mask teacher keras model, at its last checkpoint: the
+    DenseNet201 of MyMaskModel, with one cloud channel at 1/32 scale."""
+    import mymrcnn.MyMaskModel as masklib
+    teacher = masklib.MyBackboneModel(mode="inference", config=config, model_dir=TEACHER_MODEL_DIR)
+    teacher.load_weights(teacher.find_last(), by_name=True)
+    return teacher.keras_model
+def runDistill(student, epochs):
+    config = Config()
+    config.NAME = "MyMRCNN_WHOLE_Model"
+    config.DISTILL_STUDENT = student or config.DISTILL_STUDENT
+    config.display()
+    dataSetFact = dataSetlib.ImageDataSetForMaskFactory(WORK_DIR)
+    dataSetFact.initialize(WORK_DIR + "/transformed_train.xlsx",
+                        WORK_DIR + '/data_train.xlsx',
+                        WORK_DIR + '/data_val.xlsx')
+    dataSetFact.preload_images()
+    dataset_train, dataset_val = dataSetFact.getDataSet()
+    dataset_train.prepare()
+    dataset_val.prepare()
+    distiller = distillation.Distiller(loadTeacher(config), config, MODEL_DIR,
+                                       backbone=config.DISTILL_STUDENT)
+    distiller.train(dataset_train, dataset_val, learning_rate=config.LEARNING_RATE, epochs=epochs)
+    result = distiller.report(dataset_val)
+    print(json.dumps(result, indent=2))
+    print("{}: {:.1f}ms -> {:.1f}ms ({:.1f}x), dice {:.4f} -> {:.4f} ({:+.4f})".format(
+        config.DISTILL_STUDENT, result["teacher_ms"], result["student_ms"], result["speedup"],
+        result["teacher_dice"], result["student_dice"], result["dice_gap"]))
+if __name__ == "__main__":
+    runDistill(STUDENT, EPOCHS)
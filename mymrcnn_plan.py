@@ -0,0 +1,31 @@
+import os
+import sys
+MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myPlanWork"), "logs")
+MODEL = sys.argv[1] if len(sys.argv) > 1 else "backbone"
+RAM_GB = float(sys.argv[2]) if len(sys.argv) > 2 else None
+MODELS = {
+    "backbone": "mymrcnn.myBackboneModel",
+    "multi": "mymrcnn.myBackboneModel_Multi",
+    "mask": "mymrcnn.MyMaskModel_origin",
+    "segmentation": "mymrcnn.segmentationModel",
+    "mrcnn": "mrcnn.model",
+}
+def runPlan(name, ram_gb):
+    """Builds the training graph of a model under the default config and
+    prints the config with its memory and FLOPs plan, see planner."""
+    import importlib
+    modellib = importlib.import_module(MODELS[name])
+    if name == "mrcnn":
+        from mrcnn.config import Config
+        class PlanConfig(Config):
+            NAME = "MyMRCNN_origin_Model"
+        config = PlanConfig()
+        model = modellib.MaskRCNN(mode="training", config=config, model_dir=MODEL_DIR)
+    else:
+        from mymrcnn.config import Config
+        config = Config()
+        config.NAME = "MyMRCNN_WHOLE_Model"
+        model = modellib.MyBackboneModel(mode="training", config=config, model_dir=MODEL_DIR)
+    config.display(model, ram_gb)
+if __name__ == "__main__":
+    runPlan(MODEL, RAM_GB)
@@ -0,0 +1,49 @@
+import os
+import sys
+from mymrcnn.config import Config
+import mymrcnn.ImageDataSet as dataSetlib
+import mymrcnn.distillation as distillation
+import mymrcnn.pruning as pruning
+TEACHER_MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myMaskmrcnnWork"), "logs")
+MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myDistillWork"), "logs")
+WORK_DIR = "D:/MyWork"
+STUDENT_WEIGHTS = sys.argv[1] if len(sys.argv) > 1 else None
+CRITERION = sys.argv[2] if len(sys.argv) > 2 else None
+def loadTeacher(config):
+    """Returns the mask teacher keras model, at its last checkpoint."""
+    import mymrcnn.MyMaskModel_origin as masklib
+    teacher = masklib.MyBackboneModel(mode="inference", config=config, model_dir=TEACHER_MODEL_DIR)
+    teacher.load_weights(teacher.find_last(), by_name=True)
+    return teacher.keras_model
+def runPruning(weights, criterion):
+    """Prunes a distilled student, see mymrcnn_distill.py, at each
+    PRUNE_RATIOS ratio and fine-tunes it on the teacher again."""
+    assert weights, "Usage: mymrcnn_prune.py student_weights.h5 [gamma|activation]"
+    config = Config()
+    config.NAME = "MyMRCNN_WHOLE_Model"
+    config.PRUNE_CRITERION = criterion or config.PRUNE_CRITERION
+    config.display()
+    dataSetFact = dataSetlib.ImageDataSetForMaskFactory(WORK_DIR)
+    dataSetFact.initialize(WORK_DIR + "/transformed_train.xlsx",
+                        WORK_DIR + '/data_train.xlsx',
+                        WORK_DIR + '/data_val.xlsx')
+    dataSetFact.preload_images()
+    dataset_train, dataset_val = dataSetFact.getDataSet()
+    dataset_train.prepare()
+    dataset_val.prepare()
+    distiller = distillation.Distiller(loadTeacher(config), config, MODEL_DIR,
+                                       backbone=config.DISTILL_STUDENT)
+    distiller.load_weights(weights)
+    student = distiller.student
+    def fineTune(model, ratio):
+        distiller.set_student(model, "_pruned{:02d}".format(int(round(100 * ratio))))
+        distiller.train(dataset_train, dataset_val, learning_rate=config.LEARNING_RATE / 10,
+                        epochs=config.PRUNE_FINE_TUNE_EPOCHS)
+        return model
+    images = pruning.calibration_images(dataset_val, config, student)
+    rows = pruning.sweep(student, config.PRUNE_RATIOS, images, criterion=config.PRUNE_CRITERION,
+                         fine_tune=fineTune,
+                         evaluate=lambda m: pruning.evaluate_dice(m, dataset_val, config))
+    print(pruning.format_report(rows))
+if __name__ == "__main__":
+    runPruning(STUDENT_WEIGHTS, CRITERION)
@@ -0,0 +1,63 @@
+import os
+import sys
+import json
+import numpy as np
+import cv2
+from mymrcnn.config import Config
+import mymrcnn.ImageDataSet as dataSetlib
+import mymrcnn.quantization as quantization
+ROOT_DIR = os.path.abspath("D:/workfolder/myMaskmrcnnWork")
+MODEL_DIR = os.path.join(ROOT_DIR, "logs")
+WORK_DIR = "D:/MyWork"
+MODEL = sys.argv[1] if len(sys.argv) > 1 else "unet18"
+CALIBRATION_COUNT = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+def unetPreprocess(image):
+    # UNet.py feeds RGB images scaled to [0, 1], the data set loads BGR
+    return cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_BGR2RGB) / 255.
+def loadModel(name, config):
+    """Returns (keras model, preprocess function, output class names) of the
+    model to quantize."""
+    if name == "unet18":
+        import mymrcnn.segmentationModel as modellib
+        model = modellib.MyBackboneModel(mode="inference", config=config, model_dir=MODEL_DIR)
+        model.load_weights(model.find_last(), by_name=True)
+        return model.keras_model, None, None
+    if name == "mask":
+        import mymrcnn.MyMaskModel as modellib
+        model = modellib.MyBackboneModel(mode="training", config=config, model_dir=MODEL_DIR)
+        model.load_weights(model.find_last(), by_name=True)
+        return model.keras_model, None, None
+    if name == "unet34":
+        import segmentation_models as sm
+        model = sm.Unet('resnet34', classes=4, input_shape=(320, 480, 3), activation='sigmoid')
+        model.load_weights(WORK_DIR + "/model.h5")
+        # The sm.Unet of UNet.py orders the classes differently
+        return model, unetPreprocess, ["Fish", "Flower", "Gravel", "Sugar"]
+    raise ValueError("Unknown model {}, expected unet18, mask or unet34".format(name))
+def runQuantization(name, calibration_count):
+    config = Config()
+    config.NAME = "MyMRCNN_WHOLE_Model"
+    config.display()
+    dataSetFact = dataSetlib.ImageDataSetForMaskFactory(WORK_DIR)
+    dataSetFact.initialize(WORK_DIR + "/transformed_train.xlsx",
+                        WORK_DIR + '/data_train.xlsx',
+                        WORK_DIR + '/data_val.xlsx')
+    dataSetFact.preload_images()
+    _, dataset_val = dataSetFact.getDataSet()
+    dataset_val.prepare()
+    keras_model, preprocess, class_names = loadModel(name, config)
+    output_path = os.path.join(WORK_DIR, "{}_int8.tflite".format(name))
+    quantization.quantize(keras_model, dataset_val, config, output_path,
+                          calibration_count=calibration_count, preprocess=preprocess)
+    runner = quantization.QuantizedRunner(output_path)
+    result = quantization.evaluate(keras_model, runner, dataset_val, config,
+                                   count=calibration_count, preprocess=preprocess,
+                                   calibration_count=calibration_count, class_names=class_names)
+    result["model"] = name
+    result["size_mb"] = os.path.getsize(output_path) / 2. ** 20
+    print(json.dumps(result, indent=2))
+    print("{}: dice {:.4f} -> {:.4f} ({:+.4f}), latency {:.1f}ms -> {:.1f}ms".format(
+        name, result["float_dice"], result["int8_dice"], result["dice_delta"],
+        result["float_ms"], result["int8_ms"]))
+if __name__ == "__main__":
+    runQuantization(MODEL, CALIBRATION_COUNT)
@@ -0,0 +1,101 @@
+import os
+import sys
+import json
+import math
+import glob
+import numpy as np
+import cv2
+from mymrcnn.config import Config
+import mymrcnn.serving as serving
+CLASS_MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myNewmrcnnClassWork_v2"), "logs")
+MASK_MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myMaskmrcnnWork"), "logs")
+MRCNN_MODEL_DIR = os.path.join(os.path.abspath("D:/workfolder/myInheritedmrcnnWork"), "logs")
+WORK_DIR = "D:/MyWork"
+MODE = sys.argv[1] if len(sys.argv) > 1 else "serve"
+MODEL = sys.argv[2] if len(sys.argv) > 2 else "mask"
+# argv[3] is the port to serve on, or the image folder to load with
+PORT = int(sys.argv[3]) if len(sys.argv) > 3 and MODE == "serve" else 8500
+URL = sys.argv[2] if len(sys.argv) > 2 else "http://127.0.0.1:8500"
+IMAGE_DIR = sys.argv[3] if len(sys.argv) > 3 else WORK_DIR + "/test_images"
+REQUESTS = int(sys.argv[4]) if len(sys.argv) > 4 else 500
+CONCURRENCY = int(sys.argv[5]) if len(sys.argv) > 5 else 16
+def unetPreprocess(image):
+    # UNet.py feeds RGB images scaled to [0, 1], decode_image gives BGR
+    return cv2.cvtColor(image.astype(np.uint8), cv2.COLOR_BGR2RGB) / 255.
+def compute_backbone_shapes(image_shape):
+    return np.array(
+        [[int(math.ceil(image_shape[0] / stride)),
+            int(math.ceil(image_shape[1] / stride))]
+            for stride in [4, 8, 16, 32, 32]])
+def loadPredictFn(name, config):
+    """Returns (predict function, max batch size, channels) of the model to
+    serve, warm at its last checkpoint."""
+    if name == "mask":
+        import mymrcnn.MyMaskModel_origin as masklib
+        model = masklib.MyBackboneModel(mode="inference", config=config, model_dir=MASK_MODEL_DIR)
+        model.load_weights(model.find_last(), by_name=True)
+        return serving.mask_predict_fn(model.keras_model, config), config.SERVING_MAX_BATCH_SIZE, \
+            serving.input_channels(model.keras_model)
+    if name == "classifier":
+        import mymrcnn.myBackboneModel_Multi as classlib
+        model = classlib.MyBackboneModel(mode="inference", config=config, model_dir=CLASS_MODEL_DIR)
+        model.load_weights(model.find_last(), by_name=True)
+        return serving.classifier_predict_fn(model.keras_model, config), config.SERVING_MAX_BATCH_SIZE, \
+            serving.input_channels(model.keras_model)
+    if name == "unet18":
+        import mymrcnn.segmentationModel as modellib
+        model = modellib.MyBackboneModel(mode="inference", config=config, model_dir=MASK_MODEL_DIR)
+        model.load_weights(model.find_last(), by_name=True)
+        return serving.mask_predict_fn(model.keras_model, config), config.SERVING_MAX_BATCH_SIZE, \
+            serving.input_channels(model.keras_model)
+    if name == "unet34":
+        import segmentation_models as sm
+        model = sm.Unet('resnet34', classes=4, input_shape=(320, 480, 3), activation='sigmoid')
+        model.load_weights(WORK_DIR + "/model.h5")
+        # The sm.Unet of UNet.py orders the classes differently
+        return serving.mask_predict_fn(model, config, class_names=["Fish", "Flower", "Gravel", "Sugar"],
+                                       preprocess=unetPreprocess), config.SERVING_MAX_BATCH_SIZE, 3
+    if name == "mrcnn":
+        import myInheritedMrcnn.myConfig as cfg
+        import myInheritedMrcnn.mybackbonegraph as graph
+        import mrcnn.model as modellib
+        mrcnn_config = cfg.CloudPatternConfig()
+        mrcnn_config.NAME = "MyMRCNN_Inherited_Model"
+        mrcnn_config.BACKBONE = graph.dense_graph_simple_long
+        mrcnn_config.COMPUTE_BACKBONE_SHAPE = compute_backbone_shapes
+        mrcnn_config.IMAGE_SHAPE = [384,576,3]
+        model = modellib.MaskRCNN(mode="inference", config=mrcnn_config, model_dir=MRCNN_MODEL_DIR)
+        model.load_weights(model.find_last(), by_name=True)
+        # detect() runs exactly BATCH_SIZE images
+        return serving.detect_predict_fn(model), mrcnn_config.BATCH_SIZE, 3
+    raise ValueError("Unknown model {}, expected mask, classifier, unet18, unet34 or mrcnn".format(name))
+def runServer(name, port):
+    config = Config()
+    config.NAME = "MyMRCNN_WHOLE_Model"
+    config.display()
+    predict_fn, max_batch_size, channels = loadPredictFn(name, config)
+    decode = lambda data: serving.decode_image(data, canny=channels == 4)
+    server = serving.InferenceServer(predict_fn, host="127.0.0.1", port=port,
+                                     max_batch_size=max_batch_size,
+                                     max_wait_ms=config.SERVING_MAX_WAIT_MS,
+                                     max_queue=config.SERVING_MAX_QUEUE, decode=decode)
+    server.warmup(np.zeros((384, 576, channels), dtype=np.uint8))
+    print("Serving {} on {}".format(name, server.url))
+    server.serve_forever()
+def runLoad(url, image_dir, requests, concurrency):
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(image_dir, "*.jpg")))[:50]:
+        with open(path, "rb") as f:
+            payloads.append(f.read())
+    result = serving.load_test(url, payloads, requests=requests, concurrency=concurrency)
+    print(json.dumps(result, indent=2))
+    print("{} clients: {:.1f} images/s, p50 {:.1f}ms, p99 {:.1f}ms, mean batch {:.2f}".format(
+        concurrency, result["throughput"], result["latency_ms"]["p50"], result["latency_ms"]["p99"],
+        result["server"]["mean_batch_size"]))
+if __name__ == "__main__":
+    if MODE == "serve":
+        runServer(MODEL, PORT)
+    elif MODE == "load":
+        runLoad(URL, IMAGE_DIR, REQUESTS, CONCURRENCY)
+    else:
+        raise ValueError("Unknown mode {}, expected serve or load".format(MODE))